@@ -0,0 +1,198 @@
+"""
+Small file-backed key-value cache shared by the scraper and the LLM layer.
+
+Each entry is stored as its own JSON file named after the hash of its key, so
+concurrent readers never need to load the whole cache.
+
+The number and size of the entries are tracked in memory. The folder is only
+scanned when a limit is exceeded, and then trimmed to `EVICTION_TARGET` of the
+limits, so that the next scans are many writes away.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Annotated, Optional
+
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.logger import logger
+
+EVICTION_TARGET = 0.9
+
+
+class CacheEntry(BaseModel):
+    key: str
+    value: str
+    stored_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.stored_at
+
+
+class DiskCache(BaseModel):
+    folder: Path
+    ttl: Annotated[
+        Optional[float], Doc("Seconds an entry stays fresh. None means forever.")
+    ] = None
+    max_entries: Annotated[
+        Optional[int], Doc("Least recently used entries are evicted above this.")
+    ] = None
+    max_size_bytes: Annotated[
+        Optional[int], Doc("Least recently used entries are evicted above this.")
+    ] = None
+    hits: int = 0
+    misses: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    # Entries and bytes on disk, None until the folder is first scanned
+    _entries: Optional[int] = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.folder / f"{digest}.json"
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return self.ttl is None or entry.age <= self.ttl
+
+    def get(self, key: str, allow_stale: bool = False) -> Optional[CacheEntry]:
+        path = self._path(key)
+        try:
+            entry = CacheEntry.model_validate_json(path.read_text(encoding="utf-8"))
+
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        except ValueError as e:
+            logger.warning(f"Dropping corrupted cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            self._count(hit=False)
+            return None
+
+        if entry.key != key:
+            # Hash collision, treat as a miss
+            self._count(hit=False)
+            return None
+
+        fresh = self.is_fresh(entry)
+        self._count(hit=fresh)
+        if not allow_stale and not fresh:
+            return None
+
+        # Mark as recently used for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return entry
+
+    def set(self, key: str, value: str) -> None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        entry = CacheEntry(key=key, value=value, stored_at=time.time())
+        data = entry.model_dump_json().encode("utf-8")
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        try:
+            replaced_size = path.stat().st_size
+        except FileNotFoundError:
+            replaced_size = None
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._entries is not None:
+                self._entries += replaced_size is None
+                self._size += len(data) - (replaced_size or 0)
+        if self._is_over_limit():
+            self.evict()
+
+    def _is_over_limit(self) -> bool:
+        if self.max_entries is None and self.max_size_bytes is None:
+            return False
+        with self._lock:
+            if self._entries is None:
+                return True
+            return (
+                self.max_entries is not None and self._entries > self.max_entries
+            ) or (self.max_size_bytes is not None and self._size > self.max_size_bytes)
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._entries is not None:
+                self._entries -= 1
+                self._size -= size
+
+    def evict(self) -> None:
+        """
+        Scan the folder and drop the least recently used entries until the cache
+        is within `EVICTION_TARGET` of its limits.
+        """
+        if self.max_entries is None and self.max_size_bytes is None:
+            return
+
+        max_entries = (
+            math.ceil(self.max_entries * EVICTION_TARGET)
+            if self.max_entries is not None
+            else None
+        )
+        max_size = (
+            self.max_size_bytes * EVICTION_TARGET
+            if self.max_size_bytes is not None
+            else None
+        )
+        with self._lock:
+            files = []
+            for path in self.folder.glob("*.json"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            # Most recently used first
+            files.sort(key=lambda x: x[0], reverse=True)
+            entries, total_size = 0, 0
+            for _, size, path in files:
+                if (max_entries is not None and entries >= max_entries) or (
+                    max_size is not None and total_size + size > max_size
+                ):
+                    # This entry and all the less recently used ones
+                    max_entries = 0
+                    path.unlink(missing_ok=True)
+                else:
+                    entries += 1
+                    total_size += size
+            self._entries, self._size = entries, total_size
+
+    def clear(self) -> None:
+        with self._lock:
+            for path in self.folder.glob("*.json"):
+                path.unlink(missing_ok=True)
+            self._entries, self._size = 0, 0
@@ -0,0 +1,49 @@
+"""
+Webpage extraction, run in the worker processes of the extraction pool.
+
+Spawned workers import this module to unpickle their task, so it only depends
+on newspaper: it stays out of `newsletter.scraper`, whose import creates the
+Reddit client and loads the settings in every worker.
+"""
+
+import os
+import time
+from typing import Any
+
+from newspaper import Article
+from newspaper.configuration import Configuration
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36 Edg/128.0.0.0"
+
+
+def get_config() -> Configuration:
+    custom_config = Configuration()
+    custom_config.browser_user_agent = USER_AGENT
+    return custom_config
+
+
+def extract_article(url: str, html: str) -> dict[str, Any]:
+    """
+    Parse the downloaded HTML into the fields of a `Webpage`. CPU-bound, no
+    network access.
+    """
+    article = Article(url=url, config=get_config())
+    article.download(input_html=html)
+    article.parse()
+    return dict(
+        title=article.title,
+        content=article.text,
+        created_time=article.publish_date,
+        url=article.url,
+        authors=article.authors,
+    )
+
+
+def extract_article_worker(url: str, html: str) -> tuple[dict[str, Any], int, float]:
+    """
+    Returns the fields of the webpage, the pid of the worker and the seconds
+    spent parsing.
+    """
+    start = time.perf_counter()
+    fields = extract_article(url=url, html=html)
+    return fields, os.getpid(), time.perf_counter() - start
@@ -1,5 +1,6 @@
 import abc
-from typing import Optional
+import asyncio
+from typing import AsyncIterator, ClassVar, Iterator, Optional
 
 from pydantic import BaseModel
 
@@ -14,8 +15,50 @@ class LLMOptions(BaseModel):
 
 
 class BaseLLM(abc.ABC, BaseModel):
+    platform: ClassVar[str] = "Unknown"
+
     @abc.abstractmethod
     def generate(
         self, prompt: str, model_name: str, options: Optional[LLMOptions]
     ) -> str:
         raise NotImplementedError
+
+    async def agenerate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        """
+        Coroutine version of `generate`. Implementations with an async client should
+        override this, the default runs `generate` in a worker thread.
+        """
+        return await asyncio.to_thread(
+            self.generate, prompt=prompt, model_name=model_name, options=options
+        )
+
+    def stream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        """
+        Yield the output in chunks as it is generated. Closing the iterator early
+        stops the generation. Implementations that can stream should override this,
+        the default yields the whole output of `generate` at once.
+        """
+        yield self.generate(prompt=prompt, model_name=model_name, options=options)
+
+    async def astream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        """
+        Async iterator version of `stream`.
+        """
+        yield await self.agenerate(
+            prompt=prompt, model_name=model_name, options=options
+        )
+
+    def discard(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> None:
+        """
+        Called when a response turned out to be unusable, so that it is not
+        served again. Only meaningful for caching wrappers.
+        """
+        return None
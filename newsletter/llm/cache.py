@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import json
+from typing import AsyncIterator, Iterator, Optional
+
+from pydantic import Field
+from typing_extensions import override
+
+from newsletter.cache import CacheEntry, DiskCache
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.metrics import report_usage
+from newsletter.logger import logger
+from newsletter.settings import settings
+
+
+def get_default_llm_cache() -> DiskCache:
+    return DiskCache(
+        folder=settings.storage.cache_folder / "llm",
+        ttl=settings.cache.llm_ttl,
+        max_entries=settings.cache.llm_max_entries,
+        max_size_bytes=settings.cache.llm_max_size_bytes,
+    )
+
+
+class CachedLLM(BaseLLM):
+    """
+    Wraps any `BaseLLM` and serves identical requests from a local on-disk cache.
+
+    A stream closed early by the caller is cached under its own key, read back
+    by streams only: `generate` never returns a partial output.
+    """
+
+    llm: BaseLLM
+    cache: DiskCache = Field(default_factory=get_default_llm_cache)
+
+    @property
+    def platform(self) -> str:
+        return self.llm.platform
+
+    def get_cache_key(
+        self,
+        prompt: str,
+        model_name: str,
+        options: Optional[LLMOptions] = None,
+        partial: bool = False,
+    ) -> str:
+        key = {
+            "platform": self.llm.platform,
+            "model": model_name,
+            "options": (
+                options.model_dump(exclude_none=True) if options is not None else {}
+            ),
+            "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        }
+        if partial:
+            key["partial"] = True
+        return json.dumps(key, sort_keys=True)
+
+    def _get_streamed(self, key: str, partial_key: str) -> Optional[CacheEntry]:
+        entry = self.cache.get(key)
+        return entry if entry is not None else self.cache.get(partial_key)
+
+    @override
+    def generate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        key = self.get_cache_key(prompt=prompt, model_name=model_name, options=options)
+        entry = self.cache.get(key)
+        if entry is not None:
+            logger.debug(f"LLM cache hit for {model_name}")
+            report_usage(cache_hit=True)
+            return entry.value
+
+        output = self.llm.generate(
+            prompt=prompt, model_name=model_name, options=options
+        )
+        if output is not None:
+            self.cache.set(key, output)
+        return output
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        key = self.get_cache_key(prompt=prompt, model_name=model_name, options=options)
+        # The cache reads and writes files, keep them off the event loop
+        entry = await asyncio.to_thread(self.cache.get, key)
+        if entry is not None:
+            logger.debug(f"LLM cache hit for {model_name}")
+            report_usage(cache_hit=True)
+            return entry.value
+
+        output = await self.llm.agenerate(
+            prompt=prompt, model_name=model_name, options=options
+        )
+        if output is not None:
+            await asyncio.to_thread(self.cache.set, key, output)
+        return output
+
+    @override
+    def stream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        key = self.get_cache_key(prompt=prompt, model_name=model_name, options=options)
+        partial_key = self.get_cache_key(
+            prompt=prompt, model_name=model_name, options=options, partial=True
+        )
+        entry = self._get_streamed(key, partial_key)
+        if entry is not None:
+            logger.debug(f"LLM cache hit for {model_name}")
+            report_usage(cache_hit=True)
+            yield entry.value
+            return
+
+        chunks = []
+        stream = self.llm.stream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+
+        except GeneratorExit:
+            # The caller stopped reading because it had what it needed. The
+            # partial output answers the next stream, not a full generation
+            if chunks:
+                self.cache.set(partial_key, "".join(chunks))
+            raise
+
+        finally:
+            stream.close()
+
+        self.cache.set(key, "".join(chunks))
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        key = self.get_cache_key(prompt=prompt, model_name=model_name, options=options)
+        partial_key = self.get_cache_key(
+            prompt=prompt, model_name=model_name, options=options, partial=True
+        )
+        entry = await asyncio.to_thread(self._get_streamed, key, partial_key)
+        if entry is not None:
+            logger.debug(f"LLM cache hit for {model_name}")
+            report_usage(cache_hit=True)
+            yield entry.value
+            return
+
+        chunks = []
+        stream = self.llm.astream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+
+        except GeneratorExit:
+            if chunks:
+                await asyncio.to_thread(self.cache.set, partial_key, "".join(chunks))
+            raise
+
+        finally:
+            await stream.aclose()
+
+        await asyncio.to_thread(self.cache.set, key, "".join(chunks))
+
+    @override
+    def discard(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> None:
+        for partial in (False, True):
+            self.cache.delete(
+                self.get_cache_key(
+                    prompt=prompt,
+                    model_name=model_name,
+                    options=options,
+                    partial=partial,
+                )
+            )
+        self.llm.discard(prompt=prompt, model_name=model_name, options=options)
+
+
+def wrap_with_cache(llm: BaseLLM) -> BaseLLM:
+    if settings.cache.llm_enabled:
+        return CachedLLM(llm=llm)
+    return llm
@@ -0,0 +1,101 @@
+"""
+Process-wide registry of the LLM SDK clients.
+
+Building an SDK client builds its connection pool, so every `TogetherLLM()`,
+`FireworksAI()` or `OpenAILLM()` used to start with cold TLS connections. Clients
+are now created once per platform and API key and shared by every LLM instance,
+Summarizer, Streamlit rerun and worker thread.
+
+Async clients hold connections bound to the event loop that created them, so they
+are kept per event loop instead. Run coroutines with `run_async` to close them
+when the loop finishes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import inspect
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Hashable, Optional, TypeVar
+
+import httpx
+from pydantic import BaseModel, PrivateAttr
+
+from newsletter.logger import logger
+from newsletter.settings import settings
+
+T = TypeVar("T")
+
+
+def get_client_key(
+    platform: str, api_key: str, base_url: Optional[str] = None
+) -> tuple[str, str, Optional[str]]:
+    # Avoid keeping the raw API key around as a dictionary key
+    return platform, hashlib.sha256(api_key.encode("utf-8")).hexdigest(), base_url
+
+
+def get_retry_options() -> dict[str, int]:
+    max_retries = settings.llm_client.max_retries
+    return {"max_retries": max_retries} if max_retries is not None else {}
+
+
+def get_pool_limits() -> httpx.Limits:
+    pool_size = settings.llm_client.pool_size
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+
+
+class ClientRegistry(BaseModel):
+    _clients: dict[Hashable, Any] = PrivateAttr(default_factory=dict)
+    _async_clients: weakref.WeakKeyDictionary = PrivateAttr(
+        default_factory=weakref.WeakKeyDictionary
+    )
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get(self, key: Hashable, factory: Callable[[], T]) -> T:
+        with self._lock:
+            if key not in self._clients:
+                logger.debug(f"Creating shared client for {key[0]}")
+                self._clients[key] = factory()
+            return self._clients[key]
+
+    def get_async(self, key: Hashable, factory: Callable[[], T]) -> T:
+        """
+        Client shared within the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            if key not in clients:
+                logger.debug(f"Creating shared async client for {key[0]}")
+                clients[key] = factory()
+            return clients[key]
+
+    async def aclose(self):
+        """
+        Close the async clients of the running event loop.
+        """
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            result = client.close()
+            if inspect.isawaitable(result):
+                await result
+
+
+client_registry = ClientRegistry()
+
+
+def run_async(coroutine: Awaitable[T]) -> T:
+    """
+    `asyncio.run`, closing the shared async clients before the loop is closed.
+    """
+
+    async def main() -> T:
+        try:
+            return await coroutine
+        finally:
+            await client_registry.aclose()
+
+    return asyncio.run(main())
@@ -0,0 +1,311 @@
+"""
+Adaptive concurrency for the LLM calls, per platform.
+
+`AIMDController` bounds the calls in flight with an additive-increase,
+multiplicative-decrease limit, like TCP congestion control:
+
+- every successful call adds `1 / limit`, so the limit grows by one per round
+  of calls while the platform keeps up;
+- a rate limit, an unavailable service or a latency rising above
+  `latency_tolerance` times its long-run average multiplies the limit by
+  `backoff`. Calls started before the last decrease do not decrease it again.
+
+Latencies are averaged per stage and model, since a filter answer and a summary
+do not take the same time. Streams closed early by the caller are left out.
+
+The limit stays between the floor and the ceiling of the platform, see
+`settings.concurrency`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Annotated, AsyncIterator, Iterator, Optional
+
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Doc, override
+
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.exception import LLMRateLimitError, LLMServiceUnavailableError
+from newsletter.llm.metrics import get_call_context, report_concurrency
+from newsletter.logger import logger
+from newsletter.settings import ConcurrencyLimit, settings
+
+SHORT_LATENCY_ALPHA = 0.3
+LONG_LATENCY_ALPHA = 0.02
+
+
+class _Waiter:
+    def __init__(self, future: Optional[asyncio.Future] = None):
+        self.future = future
+        self.event = threading.Event() if future is None else None
+        self.granted = False
+
+    def grant(self):
+        self.granted = True
+        if self.future is None:
+            self.event.set()
+        else:
+            loop = self.future.get_loop()
+            loop.call_soon_threadsafe(
+                lambda: self.future.done() or self.future.set_result(None)
+            )
+
+
+class AIMDController(BaseModel):
+    min_concurrency: Annotated[int, Doc("Floor of the limit.")] = 1
+    max_concurrency: Annotated[int, Doc("Ceiling of the limit.")] = 32
+    limit: Annotated[float, Doc("Current limit of calls in flight.")] = 4
+    backoff: Annotated[float, Doc("Factor applied to the limit on overload.")] = 0.5
+    latency_tolerance: Annotated[
+        float, Doc("Short-term over long-term latency ratio read as overload.")
+    ] = 2.0
+    in_flight: int = 0
+    decreases: int = 0
+    # Short-term and long-term latency averages, by stage and model
+    _latencies: dict[str, tuple[float, float]] = PrivateAttr(default_factory=dict)
+    _last_decrease: float = PrivateAttr(default=0.0)
+    _waiters: deque[_Waiter] = PrivateAttr(default_factory=deque)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def from_limit(cls, limit: ConcurrencyLimit) -> AIMDController:
+        return cls(
+            min_concurrency=limit.min_concurrency,
+            max_concurrency=limit.max_concurrency,
+            limit=min(
+                max(limit.initial_concurrency, limit.min_concurrency),
+                limit.max_concurrency,
+            ),
+            backoff=settings.concurrency.backoff,
+            latency_tolerance=settings.concurrency.latency_tolerance,
+        )
+
+    @property
+    def current(self) -> int:
+        return max(int(self.limit), self.min_concurrency)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < self.current
+
+    def _wake(self):
+        while self._waiters and self._has_capacity():
+            self.in_flight += 1
+            self._waiters.popleft().grant()
+
+    def acquire(self) -> float:
+        """
+        Wait for a slot. Returns the start time to hand back to `release`.
+        """
+        with self._lock:
+            if self._has_capacity() and not self._waiters:
+                self.in_flight += 1
+                return time.monotonic()
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        waiter.event.wait()
+        return time.monotonic()
+
+    async def aacquire(self) -> float:
+        with self._lock:
+            if self._has_capacity() and not self._waiters:
+                self.in_flight += 1
+                return time.monotonic()
+            waiter = _Waiter(future=asyncio.get_running_loop().create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    # The slot was handed over while being cancelled, give it back
+                    self.in_flight -= 1
+                    self._wake()
+                else:
+                    self._waiters.remove(waiter)
+            raise
+        return time.monotonic()
+
+    def release(
+        self,
+        start: float,
+        error: Optional[BaseException] = None,
+        latency_key: Optional[str] = None,
+    ):
+        """
+        Free the slot taken at `start` and adapt the limit to the outcome.
+        Errors other than overload say nothing about the load and are ignored.
+        The latency of a success is compared to the others of `latency_key`, and
+        not observed without one.
+        """
+        latency = time.monotonic() - start
+        with self._lock:
+            self.in_flight -= 1
+            if isinstance(error, (LLMRateLimitError, LLMServiceUnavailableError)):
+                self._decrease(start, reason=type(error).__name__)
+
+            elif error is None:
+                short, long = (
+                    self._observe_latency(latency_key, latency)
+                    if latency_key is not None
+                    else (0.0, 0.0)
+                )
+                if short > long * self.latency_tolerance:
+                    self._decrease(start, reason=f"{latency_key} latency {short:.2f}s")
+                else:
+                    self.limit = min(
+                        self.limit + 1 / self.current, self.max_concurrency
+                    )
+            self._wake()
+
+    def _observe_latency(self, key: str, latency: float) -> tuple[float, float]:
+        short, long = self._latencies.get(key, (latency, latency))
+        short += SHORT_LATENCY_ALPHA * (latency - short)
+        long += LONG_LATENCY_ALPHA * (latency - long)
+        self._latencies[key] = (short, long)
+        return short, long
+
+    def _decrease(self, start: float, reason: str):
+        # The calls in flight during the last decrease already saw the overload
+        if start < self._last_decrease or self.limit <= self.min_concurrency:
+            return
+        previous = self.current
+        self.limit = max(self.limit * self.backoff, self.min_concurrency)
+        self._last_decrease = time.monotonic()
+        self.decreases += 1
+        # The latency seen under overload is not the new normal
+        self._latencies = {
+            key: (long, long) for key, (_, long) in self._latencies.items()
+        }
+        logger.info(
+            f"Concurrency limit lowered from {previous} to {self.current} ({reason})"
+        )
+
+
+_controllers: dict[str, AIMDController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_concurrency_limit(platform: str) -> ConcurrencyLimit:
+    return settings.concurrency.overrides.get(platform, settings.concurrency.default)
+
+
+def get_concurrency_controller(platform: str) -> AIMDController:
+    """
+    Controller shared by every client of the given platform.
+    """
+    with _controllers_lock:
+        if platform not in _controllers:
+            _controllers[platform] = AIMDController.from_limit(
+                get_concurrency_limit(platform)
+            )
+        return _controllers[platform]
+
+
+class AdaptiveConcurrencyLLM(BaseLLM):
+    """
+    Wraps any `BaseLLM` and holds a slot of the platform's `AIMDController` for
+    the duration of every call.
+
+    Wrap it under the cache, so that cached answers do not wait for a slot.
+    """
+
+    llm: BaseLLM
+    controller: Optional[AIMDController] = None
+
+    def model_post_init(self, __context):
+        if self.controller is None:
+            self.controller = get_concurrency_controller(self.llm.platform)
+
+    @property
+    def platform(self) -> str:
+        return self.llm.platform
+
+    def _get_latency_key(self, model_name: str) -> str:
+        return f"{get_call_context().stage}/{model_name}"
+
+    @override
+    def generate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        start = self.controller.acquire()
+        report_concurrency(self.controller.current)
+        try:
+            output = self.llm.generate(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except Exception as e:
+            self.controller.release(start, e)
+            raise
+        self.controller.release(start, latency_key=self._get_latency_key(model_name))
+        return output
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        start = await self.controller.aacquire()
+        report_concurrency(self.controller.current)
+        try:
+            output = await self.llm.agenerate(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except (Exception, asyncio.CancelledError) as e:
+            self.controller.release(start, e)
+            raise
+        self.controller.release(start, latency_key=self._get_latency_key(model_name))
+        return output
+
+    @override
+    def stream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        start = self.controller.acquire()
+        report_concurrency(self.controller.current)
+        try:
+            yield from self.llm.stream(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except GeneratorExit:
+            # Closed early by the caller: a success, but its latency is partial
+            self.controller.release(start)
+            raise
+        except Exception as e:
+            self.controller.release(start, e)
+            raise
+        self.controller.release(start, latency_key=self._get_latency_key(model_name))
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        start = await self.controller.aacquire()
+        report_concurrency(self.controller.current)
+        stream = self.llm.astream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            async for chunk in stream:
+                yield chunk
+        except GeneratorExit:
+            self.controller.release(start)
+            raise
+        except (Exception, asyncio.CancelledError) as e:
+            self.controller.release(start, e)
+            raise
+        finally:
+            await stream.aclose()
+        self.controller.release(start, latency_key=self._get_latency_key(model_name))
+
+    @override
+    def discard(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> None:
+        self.llm.discard(prompt=prompt, model_name=model_name, options=options)
+
+
+def adapt_concurrency(llm: BaseLLM) -> BaseLLM:
+    if settings.concurrency.enabled:
+        return AdaptiveConcurrencyLLM(llm=llm)
+    return llm
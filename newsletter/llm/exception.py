@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 class LLMError(Exception):
     pass
 
@@ -7,8 +10,14 @@ class LLMAuthenticationError(LLMError):
 
 
 class LLMRateLimitError(LLMError):
-    pass
+    def __init__(self, *args, retry_after: Optional[float] = None):
+        super().__init__(*args)
+        # Seconds the provider asked to wait before retrying, if it said
+        self.retry_after = retry_after
 
 
 class LLMServiceUnavailableError(LLMError):
-    pass
+    def __init__(self, *args, model_names: Optional[list[str]] = None):
+        super().__init__(*args)
+        # Models that were unavailable, when the call tried several of them
+        self.model_names = model_names
@@ -1,11 +1,41 @@
-from typing import Literal, Optional, Self, TypeAlias, get_args
+from typing import (
+    AsyncIterator,
+    ClassVar,
+    Iterator,
+    Literal,
+    Optional,
+    Self,
+    TypeAlias,
+    get_args,
+)
 
-from fireworks.client import Fireworks
+from fireworks import (
+    AsyncFireworks,
+    AuthenticationError,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    Fireworks,
+    InternalServerError,
+    RateLimitError,
+)
 from pydantic import Field, PrivateAttr, SecretStr, model_validator
 from typing_extensions import override
 
 from newsletter.llm.base import BaseLLM, LLMOptions
-from newsletter.settings import settings
+from newsletter.llm.clients import (
+    client_registry,
+    get_client_key,
+    get_pool_limits,
+    get_retry_options,
+)
+from newsletter.llm.exception import (
+    LLMAuthenticationError,
+    LLMRateLimitError,
+    LLMServiceUnavailableError,
+)
+from newsletter.llm.metrics import report_response_usage
+from newsletter.llm.rate_limit import estimate_request_tokens, get_rate_limiter
+from newsletter.settings import LLMPlatform, settings
 
 Model: TypeAlias = Literal[
     "accounts/fireworks/models/llama-v3p1-405b-instruct",
@@ -23,21 +53,55 @@ MODEL_ALIAS: dict[Model, str] = {
     "accounts/fireworks/models/mixtral-8x7b-instruct": "Mixtral-8x7B",
 }
 
+# The SDK does not expose `stream_options`, the API is OpenAI-compatible and
+# only sends the usage on the final chunk when asked to.
+STREAM_OPTIONS = {"stream_options": {"include_usage": True}}
+
 
 def get_model_list():
     return get_args(Model)
 
+
 def model_format_func(opt: str):
     return MODEL_ALIAS[opt]
-    
+
 
 class FireworksAI(BaseLLM):
+    platform: ClassVar[LLMPlatform] = "Fireworks AI"
     api_key: SecretStr = Field(default=settings.fireworks_api_key)
+    base_url: Optional[str] = Field(
+        default_factory=lambda: settings.llm_client.base_urls.get("Fireworks AI")
+    )
     _client: Fireworks = PrivateAttr()
 
     @model_validator(mode="after")
     def init_client(self) -> Self:
-        self._client = Fireworks(api_key=self.api_key.get_secret_value())
+        self._client = client_registry.get(
+            get_client_key(
+                self.platform, self.api_key.get_secret_value(), self.base_url
+            ),
+            lambda: Fireworks(
+                api_key=self.api_key.get_secret_value(),
+                base_url=self.base_url,
+                **get_retry_options(),
+                http_client=DefaultHttpxClient(limits=get_pool_limits()),
+            ),
+        )
+        return self
+
+    @property
+    def _async_client(self) -> AsyncFireworks:
+        return client_registry.get_async(
+            get_client_key(
+                self.platform, self.api_key.get_secret_value(), self.base_url
+            ),
+            lambda: AsyncFireworks(
+                api_key=self.api_key.get_secret_value(),
+                base_url=self.base_url,
+                **get_retry_options(),
+                http_client=DefaultAsyncHttpxClient(limits=get_pool_limits()),
+            ),
+        )
 
     @override
     def generate(
@@ -51,15 +115,185 @@ class FireworksAI(BaseLLM):
         else:
             kwargs = {}
 
-        response = self._client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            **kwargs,
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        rate_limiter.acquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            raw_response = self._client.chat.completions.with_raw_response.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                **kwargs,
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = raw_response.parse()
+
+        report_response_usage(response.usage)
+        return response.choices[0].message.content
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> str:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+
+        else:
+            kwargs = {}
+
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        await rate_limiter.aacquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
         )
+        try:
+            raw_response = (
+                await self._async_client.chat.completions.with_raw_response.create(
+                    model=model_name,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    **kwargs,
+                )
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
 
+        rate_limiter.observe_headers(raw_response.headers)
+        response = await raw_response.parse()
+
+        report_response_usage(response.usage)
         return response.choices[0].message.content
+
+    @override
+    def stream(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+
+        else:
+            kwargs = {}
+
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        rate_limiter.acquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            raw_response = self._client.chat.completions.with_raw_response.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                stream=True,
+                extra_body=STREAM_OPTIONS,
+                **kwargs,
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = raw_response.parse()
+        try:
+            for chunk in response:
+                report_response_usage(getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        finally:
+            # Closing the connection makes the server stop generating
+            response.close()
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+
+        else:
+            kwargs = {}
+
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        await rate_limiter.aacquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            raw_response = (
+                await self._async_client.chat.completions.with_raw_response.create(
+                    model=model_name,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    stream=True,
+                    extra_body=STREAM_OPTIONS,
+                    **kwargs,
+                )
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = await raw_response.parse()
+        try:
+            async for chunk in response:
+                report_response_usage(getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        finally:
+            await response.close()
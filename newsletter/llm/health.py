@@ -0,0 +1,300 @@
+"""
+Shared health registry for the LLM models.
+
+Every call made through `HealthTrackedLLM` is recorded per model, in a
+rolling window of outcomes and latencies. Each model has a circuit breaker:
+
+- closed: the model is healthy and used normally.
+- open: too many recent calls failed (or were too slow). The model is skipped
+  until `cooldown` seconds have passed.
+- half-open: after the cooldown, a single probe call is let through. Success
+  closes the circuit again, failure opens it for another cooldown. The probe is
+  taken when `order` puts the model first, and is given back after `cooldown`
+  if its outcome is never recorded, e.g. when it was answered from a cache.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Annotated, AsyncIterator, Iterator, Literal, Optional
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing_extensions import Doc, override
+
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.exception import LLMRateLimitError
+from newsletter.logger import logger
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class ModelHealth(BaseModel):
+    model_name: str
+    state: CircuitState = "closed"
+    opened_at: Optional[float] = None
+    probe_started_at: Optional[float] = None
+    _outcomes: deque[tuple[bool, float]] = PrivateAttr(default_factory=deque)
+
+    @property
+    def calls(self) -> int:
+        return len(self._outcomes)
+
+    @property
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(not ok for ok, _ in self._outcomes) / len(self._outcomes)
+
+    @property
+    def mean_latency(self) -> Optional[float]:
+        if not self._outcomes:
+            return None
+        return sum(latency for _, latency in self._outcomes) / len(self._outcomes)
+
+
+class HealthRegistry(BaseModel):
+    window: Annotated[int, Doc("Number of recent calls kept per model.")] = 20
+    min_calls: Annotated[
+        int, Doc("Calls needed in the window before the circuit can open.")
+    ] = 5
+    error_rate_threshold: Annotated[
+        float, Doc("Error rate in the window at which the circuit opens.")
+    ] = 0.5
+    slow_call_seconds: Annotated[
+        Optional[float], Doc("Successful calls slower than this count as failures.")
+    ] = None
+    cooldown: Annotated[
+        float, Doc("Seconds an open circuit waits before letting a probe through.")
+    ] = 30.0
+    _models: dict[str, ModelHealth] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _get(self, model_name: str) -> ModelHealth:
+        if model_name not in self._models:
+            health = ModelHealth(model_name=model_name)
+            health._outcomes = deque(maxlen=self.window)
+            self._models[model_name] = health
+        return self._models[model_name]
+
+    def _refresh(self, health: ModelHealth):
+        if (
+            health.state == "open"
+            and time.monotonic() - health.opened_at >= self.cooldown
+        ):
+            logger.info(f"Circuit for {health.model_name} is half-open, probing")
+            health.state = "half_open"
+            health.probe_started_at = None
+
+    def _has_free_probe(self, health: ModelHealth) -> bool:
+        return (
+            health.probe_started_at is None
+            or time.monotonic() - health.probe_started_at >= self.cooldown
+        )
+
+    def _open(self, health: ModelHealth):
+        logger.warning(
+            f"Circuit for {health.model_name} opened "
+            f"(error rate {health.error_rate:.0%} over {health.calls} calls)"
+        )
+        health.state = "open"
+        health.opened_at = time.monotonic()
+
+    def get_state(self, model_name: str) -> CircuitState:
+        with self._lock:
+            health = self._get(model_name)
+            self._refresh(health)
+            return health.state
+
+    def is_available(self, model_name: str) -> bool:
+        with self._lock:
+            health = self._get(model_name)
+            self._refresh(health)
+            if health.state == "half_open":
+                return self._has_free_probe(health)
+            return health.state == "closed"
+
+    def try_acquire_probe(self, model_name: str) -> bool:
+        """
+        Whether a call can be sent to the model. For a half-open circuit, the
+        check and the taking of its single probe are done under one lock, so
+        that concurrent callers cannot both probe.
+        """
+        with self._lock:
+            health = self._get(model_name)
+            self._refresh(health)
+            if health.state == "half_open":
+                if not self._has_free_probe(health):
+                    return False
+                health.probe_started_at = time.monotonic()
+                return True
+            return health.state == "closed"
+
+    def order(self, model_names: list[str]) -> list[str]:
+        """
+        Available models first, keeping the preferred order. The first one is
+        acquired, see `try_acquire_probe`. Unavailable models are kept at the
+        end, so there is still something to call during an outage.
+        """
+        for idx, model_name in enumerate(model_names):
+            if self.try_acquire_probe(model_name):
+                others = model_names[:idx] + model_names[idx + 1 :]
+                available = [name for name in others if self.is_available(name)]
+                return (
+                    [model_name]
+                    + available
+                    + [name for name in others if name not in available]
+                )
+        return list(model_names)
+
+    def record_cancel(self, model_name: str):
+        """A cancelled call does not tell anything, give the probe back."""
+        with self._lock:
+            health = self._get(model_name)
+            if health.state == "half_open":
+                health.probe_started_at = None
+
+    def record(self, model_name: str, ok: bool, latency: float):
+        if ok and self.slow_call_seconds is not None:
+            ok = latency <= self.slow_call_seconds
+
+        with self._lock:
+            health = self._get(model_name)
+            health._outcomes.append((ok, latency))
+
+            if health.state == "half_open":
+                if ok:
+                    logger.info(f"Circuit for {model_name} closed")
+                    health.state = "closed"
+                    health._outcomes.clear()
+                else:
+                    self._open(health)
+
+            elif (
+                health.state == "closed"
+                and health.calls >= self.min_calls
+                and health.error_rate >= self.error_rate_threshold
+            ):
+                self._open(health)
+
+    def snapshot(self) -> dict[str, ModelHealth]:
+        with self._lock:
+            for health in self._models.values():
+                self._refresh(health)
+            return {
+                name: health.model_copy(deep=True)
+                for name, health in self._models.items()
+            }
+
+
+health_registry = HealthRegistry()
+
+
+class HealthTrackedLLM(BaseLLM):
+    """
+    Wraps any `BaseLLM` and reports the outcome of every call to a `HealthRegistry`.
+
+    Wrap the provider itself, under any cache, so that cached answers are not
+    mistaken for healthy calls.
+    """
+
+    llm: BaseLLM
+    registry: HealthRegistry = Field(default_factory=lambda: health_registry)
+
+    @property
+    def platform(self) -> str:
+        return self.llm.platform
+
+    def _record(self, model_name: str, start: float, error: Optional[Exception]):
+        # Rate limits are handled by the rate limiter, they say nothing about health
+        if isinstance(error, LLMRateLimitError):
+            self.registry.record_cancel(model_name)
+            return
+        self.registry.record(
+            model_name, ok=error is None, latency=time.perf_counter() - start
+        )
+
+    @override
+    def generate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        start = time.perf_counter()
+        try:
+            output = self.llm.generate(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except Exception as e:
+            self._record(model_name, start, e)
+            raise
+        self._record(model_name, start, None)
+        return output
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        start = time.perf_counter()
+        try:
+            output = await self.llm.agenerate(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except asyncio.CancelledError:
+            self.registry.record_cancel(model_name)
+            raise
+        except Exception as e:
+            self._record(model_name, start, e)
+            raise
+        self._record(model_name, start, None)
+        return output
+
+    @override
+    def stream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        start = time.perf_counter()
+        try:
+            yield from self.llm.stream(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except GeneratorExit:
+            # Closed early by the caller, the model was answering fine
+            self._record(model_name, start, None)
+            raise
+        except Exception as e:
+            self._record(model_name, start, e)
+            raise
+        self._record(model_name, start, None)
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        stream = self.llm.astream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            async for chunk in stream:
+                yield chunk
+        except GeneratorExit:
+            self._record(model_name, start, None)
+            raise
+        except asyncio.CancelledError:
+            self.registry.record_cancel(model_name)
+            raise
+        except Exception as e:
+            self._record(model_name, start, e)
+            raise
+        finally:
+            await stream.aclose()
+        self._record(model_name, start, None)
+
+    @override
+    def discard(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> None:
+        self.llm.discard(prompt=prompt, model_name=model_name, options=options)
+
+
+def track_health(llm: BaseLLM) -> BaseLLM:
+    return HealthTrackedLLM(llm=llm)
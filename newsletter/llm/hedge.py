@@ -0,0 +1,278 @@
+"""
+Hedged requests across an ordered list of models.
+
+The prompt is first sent to the primary model. If it has not answered within a
+percentile of its observed latency, the same prompt also goes to the next model
+in the list. The first usable answer wins and the other requests are cancelled:
+the blocking version streams the answers, so that a losing request is closed at
+its next chunk instead of running to completion in the background.
+
+When every model failed, the error raised says which models were unavailable.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    CancelledError,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Annotated, Callable, NoReturn, Optional
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.exception import LLMServiceUnavailableError
+from newsletter.logger import logger
+
+
+class LatencyTracker(BaseModel):
+    window: Annotated[int, Doc("Number of recent latencies kept per model.")] = 100
+    min_samples: Annotated[
+        int, Doc("Samples needed before a percentile is reported.")
+    ] = 5
+    _samples: dict[str, deque[float]] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def record(self, model_name: str, latency: float):
+        with self._lock:
+            if model_name not in self._samples:
+                self._samples[model_name] = deque(maxlen=self.window)
+            self._samples[model_name].append(latency)
+
+    def percentile(self, model_name: str, percentile: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(model_name, ()))
+        if len(samples) < self.min_samples:
+            return None
+        idx = min(math.ceil(percentile / 100 * len(samples)) - 1, len(samples) - 1)
+        return samples[max(idx, 0)]
+
+
+latency_tracker = LatencyTracker()
+
+
+class HedgeOptions(BaseModel):
+    percentile: Annotated[
+        float, Doc("Latency percentile of a model after which the next one is tried.")
+    ] = 95.0
+    default_delay: Annotated[
+        float, Doc("Seconds to wait for a model with too few latency samples.")
+    ] = 10.0
+    tracker: LatencyTracker = Field(default_factory=lambda: latency_tracker)
+
+    def get_delay(self, model_name: str) -> float:
+        delay = self.tracker.percentile(model_name, self.percentile)
+        return self.default_delay if delay is None else delay
+
+
+def _timed_generate(
+    llm: BaseLLM,
+    prompt: str,
+    model_name: str,
+    options: Optional[LLMOptions],
+    tracker: LatencyTracker,
+    cancelled: threading.Event,
+) -> str:
+    start = time.perf_counter()
+    chunks = []
+    stream = llm.stream(prompt=prompt, model_name=model_name, options=options)
+    try:
+        for chunk in stream:
+            if cancelled.is_set():
+                # Closing the stream stops the generation and frees its slot
+                raise CancelledError()
+            chunks.append(chunk)
+    finally:
+        stream.close()
+    tracker.record(model_name, time.perf_counter() - start)
+    return "".join(chunks)
+
+
+async def _atimed_generate(
+    llm: BaseLLM,
+    prompt: str,
+    model_name: str,
+    options: Optional[LLMOptions],
+    tracker: LatencyTracker,
+) -> str:
+    start = time.perf_counter()
+    output = await llm.agenerate(prompt=prompt, model_name=model_name, options=options)
+    tracker.record(model_name, time.perf_counter() - start)
+    return output
+
+
+def _raise_failure(last_error: Exception, unavailable: list[str]) -> NoReturn:
+    if isinstance(last_error, LLMServiceUnavailableError) and unavailable:
+        raise LLMServiceUnavailableError(
+            last_error, model_names=unavailable
+        ) from last_error
+    raise last_error
+
+
+def hedged_generate(
+    llm: BaseLLM,
+    prompt: str,
+    model_names: list[str],
+    is_valid: Callable[[str], bool],
+    options: Optional[LLMOptions] = None,
+    hedge: Optional[HedgeOptions] = None,
+) -> tuple[str, str]:
+    """
+    Returns the model name and output of the first valid answer. If no answer is
+    valid, the last output is returned. If every model failed, the last exception
+    is raised, as an `LLMServiceUnavailableError` naming the unavailable models
+    if there were any.
+    """
+    hedge = hedge or HedgeOptions()
+    executor = ThreadPoolExecutor(max_workers=len(model_names))
+    cancelled = threading.Event()
+    pending: dict[Future, str] = {}
+    next_index = 0
+    last_output: Optional[tuple[str, str]] = None
+    last_error: Optional[Exception] = None
+    unavailable: list[str] = []
+
+    def launch():
+        nonlocal next_index
+        model_name = model_names[next_index]
+        next_index += 1
+        # Copy the context so that the call is attributed like the caller's
+        future = executor.submit(
+            contextvars.copy_context().run,
+            _timed_generate,
+            llm,
+            prompt,
+            model_name,
+            options,
+            hedge.tracker,
+            cancelled,
+        )
+        pending[future] = model_name
+
+    try:
+        launch()
+        while pending:
+            timeout = None
+            if next_index < len(model_names):
+                timeout = hedge.get_delay(model_names[next_index - 1])
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                logger.debug(
+                    f"{model_names[next_index - 1]} slower than {timeout:.2f}s, "
+                    f"hedging with {model_names[next_index]}"
+                )
+                launch()
+                continue
+
+            for future in done:
+                model_name = pending.pop(future)
+                try:
+                    output = future.result()
+                except Exception as e:
+                    last_error = e
+                    if isinstance(e, LLMServiceUnavailableError):
+                        unavailable.append(model_name)
+                    logger.info(f"Hedged request to {model_name} failed: {e}")
+                else:
+                    if is_valid(output):
+                        return model_name, output
+                    llm.discard(prompt=prompt, model_name=model_name, options=options)
+                    last_output = (model_name, output)
+
+                # The failed model is out, don't wait for the delay to try another
+                if not pending and next_index < len(model_names):
+                    launch()
+
+    finally:
+        # Running requests stop at their next chunk, their result is ignored
+        cancelled.set()
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if last_output is not None:
+        return last_output
+    _raise_failure(last_error, unavailable)
+
+
+async def ahedged_generate(
+    llm: BaseLLM,
+    prompt: str,
+    model_names: list[str],
+    is_valid: Callable[[str], bool],
+    options: Optional[LLMOptions] = None,
+    hedge: Optional[HedgeOptions] = None,
+) -> tuple[str, str]:
+    """
+    Coroutine version of `hedged_generate`. Losing requests are cancelled.
+    """
+    hedge = hedge or HedgeOptions()
+    pending: dict[asyncio.Task, str] = {}
+    next_index = 0
+    last_output: Optional[tuple[str, str]] = None
+    last_error: Optional[Exception] = None
+    unavailable: list[str] = []
+
+    def launch():
+        nonlocal next_index
+        model_name = model_names[next_index]
+        next_index += 1
+        task = asyncio.create_task(
+            _atimed_generate(llm, prompt, model_name, options, hedge.tracker)
+        )
+        pending[task] = model_name
+
+    try:
+        launch()
+        while pending:
+            timeout = None
+            if next_index < len(model_names):
+                timeout = hedge.get_delay(model_names[next_index - 1])
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if not done:
+                logger.debug(
+                    f"{model_names[next_index - 1]} slower than {timeout:.2f}s, "
+                    f"hedging with {model_names[next_index]}"
+                )
+                launch()
+                continue
+
+            for task in done:
+                model_name = pending.pop(task)
+                try:
+                    output = task.result()
+                except Exception as e:
+                    last_error = e
+                    if isinstance(e, LLMServiceUnavailableError):
+                        unavailable.append(model_name)
+                    logger.info(f"Hedged request to {model_name} failed: {e}")
+                else:
+                    if is_valid(output):
+                        return model_name, output
+                    llm.discard(prompt=prompt, model_name=model_name, options=options)
+                    last_output = (model_name, output)
+
+                if not pending and next_index < len(model_names):
+                    launch()
+
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if last_output is not None:
+        return last_output
+    _raise_failure(last_error, unavailable)
@@ -0,0 +1,521 @@
+"""
+Per-call LLM metrics.
+
+Every call made through `MetricsLLM` is recorded with its model, pipeline stage,
+latency, prompt and completion tokens, retry number and estimated cost.
+
+- The providers report the token usage of their responses with `report_usage`.
+  When a response carries no usage (e.g. a stream closed early), the tokens are
+  estimated locally. Prompt tokens served from the provider's prefix cache are
+  reported apart, and priced at the cached input rate when there is one.
+- `AdaptiveConcurrencyLLM` reports the concurrency limit the call ran under
+  with `report_concurrency`.
+- The stage, retry number and sink come from `llm_call_context`, set by the
+  caller around its LLM calls. Calls outside of a context go to `metrics_sink`.
+
+Wrap the cache with `MetricsLLM`, so that cache hits are recorded as free calls.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Annotated, AsyncIterator, Iterator, Optional
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing_extensions import Doc, override
+
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.tokens import estimate_tokens
+from newsletter.settings import ModelPricing, settings
+
+# List prices in USD, refine them with `settings.metrics.pricing`
+DEFAULT_PRICING: dict[str, ModelPricing] = {
+    "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": ModelPricing(
+        input_per_million=0.18, output_per_million=0.18
+    ),
+    "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": ModelPricing(
+        input_per_million=0.88, output_per_million=0.88
+    ),
+    "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo": ModelPricing(
+        input_per_million=3.5, output_per_million=3.5
+    ),
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": ModelPricing(
+        input_per_million=0.6, output_per_million=0.6
+    ),
+    "mistralai/Mixtral-8x22B-Instruct-v0.1": ModelPricing(
+        input_per_million=1.2, output_per_million=1.2
+    ),
+    "accounts/fireworks/models/llama-v3p1-405b-instruct": ModelPricing(
+        input_per_million=3.0, output_per_million=3.0
+    ),
+    "accounts/fireworks/models/llama-v3p1-70b-instruct": ModelPricing(
+        input_per_million=0.9, output_per_million=0.9
+    ),
+    "accounts/fireworks/models/llama-v3p1-8b-instruct": ModelPricing(
+        input_per_million=0.2, output_per_million=0.2
+    ),
+    "accounts/fireworks/models/mixtral-8x22b-instruct": ModelPricing(
+        input_per_million=1.2, output_per_million=1.2
+    ),
+    "accounts/fireworks/models/mixtral-8x7b-instruct": ModelPricing(
+        input_per_million=0.5, output_per_million=0.5
+    ),
+    "gpt-4-turbo": ModelPricing(input_per_million=10.0, output_per_million=30.0),
+    "gpt-4o": ModelPricing(
+        input_per_million=2.5, output_per_million=10.0, cached_input_per_million=1.25
+    ),
+    "gpt-4o-mini": ModelPricing(
+        input_per_million=0.15, output_per_million=0.6, cached_input_per_million=0.075
+    ),
+}
+
+
+def get_pricing(platform: str, model_name: str) -> Optional[ModelPricing]:
+    overrides = settings.metrics.pricing
+    return overrides.get(
+        f"{platform}/{model_name}",
+        overrides.get(model_name, DEFAULT_PRICING.get(model_name)),
+    )
+
+
+def get_cost(
+    pricing: ModelPricing,
+    prompt_tokens: int,
+    completion_tokens: int,
+    cached_prompt_tokens: int = 0,
+) -> float:
+    cached_rate = (
+        pricing.cached_input_per_million
+        if pricing.cached_input_per_million is not None
+        else pricing.input_per_million
+    )
+    return (
+        (prompt_tokens - cached_prompt_tokens) * pricing.input_per_million
+        + cached_prompt_tokens * cached_rate
+        + completion_tokens * pricing.output_per_million
+    ) / 1_000_000
+
+
+class LLMUsage(BaseModel):
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_prompt_tokens: Optional[int] = None
+    cache_hit: bool = False
+    concurrency_limit: Optional[int] = None
+
+
+_current_usage: contextvars.ContextVar[Optional[LLMUsage]] = contextvars.ContextVar(
+    "llm_usage", default=None
+)
+
+
+def report_usage(
+    prompt_tokens: Optional[int] = None,
+    completion_tokens: Optional[int] = None,
+    cached_prompt_tokens: Optional[int] = None,
+    cache_hit: bool = False,
+):
+    """
+    Report the usage of the response being generated to the enclosing `MetricsLLM`.
+    Does nothing outside of one.
+    """
+    usage = _current_usage.get()
+    if usage is None:
+        return
+    if prompt_tokens is not None:
+        usage.prompt_tokens = prompt_tokens
+    if completion_tokens is not None:
+        usage.completion_tokens = completion_tokens
+    if cached_prompt_tokens is not None:
+        usage.cached_prompt_tokens = cached_prompt_tokens
+    usage.cache_hit = usage.cache_hit or cache_hit
+
+
+def report_concurrency(limit: int):
+    """
+    Report the concurrency limit the call runs under to the enclosing `MetricsLLM`.
+    """
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.concurrency_limit = limit
+
+
+def report_response_usage(usage: Optional[object]):
+    """
+    Report the `usage` of an SDK response or stream chunk, if it has one.
+    """
+    if usage is None:
+        return
+    # OpenAI-compatible APIs report the prefix cache in `prompt_tokens_details`
+    details = getattr(usage, "prompt_tokens_details", None)
+    report_usage(
+        prompt_tokens=getattr(usage, "prompt_tokens", None),
+        completion_tokens=getattr(usage, "completion_tokens", None),
+        cached_prompt_tokens=getattr(details, "cached_tokens", None),
+    )
+
+
+class LLMCallMetrics(BaseModel):
+    platform: str
+    model_name: str
+    stage: str
+    retries: Annotated[int, Doc("Earlier attempts of the same request.")] = 0
+    started_at: datetime.datetime
+    latency: float
+    prompt_tokens: int
+    completion_tokens: int
+    cached_prompt_tokens: Annotated[
+        int, Doc("Prompt tokens served from the provider's prefix cache.")
+    ] = 0
+    estimated_usage: Annotated[
+        bool, Doc("The provider did not report the usage, it was estimated.")
+    ] = False
+    cache_hit: bool = False
+    cost: Annotated[Optional[float], Doc("Estimated USD, None if unpriced.")] = None
+    concurrency_limit: Annotated[
+        Optional[int], Doc("Calls allowed in flight on the platform at the start.")
+    ] = None
+    error: Optional[str] = None
+
+
+class MetricsAggregate(BaseModel):
+    calls: int = 0
+    errors: int = 0
+    retries: Annotated[int, Doc("Calls that were a retry of an earlier attempt.")] = 0
+    cache_hits: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    prefix_cache_hits: Annotated[
+        int, Doc("Calls billed some prompt tokens from the prefix cache.")
+    ] = 0
+    cost: float = 0.0
+    unpriced_calls: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+    min_concurrency: Optional[int] = None
+    max_concurrency: Optional[int] = None
+
+    @property
+    def mean_latency(self) -> Optional[float]:
+        return self.total_latency / self.calls if self.calls else None
+
+    def add(self, call: LLMCallMetrics):
+        self.calls += 1
+        self.errors += call.error is not None
+        self.retries += call.retries > 0
+        self.cache_hits += call.cache_hit
+        self.prompt_tokens += call.prompt_tokens
+        self.completion_tokens += call.completion_tokens
+        self.cached_prompt_tokens += call.cached_prompt_tokens
+        self.prefix_cache_hits += call.cached_prompt_tokens > 0
+        if call.cost is None:
+            self.unpriced_calls += 1
+        else:
+            self.cost += call.cost
+        self.total_latency += call.latency
+        self.max_latency = max(self.max_latency, call.latency)
+        if call.concurrency_limit is not None:
+            self.min_concurrency = min(
+                self.min_concurrency or call.concurrency_limit, call.concurrency_limit
+            )
+            self.max_concurrency = max(
+                self.max_concurrency or 0, call.concurrency_limit
+            )
+
+
+class RunMetrics(BaseModel):
+    total: MetricsAggregate = MetricsAggregate()
+    by_stage: dict[str, MetricsAggregate] = {}
+    by_model: dict[str, MetricsAggregate] = {}
+
+    @classmethod
+    def from_calls(cls, calls: list[LLMCallMetrics]) -> RunMetrics:
+        metrics = cls()
+        for call in calls:
+            metrics.total.add(call)
+            metrics.by_stage.setdefault(call.stage, MetricsAggregate()).add(call)
+            metrics.by_model.setdefault(call.model_name, MetricsAggregate()).add(call)
+        return metrics
+
+    def report(self) -> str:
+        lines = [
+            f"{self.total.calls} LLM calls ({self.total.errors} failed, "
+            f"{self.total.cache_hits} cached), {self.total.prompt_tokens} prompt "
+            f"({self.total.cached_prompt_tokens} from the prefix cache) "
+            f"and {self.total.completion_tokens} completion tokens, "
+            f"${self.total.cost:.4f}"
+        ]
+        for stage, aggregate in self.by_stage.items():
+            lines.append(
+                f"  {stage}: {aggregate.calls} calls, {aggregate.retries} retries, "
+                f"mean latency {aggregate.mean_latency or 0:.2f}s, "
+                f"prefix cache hit on {aggregate.prefix_cache_hits}, "
+                f"${aggregate.cost:.4f}"
+                + (
+                    f", concurrency {aggregate.min_concurrency}-"
+                    f"{aggregate.max_concurrency}"
+                    if aggregate.max_concurrency is not None
+                    else ""
+                )
+            )
+        return "\n".join(lines)
+
+
+class MetricsSink(BaseModel):
+    """
+    Collects the call metrics of a run.
+    """
+
+    _calls: list[LLMCallMetrics] = PrivateAttr(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def record(self, call: LLMCallMetrics):
+        with self._lock:
+            self._calls.append(call)
+
+    def get_calls(self, since: int = 0) -> list[LLMCallMetrics]:
+        """
+        Calls recorded after the first `since`, e.g. `since=len(sink)` taken at the
+        start of a run.
+        """
+        with self._lock:
+            return self._calls[since:]
+
+    def summary(self, since: int = 0) -> RunMetrics:
+        return RunMetrics.from_calls(self.get_calls(since=since))
+
+    def export_jsonl(self, path: Path, since: int = 0):
+        with path.open("w", encoding="utf-8") as f:
+            for call in self.get_calls(since=since):
+                f.write(call.model_dump_json() + "\n")
+
+
+metrics_sink = MetricsSink()
+
+
+class LLMCallContext(BaseModel):
+    stage: str = "unknown"
+    retries: int = 0
+    sink: MetricsSink = Field(default_factory=lambda: metrics_sink)
+
+
+_current_context: contextvars.ContextVar[LLMCallContext] = contextvars.ContextVar(
+    "llm_call_context", default=LLMCallContext()
+)
+
+
+@contextmanager
+def llm_call_context(
+    stage: str, retries: int = 0, sink: Optional[MetricsSink] = None
+) -> Iterator[LLMCallContext]:
+    """
+    Attribute the LLM calls made inside to `stage`, recorded into `sink`.
+    Worker threads do not inherit it, submit them with `contextvars.copy_context`.
+    """
+    context = LLMCallContext(stage=stage, retries=retries)
+    if sink is not None:
+        context.sink = sink
+    token = _current_context.set(context)
+    try:
+        yield context
+    finally:
+        _current_context.reset(token)
+
+
+def get_call_context() -> LLMCallContext:
+    """
+    Context of the LLM call being made, see `llm_call_context`.
+    """
+    return _current_context.get()
+
+
+class MetricsLLM(BaseLLM):
+    """
+    Wraps any `BaseLLM` and records every call into the `MetricsSink` of the
+    current `llm_call_context`.
+    """
+
+    llm: BaseLLM
+
+    @property
+    def platform(self) -> str:
+        return self.llm.platform
+
+    def _start(self) -> tuple[LLMUsage, contextvars.Token, datetime.datetime, float]:
+        usage = LLMUsage()
+        return (
+            usage,
+            _current_usage.set(usage),
+            datetime.datetime.now(),
+            time.perf_counter(),
+        )
+
+    def _record(
+        self,
+        prompt: str,
+        model_name: str,
+        output: str,
+        usage: LLMUsage,
+        started_at: datetime.datetime,
+        start: float,
+        error: Optional[BaseException],
+    ):
+        context = _current_context.get()
+        estimated = usage.prompt_tokens is None or usage.completion_tokens is None
+        cached_prompt_tokens = 0
+        if usage.cache_hit:
+            prompt_tokens, completion_tokens, cost = 0, 0, 0.0
+        else:
+            prompt_tokens = (
+                usage.prompt_tokens
+                if usage.prompt_tokens is not None
+                else estimate_tokens(prompt)
+            )
+            completion_tokens = (
+                usage.completion_tokens
+                if usage.completion_tokens is not None
+                else estimate_tokens(output)
+            )
+            cached_prompt_tokens = min(usage.cached_prompt_tokens or 0, prompt_tokens)
+            pricing = get_pricing(platform=self.platform, model_name=model_name)
+            cost = (
+                get_cost(
+                    pricing,
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    cached_prompt_tokens=cached_prompt_tokens,
+                )
+                if pricing is not None
+                else None
+            )
+
+        context.sink.record(
+            LLMCallMetrics(
+                platform=self.platform,
+                model_name=model_name,
+                stage=context.stage,
+                retries=context.retries,
+                started_at=started_at,
+                latency=time.perf_counter() - start,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cached_prompt_tokens=cached_prompt_tokens,
+                estimated_usage=estimated and not usage.cache_hit,
+                cache_hit=usage.cache_hit,
+                cost=cost,
+                concurrency_limit=usage.concurrency_limit,
+                error=None if error is None else type(error).__name__,
+            )
+        )
+
+    @override
+    def generate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        usage, token, started_at, start = self._start()
+        try:
+            output = self.llm.generate(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except Exception as e:
+            self._record(prompt, model_name, "", usage, started_at, start, e)
+            raise
+        finally:
+            _current_usage.reset(token)
+        self._record(prompt, model_name, output or "", usage, started_at, start, None)
+        return output
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> str:
+        usage, token, started_at, start = self._start()
+        try:
+            output = await self.llm.agenerate(
+                prompt=prompt, model_name=model_name, options=options
+            )
+        except (Exception, asyncio.CancelledError) as e:
+            # Cancelled hedged requests may still be billed
+            self._record(prompt, model_name, "", usage, started_at, start, e)
+            raise
+        finally:
+            _current_usage.reset(token)
+        self._record(prompt, model_name, output or "", usage, started_at, start, None)
+        return output
+
+    @override
+    def stream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        usage, token, started_at, start = self._start()
+        chunks = []
+        stream = self.llm.stream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Closed early by the caller, only the chunks read were generated
+            self._record(
+                prompt, model_name, "".join(chunks), usage, started_at, start, None
+            )
+            raise
+        except Exception as e:
+            self._record(
+                prompt, model_name, "".join(chunks), usage, started_at, start, e
+            )
+            raise
+        finally:
+            stream.close()
+            _current_usage.reset(token)
+        self._record(
+            prompt, model_name, "".join(chunks), usage, started_at, start, None
+        )
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        usage, token, started_at, start = self._start()
+        chunks = []
+        stream = self.llm.astream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            self._record(
+                prompt, model_name, "".join(chunks), usage, started_at, start, None
+            )
+            raise
+        except (Exception, asyncio.CancelledError) as e:
+            self._record(
+                prompt, model_name, "".join(chunks), usage, started_at, start, e
+            )
+            raise
+        finally:
+            await stream.aclose()
+            _current_usage.reset(token)
+        self._record(
+            prompt, model_name, "".join(chunks), usage, started_at, start, None
+        )
+
+    @override
+    def discard(
+        self, prompt: str, model_name: str, options: Optional[LLMOptions] = None
+    ) -> None:
+        self.llm.discard(prompt=prompt, model_name=model_name, options=options)
+
+
+def track_metrics(llm: BaseLLM) -> BaseLLM:
+    return MetricsLLM(llm=llm)
@@ -0,0 +1,435 @@
+"""
+Local stand-in for the LLM providers, for offline load testing.
+
+Serves the chat-completions protocol spoken by the Together, Fireworks and OpenAI
+clients, streaming included, with configurable latency distributions, injected
+errors and rate limits, and canned `<answer>`, `<title>` and `<body>` outputs.
+Like the OpenAI prefix cache, prompt prefixes seen before are reported as cached
+tokens, in blocks of `PREFIX_BLOCK_CHARS`. The least recently used blocks are
+evicted past `MockServerConfig.prefix_cache_blocks`, so that memory stays flat
+during long load tests.
+
+Start it with:
+
+    python -m newsletter.llm.mock_server --port 8000 --latency lognormal --mean 1.5
+
+and point the providers at it with the `LLM_CLIENT__BASE_URLS` environment
+variable, e.g. `{"OpenAI": "http://127.0.0.1:8000/v1/"}`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Annotated, Literal, Optional
+
+from pydantic import BaseModel
+from typing_extensions import Doc
+
+from newsletter.llm.tokens import estimate_tokens
+from newsletter.logger import logger
+
+PREFIX_BLOCK_CHARS = 512
+
+post_id_pattern = re.compile(r'<post id="(\d+)">(.*?)</post>', re.DOTALL)
+
+LatencyDistribution = Literal["fixed", "uniform", "exponential", "lognormal"]
+
+
+class MockModelConfig(BaseModel):
+    latency: LatencyDistribution = "fixed"
+    latency_mean: Annotated[float, Doc("Mean seconds before the answer starts.")] = 0.0
+    latency_sigma: Annotated[
+        float, Doc("Spread: half width for uniform, sigma for lognormal.")
+    ] = 0.5
+    error_rate: Annotated[float, Doc("Share of requests answered with a 503.")] = 0.0
+    rate_limit_rate: Annotated[float, Doc("Share of requests answered with a 429.")] = (
+        0.0
+    )
+    retry_after: Annotated[float, Doc("Retry-After sent with a 429.")] = 1.0
+    relevant_ratio: Annotated[
+        float, Doc("Share of filter prompts answered as relevant.")
+    ] = 0.5
+    reasoning_words: Annotated[
+        int, Doc("Words of reasoning written before the filter answer.")
+    ] = 0
+    seconds_per_token: Annotated[
+        float, Doc("Generation speed, applied between streamed chunks.")
+    ] = 0.0
+
+    def sample_latency(self, rng: random.Random) -> float:
+        if self.latency == "uniform":
+            return max(
+                0.0,
+                rng.uniform(
+                    self.latency_mean - self.latency_sigma,
+                    self.latency_mean + self.latency_sigma,
+                ),
+            )
+        if self.latency == "exponential":
+            return rng.expovariate(1 / self.latency_mean) if self.latency_mean else 0.0
+        if self.latency == "lognormal":
+            if not self.latency_mean:
+                return 0.0
+            # Parametrized so that the mean of the distribution is `latency_mean`
+            mu = math.log(self.latency_mean) - self.latency_sigma**2 / 2
+            return rng.lognormvariate(mu, self.latency_sigma)
+        return self.latency_mean
+
+
+class MockServerConfig(BaseModel):
+    default: MockModelConfig = MockModelConfig()
+    models: Annotated[
+        dict[str, MockModelConfig], Doc("Per model overrides of the default.")
+    ] = {}
+    seed: Optional[int] = None
+    prefix_cache_blocks: Annotated[
+        int, Doc("Prompt prefix blocks remembered for the prefix cache.")
+    ] = 100_000
+
+    def get_model_config(self, model_name: str) -> MockModelConfig:
+        return self.models.get(model_name, self.default)
+
+
+def is_relevant(prompt: str, ratio: float) -> bool:
+    # Stable per prompt, so that retries and fallbacks agree
+    digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 < ratio
+
+
+def get_usage(prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+
+
+def get_canned_output(prompt: str, config: MockModelConfig) -> str:
+    if "<title>" in prompt and "<body>" in prompt:
+        return (
+            "<title>Mock summary</title>\n"
+            "<body>A canned summary written by the local mock LLM server.</body>"
+        )
+    post_ids = post_id_pattern.findall(prompt)
+    if post_ids:
+        # Batched filter prompt, one answer per post
+        return "\n".join(
+            f'<answer id="{post_id}">'
+            + (
+                "Relevant"
+                if is_relevant(post, config.relevant_ratio)
+                else "Not relevant"
+            )
+            + "</answer>"
+            for post_id, post in post_ids
+        )
+    if "<answer>" in prompt:
+        reasoning = " ".join(["thinking"] * config.reasoning_words)
+        answer = (
+            "Relevant" if is_relevant(prompt, config.relevant_ratio) else "Not relevant"
+        )
+        return f"{reasoning}\n<answer>{answer}</answer>".lstrip()
+    return "Mock answer."
+
+
+def apply_stop(output: str, stop: Optional[list[str]]) -> str:
+    for sequence in stop or []:
+        idx = output.find(sequence)
+        if idx != -1:
+            output = output[:idx]
+    return output
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    server: MockLLMServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(f"Mock LLM server: {format % args}")
+
+    def _send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, headers: Optional[dict] = None):
+        self._send_json(
+            status,
+            {"error": {"message": message, "type": "mock_error", "code": str(status)}},
+            headers=headers,
+        )
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_error(400, "Invalid JSON body")
+
+        if not self.path.rstrip("/").endswith("chat/completions"):
+            return self._send_error(404, f"Unknown path {self.path}")
+
+        model_name = request.get("model", "mock")
+        prompt = "\n".join(
+            str(message.get("content", "")) for message in request.get("messages", [])
+        )
+        config = self.server.config.get_model_config(model_name)
+        self.server.record_request(model_name)
+
+        roll = self.server.random()
+        if roll < config.rate_limit_rate:
+            self.server.record_status(429)
+            return self._send_error(
+                429,
+                "Mock rate limit",
+                headers={"retry-after": str(config.retry_after)},
+            )
+        if roll < config.rate_limit_rate + config.error_rate:
+            self.server.record_status(503)
+            return self._send_error(503, "Mock service unavailable")
+
+        time.sleep(self.server.sample_latency(config))
+        output = apply_stop(get_canned_output(prompt, config), request.get("stop"))
+        self.server.record_status(200)
+
+        prompt_tokens = estimate_tokens(prompt)
+        cached_tokens = self.server.get_cached_tokens(prompt)
+        if request.get("stream"):
+            return self._stream(
+                model_name, output, prompt_tokens, cached_tokens, config
+            )
+
+        completion_tokens = estimate_tokens(output)
+        time.sleep(completion_tokens * config.seconds_per_token)
+        self._send_json(
+            200,
+            {
+                "id": f"mock-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model_name,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": output},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": get_usage(prompt_tokens, completion_tokens, cached_tokens),
+            },
+        )
+
+    def _stream(
+        self,
+        model_name: str,
+        output: str,
+        prompt_tokens: int,
+        cached_tokens: int,
+        config: MockModelConfig,
+    ):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        completion_id = f"mock-{uuid.uuid4().hex}"
+        # Split on tags and whitespace, like a tokenizer would
+        chunks = [chunk for chunk in output.replace("<", " <").split(" ") if chunk]
+        try:
+            for idx, chunk in enumerate(chunks):
+                time.sleep(config.seconds_per_token)
+                content = chunk if idx == 0 or chunk.startswith("<") else f" {chunk}"
+                self._write_event(completion_id, model_name, {"content": content}, None)
+            # Like Together AI, the usage comes with the last chunk
+            completion_tokens = estimate_tokens(output)
+            self._write_event(
+                completion_id,
+                model_name,
+                {},
+                "stop",
+                usage=get_usage(prompt_tokens, completion_tokens, cached_tokens),
+            )
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early
+            self.server.record_closed_stream()
+
+    def _write_event(
+        self,
+        completion_id: str,
+        model_name: str,
+        delta: dict,
+        finish_reason: Optional[str],
+        usage: Optional[dict] = None,
+    ):
+        event = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage is not None:
+            event["usage"] = usage
+        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+class MockServerStats(BaseModel):
+    requests: dict[str, int] = {}
+    statuses: dict[int, int] = {}
+    closed_streams: int = 0
+    cached_tokens: int = 0
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    Threaded mock server. Use as a context manager to serve in the background:
+
+        with MockLLMServer(config=MockServerConfig()) as server:
+            llm = OpenAILLM(base_url=server.base_url)
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        config: Optional[MockServerConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), MockLLMHandler)
+        self.config = config or MockServerConfig()
+        self.stats = MockServerStats()
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._prefixes: OrderedDict[bytes, None] = OrderedDict()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def sample_latency(self, config: MockModelConfig) -> float:
+        with self._lock:
+            return config.sample_latency(self._rng)
+
+    def get_cached_tokens(self, prompt: str) -> int:
+        """
+        Tokens of the longest block-aligned prefix of the prompt seen before.
+        """
+        cached = 0
+        with self._lock:
+            for end in range(PREFIX_BLOCK_CHARS, len(prompt) + 1, PREFIX_BLOCK_CHARS):
+                digest = hashlib.sha256(prompt[:end].encode("utf-8")).digest()
+                if digest in self._prefixes:
+                    cached = end
+                    self._prefixes.move_to_end(digest)
+                else:
+                    self._prefixes[digest] = None
+                    if len(self._prefixes) > self.config.prefix_cache_blocks:
+                        self._prefixes.popitem(last=False)
+            tokens = estimate_tokens(prompt[:cached]) if cached else 0
+            self.stats.cached_tokens += tokens
+        return tokens
+
+    def record_request(self, model_name: str):
+        with self._lock:
+            self.stats.requests[model_name] = self.stats.requests.get(model_name, 0) + 1
+
+    def record_status(self, status: int):
+        with self._lock:
+            self.stats.statuses[status] = self.stats.statuses.get(status, 0) + 1
+
+    def record_closed_stream(self):
+        with self._lock:
+            self.stats.closed_streams += 1
+
+    def __enter__(self) -> MockLLMServer:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency",
+        choices=["fixed", "uniform", "exponential", "lognormal"],
+        default="fixed",
+    )
+    parser.add_argument("--mean", type=float, default=0.0, help="Mean latency (s)")
+    parser.add_argument("--sigma", type=float, default=0.5, help="Latency spread")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--relevant-ratio", type=float, default=0.5)
+    parser.add_argument("--reasoning-words", type=int, default=0)
+    parser.add_argument("--seconds-per-token", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--config", default=None, help="JSON file with a full MockServerConfig"
+    )
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config) as f:
+            config = MockServerConfig.model_validate_json(f.read())
+    else:
+        config = MockServerConfig(
+            default=MockModelConfig(
+                latency=args.latency,
+                latency_mean=args.mean,
+                latency_sigma=args.sigma,
+                error_rate=args.error_rate,
+                rate_limit_rate=args.rate_limit_rate,
+                relevant_ratio=args.relevant_ratio,
+                reasoning_words=args.reasoning_words,
+                seconds_per_token=args.seconds_per_token,
+            ),
+            seed=args.seed,
+        )
+
+    server = MockLLMServer(config=config, host=args.host, port=args.port)
+    logger.info(f"Mock LLM server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Mock LLM server stats: {server.stats.model_dump_json()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,42 @@
-from typing import Annotated, Literal, Optional, Self, TypeAlias, get_args
+from typing import (
+    Annotated,
+    AsyncIterator,
+    ClassVar,
+    Iterator,
+    Literal,
+    Optional,
+    Self,
+    TypeAlias,
+    get_args,
+)
 
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI,
+    AuthenticationError,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 from pydantic import ConfigDict, Field, PrivateAttr, SecretStr, model_validator
 from typing_extensions import override
 
 from newsletter.llm.base import BaseLLM, LLMOptions
-from newsletter.settings import settings
+from newsletter.llm.clients import (
+    client_registry,
+    get_client_key,
+    get_pool_limits,
+    get_retry_options,
+)
+from newsletter.llm.exception import (
+    LLMAuthenticationError,
+    LLMRateLimitError,
+    LLMServiceUnavailableError,
+)
+from newsletter.llm.metrics import report_response_usage
+from newsletter.llm.rate_limit import estimate_request_tokens, get_rate_limiter
+from newsletter.settings import LLMPlatform, settings
 
 Model: TypeAlias = Literal[
     "gpt-4-turbo",
@@ -29,7 +60,11 @@ def model_format_func(opt: str) -> str:
 
 
 class OpenAILLM(BaseLLM):
+    platform: ClassVar[LLMPlatform] = "OpenAI"
     api_key: Annotated[SecretStr, Field(default=settings.openai_api_key)]
+    base_url: Optional[str] = Field(
+        default_factory=lambda: settings.llm_client.base_urls.get("OpenAI")
+    )
     _client: OpenAI = PrivateAttr()
 
     model_config = ConfigDict(
@@ -38,11 +73,33 @@ class OpenAILLM(BaseLLM):
 
     @model_validator(mode="after")
     def init_client(self) -> Self:
-        self._client = OpenAI(
-            api_key=self.api_key.get_secret_value(),
+        self._client = client_registry.get(
+            get_client_key(
+                self.platform, self.api_key.get_secret_value(), self.base_url
+            ),
+            lambda: OpenAI(
+                api_key=self.api_key.get_secret_value(),
+                base_url=self.base_url,
+                **get_retry_options(),
+                http_client=DefaultHttpxClient(limits=get_pool_limits()),
+            ),
         )
         return self
 
+    @property
+    def _async_client(self) -> AsyncOpenAI:
+        return client_registry.get_async(
+            get_client_key(
+                self.platform, self.api_key.get_secret_value(), self.base_url
+            ),
+            lambda: AsyncOpenAI(
+                api_key=self.api_key.get_secret_value(),
+                base_url=self.base_url,
+                **get_retry_options(),
+                http_client=DefaultAsyncHttpxClient(limits=get_pool_limits()),
+            ),
+        )
+
     @override
     def generate(
         self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
@@ -55,8 +112,100 @@ class OpenAILLM(BaseLLM):
         else:
             kwargs = {}
 
-        return (
-            self._client.chat.completions.create(
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        rate_limiter.acquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            raw_response = self._client.chat.completions.with_raw_response.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                **kwargs,
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = raw_response.parse()
+        report_response_usage(response.usage)
+        return response.choices[0].message.content
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> str:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+
+        else:
+            kwargs = {}
+
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        await rate_limiter.aacquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            raw_response = (
+                await self._async_client.chat.completions.with_raw_response.create(
+                    model=model_name,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    **kwargs,
+                )
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = raw_response.parse()
+        report_response_usage(response.usage)
+        return response.choices[0].message.content
+
+    @override
+    def stream(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+
+        else:
+            kwargs = {}
+
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        rate_limiter.acquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            raw_response = self._client.chat.completions.with_raw_response.create(
                 model=model_name,
                 messages=[
                     {
@@ -64,8 +213,82 @@ class OpenAILLM(BaseLLM):
                         "content": prompt,
                     }
                 ],
+                stream=True,
+                stream_options={"include_usage": True},
                 **kwargs,
             )
-            .choices[0]
-            .message.content
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = raw_response.parse()
+        try:
+            for chunk in response:
+                report_response_usage(getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        finally:
+            # Closing the connection makes the server stop generating
+            response.close()
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+
+        else:
+            kwargs = {}
+
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        await rate_limiter.aacquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
         )
+        try:
+            raw_response = (
+                await self._async_client.chat.completions.with_raw_response.create(
+                    model=model_name,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **kwargs,
+                )
+            )
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.response.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except InternalServerError as e:
+            raise LLMServiceUnavailableError(e)
+
+        rate_limiter.observe_headers(raw_response.headers)
+        response = raw_response.parse()
+        try:
+            async for chunk in response:
+                report_response_usage(getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        finally:
+            await response.close()
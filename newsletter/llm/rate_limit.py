@@ -0,0 +1,238 @@
+"""
+Proactive client-side rate limiting for the LLM providers.
+
+Each platform/model pair gets a shared `RateLimiter` holding two token buckets, one
+for requests and one for tokens. Calls wait for capacity before being sent instead
+of running into the provider's limits, and the buckets are adjusted from the
+rate-limit headers of the responses when the provider sends them. A rate-limited
+call pauses the buckets, so that its retry waits in `acquire` like any other call.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Annotated, Any, Mapping, Optional
+
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.llm.base import LLMOptions
+from newsletter.llm.tokens import estimate_tokens
+from newsletter.logger import logger
+from newsletter.settings import RateLimit, settings
+
+DEFAULT_RETRY_AFTER = 2.0
+
+
+class TokenBucket(BaseModel):
+    per_minute: float
+    burst_seconds: Annotated[
+        float, Doc("Capacity of the bucket, in seconds worth of refill.")
+    ] = 10.0
+    _tokens: Optional[float] = PrivateAttr(default=None)
+    _updated_at: float = PrivateAttr(default_factory=time.monotonic)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+    @property
+    def capacity(self) -> float:
+        return max(self.rate * self.burst_seconds, 1.0)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._tokens is None:
+            self._tokens = self.capacity
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` from the bucket and return how many seconds the caller has
+        to wait before the reservation is covered.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def clamp(self, remaining: float):
+        """Never assume more capacity than the provider says is left."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, remaining)
+
+    def pause(self, seconds: float):
+        """Empty the bucket so that the next reservation waits `seconds`."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def set_limit(self, per_minute: float):
+        with self._lock:
+            self._refill()
+            self.per_minute = per_minute
+
+
+def parse_header_float(headers: Mapping[str, Any], *names: str) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def parse_retry_after(headers: Mapping[str, Any]) -> Optional[float]:
+    retry_after_ms = parse_header_float(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return parse_header_float(headers, "retry-after")
+
+
+class RateLimiter(BaseModel):
+    requests: Optional[TokenBucket] = None
+    tokens: Optional[TokenBucket] = None
+    default_retry_after: Annotated[
+        float, Doc("Pause after a rate limit error without a retry-after header.")
+    ] = DEFAULT_RETRY_AFTER
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def from_limit(cls, limit: RateLimit) -> RateLimiter:
+        return cls(
+            requests=(
+                TokenBucket(per_minute=limit.requests_per_minute)
+                if limit.requests_per_minute
+                else None
+            ),
+            tokens=(
+                TokenBucket(per_minute=limit.tokens_per_minute)
+                if limit.tokens_per_minute
+                else None
+            ),
+        )
+
+    def _reserve(self, tokens: float) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def acquire(self, tokens: float = 0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            logger.debug(f"Rate limiter waiting {wait:.2f}s")
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: float = 0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            logger.debug(f"Rate limiter waiting {wait:.2f}s")
+            await asyncio.sleep(wait)
+
+    def observe_headers(self, headers: Optional[Mapping[str, Any]]):
+        """
+        Learn limits from the `x-ratelimit-*` headers (OpenAI, Fireworks and
+        Together all use variations of them), and back off on `retry-after`.
+        """
+        if not headers:
+            return
+
+        headers = {str(key).lower(): value for key, value in headers.items()}
+        request_limit = parse_header_float(headers, "x-ratelimit-limit-requests")
+        token_limit = parse_header_float(headers, "x-ratelimit-limit-tokens")
+        remaining_requests = parse_header_float(
+            headers, "x-ratelimit-remaining-requests", "x-ratelimit-remaining"
+        )
+        remaining_tokens = parse_header_float(headers, "x-ratelimit-remaining-tokens")
+
+        with self._lock:
+            if request_limit is not None:
+                if self.requests is None:
+                    self.requests = TokenBucket(per_minute=request_limit)
+                elif self.requests.per_minute != request_limit:
+                    self.requests.set_limit(request_limit)
+            if token_limit is not None:
+                if self.tokens is None:
+                    self.tokens = TokenBucket(per_minute=token_limit)
+                elif self.tokens.per_minute != token_limit:
+                    self.tokens.set_limit(token_limit)
+
+        if remaining_requests is not None and self.requests is not None:
+            self.requests.clamp(remaining_requests)
+        if remaining_tokens is not None and self.tokens is not None:
+            self.tokens.clamp(remaining_tokens)
+
+        retry_after = parse_retry_after(headers)
+        if retry_after is not None and retry_after > 0:
+            logger.info(f"Provider asked to retry after {retry_after}s, pausing")
+            self._pause(retry_after)
+
+    def observe_rate_limit(
+        self, headers: Optional[Mapping[str, Any]]
+    ) -> Optional[float]:
+        """
+        Called on a rate limit error. Pauses for the retry-after of the response,
+        or `default_retry_after` when the provider does not send one. Returns the
+        retry-after of the response, for the caller to back off.
+        """
+        self.observe_headers(headers)
+        headers = {str(key).lower(): value for key, value in (headers or {}).items()}
+        retry_after = parse_retry_after(headers)
+        if retry_after is None:
+            logger.info(f"Rate limited, pausing for {self.default_retry_after}s")
+            self._pause(self.default_retry_after)
+        return retry_after
+
+    def _pause(self, seconds: float):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.pause(seconds)
+
+
+def estimate_request_tokens(prompt: str, options: Optional[LLMOptions] = None) -> int:
+    completion_tokens = options.max_tokens if options and options.max_tokens else 0
+    return estimate_tokens(prompt) + completion_tokens
+
+
+_rate_limiters: dict[tuple[str, str], RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limit(platform: str, model_name: str) -> RateLimit:
+    overrides = settings.rate_limit.overrides
+    return overrides.get(
+        f"{platform}/{model_name}",
+        overrides.get(platform, settings.rate_limit.default),
+    )
+
+
+def get_rate_limiter(platform: str, model_name: str) -> RateLimiter:
+    """
+    Rate limiter shared by every client of the given platform and model.
+    """
+    if not settings.rate_limit.enabled:
+        # Without buckets, acquiring never waits
+        return RateLimiter()
+
+    with _rate_limiters_lock:
+        key = (platform, model_name)
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter.from_limit(
+                get_rate_limit(platform=platform, model_name=model_name)
+            )
+        return _rate_limiters[key]
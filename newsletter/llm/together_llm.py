@@ -1,5 +1,17 @@
-from typing import Literal, Optional, Self, TypeAlias, get_args
+from typing import (
+    AsyncIterator,
+    ClassVar,
+    Iterator,
+    Literal,
+    Optional,
+    Self,
+    TypeAlias,
+    get_args,
+)
 
+import aiohttp
+import requests
+import together
 from pydantic import (
     ConfigDict,
     Field,
@@ -7,17 +19,22 @@ from pydantic import (
     SecretStr,
     model_validator,
 )
-from together import Together
+from together import AsyncTogether, Together
+from together.constants import MAX_CONNECTION_RETRIES
 from together.error import AuthenticationError, RateLimitError, ServiceUnavailableError
 from typing_extensions import override
+from urllib3.util import Retry
 
 from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.clients import client_registry, get_client_key, get_retry_options
 from newsletter.llm.exception import (
     LLMAuthenticationError,
     LLMRateLimitError,
     LLMServiceUnavailableError,
 )
-from newsletter.settings import settings
+from newsletter.llm.metrics import report_response_usage
+from newsletter.llm.rate_limit import estimate_request_tokens, get_rate_limiter
+from newsletter.settings import LLMPlatform, settings
 
 Model: TypeAlias = Literal[
     "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
@@ -36,6 +53,20 @@ MODEL_ALIAS: dict[Model, str] = {
 }
 
 
+def get_requests_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=settings.llm_client.pool_size,
+        pool_maxsize=settings.llm_client.pool_size,
+        # Same connection retries as the sessions the SDK makes itself
+        max_retries=Retry(MAX_CONNECTION_RETRIES, read=False),
+    )
+    # http:// too, for a local base url such as the mock server
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 def get_model_list():
     return get_args(Model)
 
@@ -45,8 +76,13 @@ def model_format_func(opt: str):
 
 
 class TogetherLLM(BaseLLM):
+    platform: ClassVar[LLMPlatform] = "Together AI"
     api_key: SecretStr = Field(default=settings.together_api_key)
+    base_url: Optional[str] = Field(
+        default_factory=lambda: settings.llm_client.base_urls.get("Together AI")
+    )
     _client: Together = PrivateAttr()
+    _async_client: AsyncTogether = PrivateAttr()
 
     model_config = ConfigDict(
         arbitrary_types_allowed=True,
@@ -54,9 +90,42 @@ class TogetherLLM(BaseLLM):
 
     @model_validator(mode="after")
     def init_client(self) -> Self:
-        self._client = Together(api_key=self.api_key.get_secret_value())
+        # The SDK opens its connections through these module level sessions
+        together.requestssession = client_registry.get(
+            (self.platform, "requests"), get_requests_session
+        )
+        key = get_client_key(
+            self.platform, self.api_key.get_secret_value(), self.base_url
+        )
+        self._client = client_registry.get(
+            key,
+            lambda: Together(
+                api_key=self.api_key.get_secret_value(),
+                base_url=self.base_url,
+                **get_retry_options(),
+            ),
+        )
+        self._async_client = client_registry.get(
+            (*key, "async"),
+            lambda: AsyncTogether(
+                api_key=self.api_key.get_secret_value(),
+                base_url=self.base_url,
+                **get_retry_options(),
+            ),
+        )
         return self
 
+    def _use_shared_aiohttp_session(self):
+        # Without a session in the context, the SDK opens a new one per request
+        together.aiosession.set(
+            client_registry.get_async(
+                (self.platform, "aiohttp"),
+                lambda: aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=settings.llm_client.pool_size)
+                ),
+            )
+        )
+
     @override
     def generate(
         self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
@@ -67,6 +136,10 @@ class TogetherLLM(BaseLLM):
             )
         else:
             kwargs = {}
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        rate_limiter.acquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
         try:
             response = self._client.chat.completions.create(
                 model=model_name,
@@ -79,13 +152,147 @@ class TogetherLLM(BaseLLM):
                 **kwargs,
             )
 
+            report_response_usage(response.usage)
             return response.choices[0].message.content
 
         except AuthenticationError as e:
             raise LLMAuthenticationError(e)
 
         except RateLimitError as e:
-            raise LLMRateLimitError(e)
+            retry_after = rate_limiter.observe_rate_limit(e.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except ServiceUnavailableError as e:
+            raise LLMServiceUnavailableError(e)
+
+    @override
+    async def agenerate(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> str:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+        else:
+            kwargs = {}
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        await rate_limiter.aacquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        self._use_shared_aiohttp_session()
+        try:
+            response = await self._async_client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                **kwargs,
+            )
+
+            report_response_usage(response.usage)
+            return response.choices[0].message.content
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except ServiceUnavailableError as e:
+            raise LLMServiceUnavailableError(e)
+
+    @override
+    def stream(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> Iterator[str]:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+        else:
+            kwargs = {}
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        rate_limiter.acquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        try:
+            response = self._client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                stream=True,
+                **kwargs,
+            )
+            try:
+                for chunk in response:
+                    report_response_usage(getattr(chunk, "usage", None))
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+            finally:
+                # Closing the connection makes the server stop generating
+                response.close()
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
+
+        except ServiceUnavailableError as e:
+            raise LLMServiceUnavailableError(e)
+
+    @override
+    async def astream(
+        self, prompt: str, model_name: Model, options: Optional[LLMOptions] = None
+    ) -> AsyncIterator[str]:
+        if options is not None:
+            kwargs = options.model_dump(
+                exclude_none=True,
+            )
+        else:
+            kwargs = {}
+        rate_limiter = get_rate_limiter(platform=self.platform, model_name=model_name)
+        await rate_limiter.aacquire(
+            tokens=estimate_request_tokens(prompt=prompt, options=options)
+        )
+        self._use_shared_aiohttp_session()
+        try:
+            response = await self._async_client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                stream=True,
+                **kwargs,
+            )
+            try:
+                async for chunk in response:
+                    report_response_usage(getattr(chunk, "usage", None))
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+            finally:
+                await response.aclose()
+
+        except AuthenticationError as e:
+            raise LLMAuthenticationError(e)
+
+        except RateLimitError as e:
+            retry_after = rate_limiter.observe_rate_limit(e.headers)
+            raise LLMRateLimitError(e, retry_after=retry_after)
 
         except ServiceUnavailableError as e:
             raise LLMServiceUnavailableError(e)
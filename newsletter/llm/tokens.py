@@ -0,0 +1,37 @@
+"""
+Local token estimation, without downloading a tokenizer for every model.
+
+The estimate follows how BPE tokenizers split text: short words are a single
+token, long words are split in pieces, digits are grouped by three and most
+punctuation is its own token. It errs on the high side, so that a prompt fitting
+the estimate fits the model.
+"""
+
+import math
+import re
+
+token_pattern = re.compile(r"[A-Za-z]+|\d{1,3}|\n[ \t]*|[^\sA-Za-z\d]")
+CHARS_PER_WORD_TOKEN = 5
+
+
+def _count(match: re.Match) -> int:
+    piece = match.group(0)
+    if piece[0].isascii() and piece[0].isalpha():
+        return max(1, math.ceil(len(piece) / CHARS_PER_WORD_TOKEN))
+    return 1
+
+
+def estimate_tokens(text: str) -> int:
+    return sum(_count(match) for match in token_pattern.finditer(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Longest prefix of `text` estimated at no more than `max_tokens` tokens.
+    """
+    tokens = 0
+    for match in token_pattern.finditer(text):
+        tokens += _count(match)
+        if tokens > max_tokens:
+            return text[: match.start()].rstrip()
+    return text
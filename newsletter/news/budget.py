@@ -0,0 +1,147 @@
+"""
+Fit posts into a per-stage prompt token budget.
+
+When a serialized post is over budget, it is trimmed in priority order until it
+fits: replies to comments go first, then the lowest ranked comments, then the
+scraped webpage contents, then the remaining comments and finally the post text.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Annotated, Callable, Optional
+
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.llm.tokens import estimate_tokens, truncate_to_tokens
+from newsletter.logger import logger
+from newsletter.scraper.post import Post, Text
+from newsletter.scraper.webpage import Webpage
+
+TRUNCATION_MARKER = " [...]"
+MAX_TRUNCATION_ROUNDS = 3
+
+
+def _truncate_contents(contents: list, attribute: str, excess: int) -> Optional[str]:
+    """
+    Cut `excess` tokens from the `attribute` of the contents, longest first.
+    """
+    sized = [
+        (estimate_tokens(getattr(content, attribute)), content)
+        for content in contents
+        if getattr(content, attribute)
+    ]
+    sized.sort(key=lambda x: x[0], reverse=True)
+
+    cut_total = 0
+    for tokens, content in sized:
+        if excess <= 0:
+            break
+        keep = max(tokens - excess - estimate_tokens(TRUNCATION_MARKER), 0)
+        text = truncate_to_tokens(getattr(content, attribute), keep)
+        setattr(content, attribute, text + TRUNCATION_MARKER if text else "")
+        excess -= tokens - keep
+        cut_total += tokens - keep
+
+    return f"cut {cut_total} tokens of {attribute}" if cut_total > 0 else None
+
+
+class PromptBudget(BaseModel):
+    stage: str
+    max_tokens: Annotated[int, Doc("Token budget of the whole prompt.")]
+    min_comments: Annotated[
+        int, Doc("Comments kept while webpages are still being trimmed.")
+    ] = 3
+    hits: Annotated[int, Doc("Prompts that had to be trimmed.")] = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _drop_replies(self, post: Post, excess: int) -> Optional[str]:
+        dropped = 0
+        for comment in post.comments or []:
+            if comment.comments:
+                dropped += len(comment.comments)
+                comment.comments = None
+        return f"dropped {dropped} replies" if dropped > 0 else None
+
+    def _drop_comments(self, post: Post, excess: int, keep: int) -> Optional[str]:
+        if not post.comments or len(post.comments) <= keep:
+            return None
+        # Comments are scraped in ranking order, the last are the least relevant
+        dropped = len(post.comments) - keep
+        post.comments = post.comments[:keep]
+        return f"dropped {dropped} comments"
+
+    def _truncate_webpages(self, post: Post, excess: int) -> Optional[str]:
+        if post.content is None:
+            return None
+        webpages = [c for c in post.content.contents if isinstance(c, Webpage)]
+        return _truncate_contents(webpages, "content", excess)
+
+    def _truncate_texts(self, post: Post, excess: int) -> Optional[str]:
+        if post.content is None:
+            return None
+        texts = [c for c in post.content.contents if isinstance(c, Text)]
+        return _truncate_contents(texts, "text", excess)
+
+    def fit(
+        self,
+        post: Post,
+        serialize: Callable[[Post], str],
+        reserved_tokens: int = 0,
+    ) -> str:
+        """
+        Serialize the post, trimmed to fit in the budget left after
+        `reserved_tokens`, which is the rest of the prompt. The trimmed text is
+        kept on the post, so that retries reuse it until `Post.clear_prompt`.
+        """
+        available = self.max_tokens - reserved_tokens
+        key = (self.stage, available, serialize)
+        if key in post._fitted:
+            return post._fitted[key]
+
+        text = serialize(post)
+        tokens = estimate_tokens(text)
+        if tokens <= available:
+            return text
+
+        original_tokens = tokens
+        original = post
+        post = post.model_copy(deep=True)
+        steps = [
+            self._drop_replies,
+            lambda post, excess: self._drop_comments(
+                post, excess, keep=self.min_comments
+            ),
+            self._truncate_webpages,
+            lambda post, excess: self._drop_comments(post, excess, keep=0),
+            self._truncate_texts,
+        ]
+        trimmed = []
+        for step in steps:
+            # Truncation is estimated on the raw text, serializing adds some
+            # overhead, so a step may need another round
+            for _ in range(MAX_TRUNCATION_ROUNDS):
+                result = step(post, tokens - available)
+                if result is None:
+                    break
+                trimmed.append(result)
+                post.clear_prompt()
+                text = serialize(post)
+                tokens = estimate_tokens(text)
+                if tokens <= available:
+                    break
+            if tokens <= available:
+                break
+
+        with self._lock:
+            self.hits += 1
+
+        log = logger.info if tokens <= available else logger.warning
+        log(
+            f"{self.stage} prompt for {post.url} over budget "
+            f"({original_tokens} > {available} tokens): {', '.join(trimmed)}. "
+            f"Now {tokens} tokens."
+        )
+        original._fitted[key] = text
+        return text
@@ -2,37 +2,70 @@
 Generate a newsletters
 """
 
-import datetime
+from typing import Iterator, Optional
 
+from newsletter.llm.cache import wrap_with_cache
+from newsletter.llm.clients import run_async
+from newsletter.llm.concurrency import adapt_concurrency
+from newsletter.llm.health import track_health
+from newsletter.llm.metrics import track_metrics
 from newsletter.llm.together_llm import Model, TogetherLLM
 from newsletter.news.news import Newsletter
-from newsletter.news.summarize import Summarizer
-from newsletter.scraper.reddit import load_reddit_preferences, reddit_scraper
+from newsletter.news.results import get_default_result_store
+from newsletter.news.summarize import Summarizer, generate_default_newsletter_name
+from newsletter.scraper.post import Post
+from newsletter.scraper.reddit import (
+    Preference,
+    load_reddit_preferences,
+    reddit_scraper,
+)
+from newsletter.scraper.store import raw_data_store
+from newsletter.scraper.webpage import extraction_stats
 from newsletter.settings import settings
 
 
-def generate_default_newsletter_name() -> str:
-    return datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+def stream_reddit_posts(
+    preferences: list[Preference], run_id: Optional[str] = None
+) -> Iterator[Post]:
+    """
+    Yield posts as they are scraped, appending them to the raw data store.
+    """
+    if run_id is None:
+        run_id = generate_default_newsletter_name()
+
+    # The stats are module-level, report only the pages of this run
+    extraction_stats.reset()
+
+    with raw_data_store.writer(run_id=run_id) as writer:
+        for subreddit_name, post in reddit_scraper.iter_scrape_with_preferences(
+            preferences=preferences
+        ):
+            writer.write(name=subreddit_name, post=post)
+            yield post
+
+    extraction_stats.report()
 
 
 def generate_newsletter(
-    name: str, filter_model: Model, summary_model: Model
+    name: str, filter_model: list[Model], summary_model: list[Model]
 ) -> Newsletter:
     preferences = load_reddit_preferences()
-    res = reddit_scraper.scrape_with_preferences(preferences=preferences)
-
-    all_post_list = []
-    for subreddit_name, post_list in res.items():
-        filepath = settings.storage.raw_data_folder / f"{subreddit_name}.json"
-        post_list.save(filepath)
-        all_post_list.extend(post_list)
-
-    summarizer = Summarizer(llm=TogetherLLM())
-    summary = summarizer.summarize_post_list(
-        post_list=all_post_list,
-        summary_model=summary_model,
-        filter_model=filter_model,
-        newsletter_name=name,
+
+    summarizer = Summarizer(
+        llm=track_metrics(
+            wrap_with_cache(adapt_concurrency(track_health(TogetherLLM())))
+        ),
+        results=get_default_result_store(),
+    )
+    summary = run_async(
+        summarizer.asummarize_posts(
+            posts=stream_reddit_posts(preferences=preferences, run_id=name),
+            summary_model=summary_model,
+            filter_model=filter_model,
+            newsletter_name=name,
+        )
     )
     summary.save()
+    reddit_scraper.commit_state()
+    summarizer.metrics.export_jsonl(settings.storage.metrics_folder / f"{name}.jsonl")
     return summary
@@ -2,9 +2,11 @@ from __future__ import annotations
 
 import datetime
 from pathlib import Path
+from typing import Optional
 
 from pydantic import BaseModel
 
+from newsletter.llm.metrics import RunMetrics
 from newsletter.settings import settings
 
 
@@ -19,6 +21,7 @@ class Newsletter(BaseModel):
     name: str
     created_at: datetime.datetime
     path: Path
+    metrics: Optional[RunMetrics] = None
 
     @classmethod
     def from_path(cls, path: Path) -> Newsletter:
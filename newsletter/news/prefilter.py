@@ -0,0 +1,272 @@
+"""
+Local relevance pre-filter, run before the filter LLM.
+
+Posts and the user interests are embedded as hashed TF-IDF vectors: words, word
+pairs and down-weighted character trigrams are hashed into a fixed number of
+features, term frequencies are dampened with a log and weighted by the inverse
+document frequency over the posts seen so far. A post, with its top level
+comments, is scored by its best cosine similarity with any line of the user
+interests.
+
+The document frequencies are seeded from the posts of earlier runs in the raw
+data store, see `settings.prefilter.seed_posts`, read once per process. Without that corpus, they are
+learned from the posts of the run only, so that early decisions depend on the
+order the posts arrive in until enough posts were seen.
+
+Posts scoring below `reject_below` share next to nothing with the interests and
+are rejected, posts above `accept_above` are accepted, both without calling the
+LLM. Only the uncertain band in between goes to the filter model.
+"""
+
+from __future__ import annotations
+
+import itertools
+import re
+import threading
+import zlib
+from typing import Annotated, Iterable, Optional
+
+import numpy as np
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.logger import logger
+from newsletter.scraper.dedup import get_post_text
+from newsletter.scraper.post import Post, Text
+from newsletter.scraper.store import raw_data_store
+from newsletter.settings import settings
+
+term_pattern = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    """
+    a about above after again against all am an and any are as at be because been
+    before being below between both but by can did do does doing down during each
+    few for from further had has have having he her here hers herself him himself
+    his how i if in into is it its itself just me more most my myself no nor not
+    now of off on once only or other our ours ourselves out over own same she
+    should so some such than that the their theirs them themselves then there
+    these they this those through to too under until up very was we were what
+    when where which while who whom why will with would you your yours yourself
+    yourselves also get got like one really would could us im dont its thats
+    """.split()
+)
+
+
+def get_terms(text: str) -> tuple[list[str], list[str]]:
+    """
+    Words and word pairs, and the character trigrams of the words.
+    """
+    words = [
+        # Crude plural folding, so that "model" matches "models"
+        word[:-1] if len(word) > 3 and word.endswith("s") else word
+        for word in term_pattern.findall(text.lower())
+        if word not in STOP_WORDS
+    ]
+    pairs = [f"{first} {second}" for first, second in zip(words, words[1:])]
+    trigrams = [
+        padded[idx : idx + 3]
+        for padded in (f" {word} " for word in words)
+        for idx in range(len(padded) - 2)
+    ]
+    return words + pairs, trigrams
+
+
+def get_prefilter_text(post: Post) -> str:
+    """
+    Text of the post and of its top level comments, which often say what an
+    image or a short title is about.
+    """
+    texts = [get_post_text(post)]
+    for comment in post.comments or []:
+        if comment.content is not None:
+            texts.extend(
+                content.text
+                for content in comment.content.contents
+                if isinstance(content, Text)
+            )
+    return "\n".join(texts)
+
+
+class RelevancePrefilter(BaseModel):
+    reject_below: Annotated[
+        float, Doc("Posts less similar to the interests are rejected.")
+    ] = 0.01
+    accept_above: Annotated[
+        Optional[float],
+        Doc("Posts more similar to the interests are accepted. None never accepts."),
+    ] = 0.4
+    n_features: Annotated[int, Doc("Size of the hashed feature space.")] = 2**18
+    trigram_weight: Annotated[
+        float,
+        Doc('Weight of character trigrams, which match "gpt" in "chatgpt".'),
+    ] = 0.2
+    interests: Annotated[
+        Optional[str], Doc("Interests to compare to. None reads the user's.")
+    ] = None
+    accepted: int = 0
+    rejected: int = 0
+    uncertain: int = 0
+    _document_frequency: Optional[np.ndarray] = PrivateAttr(default=None)
+    _documents: int = PrivateAttr(default=0)
+    _interests: Optional[str] = PrivateAttr(default=None)
+    _interest_features: list[tuple[np.ndarray, np.ndarray]] = PrivateAttr(
+        default_factory=list
+    )
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _hash(self, text: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Hashed features of the text, with their log-dampened frequency.
+        """
+        terms, trigrams = get_terms(text)
+        hashes = np.fromiter(
+            (zlib.crc32(term.encode("utf-8")) for term in terms + trigrams),
+            dtype=np.int64,
+            count=len(terms) + len(trigrams),
+        )
+        weights = np.concatenate(
+            [np.ones(len(terms)), np.full(len(trigrams), self.trigram_weight)]
+        )
+        features, inverse = np.unique(hashes % self.n_features, return_inverse=True)
+        return features, np.log1p(np.bincount(inverse, weights=weights))
+
+    def _idf(self, features: np.ndarray) -> np.ndarray:
+        return (
+            np.log((1 + self._documents) / (1 + self._document_frequency[features])) + 1
+        )
+
+    def _count(self, features: np.ndarray):
+        if self._document_frequency is None:
+            self._document_frequency = np.zeros(self.n_features, dtype=np.int32)
+        self._document_frequency[features] += 1
+        self._documents += 1
+
+    def seed(self, posts: Iterable[Post]) -> int:
+        """
+        Count the document frequencies of a fixed corpus, e.g. the posts of
+        earlier runs, without scoring it. Returns the number of posts counted.
+        """
+        seeded = 0
+        for post in posts:
+            text = get_prefilter_text(post)
+            if not any(get_terms(text)):
+                continue
+            features, _ = self._hash(text)
+            with self._lock:
+                self._count(features)
+            seeded += 1
+        return seeded
+
+    def copy_frequencies(self, other: RelevancePrefilter):
+        """
+        Start from the document frequencies counted by `other`.
+        """
+        with self._lock:
+            if other._document_frequency is not None:
+                self._document_frequency = other._document_frequency.copy()
+            self._documents = other._documents
+
+    def _update_interests(self, interests: str):
+        self._interests = interests
+        self._interest_features = [
+            self._hash(line) for line in interests.splitlines() if any(get_terms(line))
+        ]
+
+    def score(self, post: Post) -> Optional[float]:
+        """
+        Best cosine similarity between the post and a line of the user interests.
+        None without interests to compare to.
+        """
+        interests = self.interests or settings.storage.get_user_interest_prompt()
+        text = get_prefilter_text(post)
+        with self._lock:
+            if interests != self._interests:
+                self._update_interests(interests or "")
+            if not self._interest_features or not any(get_terms(text)):
+                return None
+
+            features, tf = self._hash(text)
+            self._count(features)
+
+            post_weights = tf * self._idf(features)
+            post_norm = np.linalg.norm(post_weights)
+            best = 0.0
+            for interest_features, interest_tf in self._interest_features:
+                interest_weights = interest_tf * self._idf(interest_features)
+                # Both feature arrays are sorted and unique
+                _, post_idx, interest_idx = np.intersect1d(
+                    features, interest_features, assume_unique=True, return_indices=True
+                )
+                dot = np.dot(post_weights[post_idx], interest_weights[interest_idx])
+                best = max(best, dot / (post_norm * np.linalg.norm(interest_weights)))
+            return float(best)
+
+    def decide(self, post: Post) -> Optional[bool]:
+        """
+        True or False when the score is clear enough, None when the filter LLM
+        has to decide.
+        """
+        score = self.score(post)
+        if score is None:
+            decision = None
+        elif score < self.reject_below:
+            decision = False
+        elif self.accept_above is not None and score > self.accept_above:
+            decision = True
+        else:
+            decision = None
+
+        with self._lock:
+            if decision is None:
+                self.uncertain += 1
+            elif decision:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+        logger.debug(f"Pre-filter score of {post.url}: {score} -> {decision}")
+        return decision
+
+    def report(self):
+        total = self.accepted + self.rejected + self.uncertain
+        if total > 0:
+            logger.info(
+                f"Pre-filter: {self.accepted} accepted, {self.rejected} rejected, "
+                f"{self.uncertain} of {total} posts left to the filter LLM"
+            )
+
+
+def iter_recent_posts() -> Iterable[Post]:
+    for run_id in reversed(raw_data_store.get_runs()):
+        yield from raw_data_store.iter_posts(run_id=run_id)
+
+
+_seed: Optional[RelevancePrefilter] = None
+_seed_lock = threading.Lock()
+
+
+def get_seed() -> RelevancePrefilter:
+    """
+    Pre-filter holding the document frequencies of the posts of earlier runs,
+    counted once per process rather than for every `Summarizer`.
+    """
+    global _seed
+    with _seed_lock:
+        if _seed is None:
+            _seed = RelevancePrefilter()
+            seeded = _seed.seed(
+                itertools.islice(iter_recent_posts(), settings.prefilter.seed_posts)
+            )
+            logger.debug(f"Pre-filter document frequencies seeded from {seeded} posts")
+        return _seed
+
+
+def get_default_prefilter() -> Optional[RelevancePrefilter]:
+    if not settings.prefilter.enabled:
+        return None
+    prefilter = RelevancePrefilter(
+        reject_below=settings.prefilter.reject_below,
+        accept_above=settings.prefilter.accept_above,
+    )
+    if settings.prefilter.seed_posts > 0:
+        prefilter.copy_frequencies(get_seed())
+    return prefilter
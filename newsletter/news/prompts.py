@@ -1,11 +1,41 @@
-FILTER_PROMPT = """
-Below is a JSON data holding simplified information about a social media post. The top level field refer to the information for the post, such as votes specify how many upvotes. The comments sections hold a list of objects containing information about each comment as well as replies to comments, if any. 
+"""
+The static instructions and the user interests come first and the posts last, so
+that consecutive prompts share a prefix that providers can cache.
+"""
+
+POST_FORMAT = """The social media posts are given as JSON data holding simplified information. The top level fields refer to the post: title, text and votes, the number of upvotes. The comments field holds a list of objects containing the text and votes of each comment, as well as its replies, if any."""
+
+FILTER_PROMPT = (
+    """
+Your task is to detect whether the content of a social media post matches any of user interests. If so, reply with "Relevant". Else reply with "Not relevant".
+
+Wrap your final response (i.e. "Relevant" or "Not relevant") with <answer></answer> tag.
+
+"""
+    + POST_FORMAT
+    + """
+
+User interests:
+
+```
+{user_interests}
+```
 
 Post:
 
 {post}
+"""
+)
 
-Your task is to detect whether the content of the post matches any of user interests. If so, reply with "Relevant". Else reply with "Not relevant".
+BATCH_FILTER_PROMPT = (
+    """
+Your task is to detect, for each social media post below, whether the content of the post matches any of user interests. If so, the answer for the post is "Relevant". Else it is "Not relevant".
+
+Each post is wrapped in a <post id=""></post> tag. Answer every post in order, one per line. Wrap each answer (i.e. "Relevant" or "Not relevant") with an <answer id=""></answer> tag holding the id of the post, e.g. <answer id="1">Relevant</answer>.
+
+"""
+    + POST_FORMAT
+    + """
 
 User interests:
 
@@ -13,10 +43,14 @@ User interests:
 {user_interests}
 ```
 
-Wrap your final response (i.e. "Relevant" or "Not relevant") with <answer></answer> tag.
+Posts ({num_posts}):
+
+{posts}
 """
+)
 
-SUMMARIZE_PROMPT = """
+SUMMARIZE_PROMPT = (
+    """
 Summarize the following social media post contents and the overall responses accurately into a paragraph. Ensure that the summary captures the main points and tone of both the original post and the replies.
 
 Do not mention anything about the votes or specific users in the summary.
@@ -25,10 +59,15 @@ The summary needs both a title and a body.
 Wrap title in <title></title>.
 Wrap body in <body></body>.
 
-Post: 
+"""
+    + POST_FORMAT
+    + """
+
+Post:
 
 {post}
 
 Summary:
 
 """
+)
@@ -0,0 +1,138 @@
+"""
+Persistent store of the filter decisions and summaries of earlier runs.
+
+A post is keyed by its url, a hash of the user interests and a hash of its
+material content: the title, the text and the text of its top comments. Votes
+and replies are left out, so that a hot post seen again a few hours later reuses
+its result, while an edited post or one with a new top comment goes through the
+LLM again. The filter and summary models and a hash of the prompt templates are
+part of the key too, so that changing either does not reuse stale results.
+
+Only the decisions of the LLM are stored: a post rejected by the local
+pre-filter is scored again on the next run.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from typing import Annotated, Optional
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.cache import DiskCache
+from newsletter.logger import logger
+from newsletter.news.news import News
+from newsletter.news.prompts import BATCH_FILTER_PROMPT, FILTER_PROMPT, SUMMARIZE_PROMPT
+from newsletter.scraper.post import Post
+from newsletter.settings import settings
+
+PROMPTS_HASH = hashlib.sha256(
+    "\n".join([FILTER_PROMPT, BATCH_FILTER_PROMPT, SUMMARIZE_PROMPT]).encode("utf-8")
+).hexdigest()
+
+
+def get_default_result_cache() -> DiskCache:
+    return DiskCache(
+        folder=settings.storage.cache_folder / "results",
+        ttl=settings.cache.results_ttl,
+        max_entries=settings.cache.results_max_entries,
+    )
+
+
+def get_content_hash(post: Post, top_comments: int) -> str:
+    view = post.prompt_view()
+    material = {
+        "title": view.get("title"),
+        "text": view.get("text"),
+        "comments": [
+            comment.get("text") for comment in view.get("comments", [])[:top_comments]
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class PostResult(BaseModel):
+    relevant: bool
+    news: Annotated[Optional[News], Doc("Summary of a relevant post.")] = None
+
+
+class ResultStore(BaseModel):
+    cache: DiskCache = Field(default_factory=get_default_result_cache)
+    top_comments: Annotated[
+        int, Doc("Top comments whose text is part of the content hash.")
+    ] = 3
+    reused: int = 0
+    stored: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get_key(
+        self, post: Post, filter_model: list[str], summary_model: list[str]
+    ) -> str:
+        interests = settings.storage.get_user_interest_prompt() or ""
+        return json.dumps(
+            {
+                "url": post.url,
+                "interests": hashlib.sha256(interests.encode("utf-8")).hexdigest(),
+                "content": get_content_hash(post, top_comments=self.top_comments),
+                "filter_model": filter_model,
+                "summary_model": summary_model,
+                "prompts": PROMPTS_HASH,
+            },
+            sort_keys=True,
+        )
+
+    def get(
+        self, post: Post, filter_model: list[str], summary_model: list[str]
+    ) -> Optional[PostResult]:
+        if post.url is None:
+            return None
+        entry = self.cache.get(
+            self.get_key(post, filter_model=filter_model, summary_model=summary_model)
+        )
+        if entry is None:
+            return None
+
+        try:
+            result = PostResult.model_validate_json(entry.value)
+        except ValueError as e:
+            logger.warning(f"Dropping unreadable result of {post.url}: {e}")
+            return None
+
+        with self._lock:
+            self.reused += 1
+        logger.debug(f"Reusing the result of {post.url} from an earlier run")
+        return result
+
+    def set(
+        self,
+        post: Post,
+        result: PostResult,
+        filter_model: list[str],
+        summary_model: list[str],
+    ):
+        if post.url is None:
+            return
+        self.cache.set(
+            self.get_key(post, filter_model=filter_model, summary_model=summary_model),
+            result.model_dump_json(),
+        )
+        with self._lock:
+            self.stored += 1
+
+    def report(self):
+        if self.reused + self.stored > 0:
+            logger.info(
+                f"Result store: {self.reused} posts reused from earlier runs, "
+                f"{self.stored} new results stored"
+            )
+
+
+def get_default_result_store() -> Optional[ResultStore]:
+    if not settings.cache.results_enabled:
+        return None
+    return ResultStore(top_comments=settings.cache.results_top_comments)
@@ -1,28 +1,46 @@
+import asyncio
 import datetime
+import itertools
 import re
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional
+from typing import Annotated, Any, Callable, Generator, Iterable, Optional, TypeVar
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing_extensions import Doc
 
-from newsletter.llm.base import BaseLLM
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.concurrency import get_concurrency_limit
 from newsletter.llm.exception import (
     LLMRateLimitError,
     LLMServiceUnavailableError,
 )
+from newsletter.llm.health import HealthRegistry, health_registry
+from newsletter.llm.hedge import HedgeOptions, ahedged_generate, hedged_generate
+from newsletter.llm.metrics import MetricsSink, llm_call_context
+from newsletter.llm.tokens import estimate_tokens
 from newsletter.logger import logger
+from newsletter.news.budget import PromptBudget
 from newsletter.news.news import News, Newsletter
-from newsletter.news.prompts import FILTER_PROMPT, SUMMARIZE_PROMPT
+from newsletter.news.prefilter import RelevancePrefilter, get_default_prefilter
+from newsletter.news.prompts import BATCH_FILTER_PROMPT, FILTER_PROMPT, SUMMARIZE_PROMPT
+from newsletter.news.results import PostResult, ResultStore
+from newsletter.scraper.dedup import deduplicate_posts
 from newsletter.scraper.post import Post, PostList
 from newsletter.settings import settings
+from newsletter.utils import batched
 
 NOT_RELEVANT_WORD = "not relevant"
 RELEVANT_WORD = "relevant"
-answer_pattern = re.compile(r"<answer>(.*?)</answer>")
+# The closing tag is a stop sequence, which most providers leave out of the output
+answer_pattern = re.compile(r"<answer>(.*?)(?:</answer>|$)")
+batch_answer_pattern = re.compile(r'<answer id="(\d+)">(.*?)</answer>')
 title_pattern = re.compile(r"<title>(.*?)</title>")
 body_pattern = re.compile(r"<body>(.*?)</body>")
+FILTER_OPTIONS = LLMOptions(stop=["</answer>"])
+
+T = TypeVar("T")
 
 
 def extract_relevance(text):
@@ -39,6 +57,20 @@ def extract_relevance(text):
     return None
 
 
+def extract_batch_relevance(text: str, num_posts: int) -> dict[int, bool]:
+    """
+    Relevance of the posts of a batch, by index, for the answers that could be
+    parsed.
+    """
+    relevances = {}
+    for match in batch_answer_pattern.finditer(text):
+        idx = int(match.group(1)) - 1
+        content = match.group(2).strip().lower()
+        if 0 <= idx < num_posts and content in (NOT_RELEVANT_WORD, RELEVANT_WORD):
+            relevances[idx] = content == RELEVANT_WORD
+    return relevances
+
+
 def extract_summary(text) -> Optional[tuple[str, str]]:
     # Use the precompiled regex to find the text within the <title> and <body> tags
     match = title_pattern.search(text)
@@ -54,84 +86,744 @@ def extract_summary(text) -> Optional[tuple[str, str]]:
     return title, body
 
 
+def generate_default_newsletter_name() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+
+class LLMAttempt(BaseModel):
+    """
+    A call asked for by `Summarizer._retry`, made by `_run` or `_arun`.
+    """
+
+    stage: str
+    attempt: int
+    prompt: str
+    model_names: list[str]
+    is_valid: Callable[[str], bool]
+    options: Optional[LLMOptions] = None
+    stream: bool = False
+
+
+RetryPolicy = Generator[LLMAttempt | float, Any, Optional[T]]
+
+
 class Summarizer(BaseModel):
     llm: BaseLLM
+    max_workers: Annotated[
+        Optional[int],
+        Doc(
+            "Threads per stage. None sizes them to the platform's concurrency "
+            "ceiling and leaves the calls in flight to its controller."
+        ),
+    ] = None
+    max_async_concurrency: Annotated[
+        int, Doc("Concurrent LLM calls in the asyncio execution path.")
+    ] = Field(default=settings.llm_client.pool_size)
+    deduplicate: Annotated[
+        bool, Doc("Merge posts covering the same story before the LLM stages.")
+    ] = True
+    hedge: Annotated[
+        Optional[HedgeOptions],
+        Doc("Also send slow requests to the next model in the list. None disables."),
+    ] = None
+    health: Annotated[
+        Optional[HealthRegistry],
+        Doc("Models with an open circuit are tried last. None disables."),
+    ] = Field(default_factory=lambda: health_registry)
+    filter_batch_size: Annotated[
+        int, Doc("Posts filtered with a single prompt. 1 filters each post alone.")
+    ] = 1
+    prefilter: Annotated[
+        Optional[RelevancePrefilter],
+        Doc("Local similarity stage deciding clear cases without the LLM."),
+    ] = Field(default_factory=get_default_prefilter)
+    stream_filter: Annotated[
+        bool, Doc("Stream filter answers and stop reading once the answer is known.")
+    ] = True
+    results: Annotated[
+        Optional[ResultStore],
+        Doc(
+            "Reuses the results of posts unchanged since an earlier run. None disables."
+        ),
+    ] = None
+    metrics: Annotated[
+        MetricsSink, Doc("Collects the LLM calls, summarized into each Newsletter.")
+    ] = Field(default_factory=MetricsSink)
+    filter_budget: PromptBudget = Field(
+        default_factory=lambda: PromptBudget(
+            stage="filter",
+            max_tokens=settings.prompt_budget.filter_max_tokens,
+            min_comments=settings.prompt_budget.min_comments,
+        )
+    )
+    batch_filter_budget: PromptBudget = Field(
+        default_factory=lambda: PromptBudget(
+            stage="batch filter",
+            max_tokens=settings.prompt_budget.batch_filter_post_max_tokens,
+            min_comments=settings.prompt_budget.min_comments,
+        )
+    )
+    summary_budget: PromptBudget = Field(
+        default_factory=lambda: PromptBudget(
+            stage="summary",
+            max_tokens=settings.prompt_budget.summary_max_tokens,
+            min_comments=settings.prompt_budget.min_comments,
+        )
+    )
 
     def _format_filter_prompt(self, post: Post) -> str:
+        user_interests = settings.storage.get_user_interest_prompt()
+        reserved_tokens = estimate_tokens(
+            FILTER_PROMPT.format(post="", user_interests=user_interests)
+        )
         return FILTER_PROMPT.format(
-            post=post.model_dump_json(indent=2),
+            post=self.filter_budget.fit(
+                post,
+                serialize=Post.to_prompt,
+                reserved_tokens=reserved_tokens,
+            ),
+            user_interests=user_interests,
+        )
+
+    def _format_batch_filter_prompt(self, posts: list[Post]) -> str:
+        # Each post is fitted to its own budget
+        return BATCH_FILTER_PROMPT.format(
+            num_posts=len(posts),
+            posts="\n\n".join(
+                f'<post id="{idx}">\n'
+                + self.batch_filter_budget.fit(post, serialize=Post.to_prompt)
+                + "\n</post>"
+                for idx, post in enumerate(posts, start=1)
+            ),
             user_interests=settings.storage.get_user_interest_prompt(),
         )
 
     def _format_summary_prompt(self, post: Post) -> str:
+        reserved_tokens = estimate_tokens(SUMMARIZE_PROMPT.format(post=""))
         return SUMMARIZE_PROMPT.format(
-            post=post.model_dump_json(indent=2),
+            post=self.summary_budget.fit(
+                post,
+                serialize=Post.to_prompt,
+                reserved_tokens=reserved_tokens,
+            ),
         )
 
-    def filter_post(
-        self, post: Post, model_names: list[str], num_retries: int = 1
-    ) -> Optional[bool]:
-        model_index_to_use = 0
-        for _ in range(num_retries + 1):
-            prompt = self._format_filter_prompt(post=post)
+    def _read_stream(
+        self,
+        prompt: str,
+        model_name: str,
+        is_valid: Callable[[str], bool],
+        options: Optional[LLMOptions] = None,
+    ) -> str:
+        """
+        Read the streamed output only until it is valid, then close the stream.
+        """
+        output = ""
+        stream = self.llm.stream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            for chunk in stream:
+                output += chunk
+                if is_valid(output):
+                    break
+        finally:
+            stream.close()
+        return output
+
+    async def _aread_stream(
+        self,
+        prompt: str,
+        model_name: str,
+        is_valid: Callable[[str], bool],
+        options: Optional[LLMOptions] = None,
+    ) -> str:
+        output = ""
+        stream = self.llm.astream(prompt=prompt, model_name=model_name, options=options)
+        try:
+            async for chunk in stream:
+                output += chunk
+                if is_valid(output):
+                    break
+        finally:
+            await stream.aclose()
+        return output
+
+    def _generate(
+        self,
+        prompt: str,
+        model_names: list[str],
+        is_valid: Callable[[str], bool],
+        options: Optional[LLMOptions] = None,
+        stream: bool = False,
+    ) -> tuple[str, str]:
+        """
+        Calls the first model, hedging with the others if enabled. Returns the
+        name of the model that answered and its output.
+        """
+        if self.hedge is not None:
+            return hedged_generate(
+                llm=self.llm,
+                prompt=prompt,
+                model_names=model_names,
+                is_valid=is_valid,
+                options=options,
+                hedge=self.hedge,
+            )
+        if stream:
+            return model_names[0], self._read_stream(
+                prompt=prompt,
+                model_name=model_names[0],
+                is_valid=is_valid,
+                options=options,
+            )
+        return model_names[0], self.llm.generate(
+            prompt=prompt, model_name=model_names[0], options=options
+        )
+
+    async def _agenerate(
+        self,
+        prompt: str,
+        model_names: list[str],
+        is_valid: Callable[[str], bool],
+        options: Optional[LLMOptions] = None,
+        stream: bool = False,
+    ) -> tuple[str, str]:
+        if self.hedge is not None:
+            return await ahedged_generate(
+                llm=self.llm,
+                prompt=prompt,
+                model_names=model_names,
+                is_valid=is_valid,
+                options=options,
+                hedge=self.hedge,
+            )
+        if stream:
+            return model_names[0], await self._aread_stream(
+                prompt=prompt,
+                model_name=model_names[0],
+                is_valid=is_valid,
+                options=options,
+            )
+        return model_names[0], await self.llm.agenerate(
+            prompt=prompt, model_name=model_names[0], options=options
+        )
+
+    def _retry(
+        self,
+        stage: str,
+        task: str,
+        format_prompt: Callable[[], str],
+        parse: Callable[[str], Optional[T]],
+        model_names: list[str],
+        num_retries: int = 1,
+        options: Optional[LLMOptions] = None,
+        stream: bool = False,
+        is_valid: Optional[Callable[[str], bool]] = None,
+    ) -> RetryPolicy[T]:
+        """
+        Retry, rate-limit and fallback policy of the LLM stages, written once for
+        the sync and async paths. Yields the calls to make and the seconds to
+        wait, and receives the `(model, output)` of each call or its error. The
+        parsed output is returned, or None once every attempt failed.
+
+        `is_valid` tells when a streamed output is complete, by default once it
+        can be parsed.
+        """
+        if is_valid is None:
+
+            def is_valid(output: str) -> bool:
+                return parse(output) is not None
+
+        failed: set[str] = set()
+        failures, rate_limited = 0, 0
+        for attempt in itertools.count():
+            if failures > num_retries:
+                break
+            prompt = format_prompt()
+            # Once every model failed, start over from the preferred one
+            candidates = [name for name in model_names if name not in failed]
+            candidates = candidates or model_names
+            if self.health is not None:
+                candidates = self.health.order(candidates)
             try:
-                output = self.llm.generate(
-                    prompt=prompt, model_name=model_names[model_index_to_use]
+                used_model, output = yield LLMAttempt(
+                    stage=stage,
+                    attempt=attempt,
+                    prompt=prompt,
+                    model_names=candidates,
+                    is_valid=is_valid,
+                    options=options,
+                    stream=stream,
                 )
-                logger.debug(f"Filter llm output: {output}")
-                relevance = extract_relevance(output)
-                if relevance is None:
-                    logger.info("Failed to filter post. Retrying...")
-                    continue
-                return relevance
 
-            except LLMRateLimitError:
-                logger.info("Hitting rate limit error, waiting for 15 seconds.")
-                time.sleep(15)
+            except LLMRateLimitError as e:
+                # Not a failure of the model, retried on its own budget
+                if rate_limited >= settings.rate_limit.max_retries:
+                    logger.info(f"Still rate limited after {rate_limited} retries")
+                    break
+                delay = self._get_rate_limit_delay(e, rate_limited=rate_limited)
+                rate_limited += 1
+                logger.info(f"Hitting rate limit error, retrying in {delay:.1f}s")
+                yield delay
                 continue
 
-            except LLMServiceUnavailableError:
+            except LLMServiceUnavailableError as e:
+                # A hedged call tells which of the candidates were unavailable
+                unavailable = e.model_names or candidates[:1]
                 logger.info(
-                    f"LLM model {model_names[model_index_to_use]} unavailable (exception: {e}), using other LLM"
+                    f"LLM model {', '.join(unavailable)} unavailable (exception: {e}), using other LLM"
+                )
+                failures += 1
+                failed.update(unavailable)
+                yield self._get_fallback_delay(
+                    [name for name in model_names if name not in failed]
                 )
-                time.sleep(3)
-                model_index_to_use = min(model_index_to_use + 1, len(model_names) - 1)
                 continue
 
+            logger.debug(f"{stage.capitalize()} llm output: {output}")
+            result = parse(output)
+            if result is None:
+                logger.info(f"Failed to {task}. Retrying...")
+                self.llm.discard(prompt=prompt, model_name=used_model, options=options)
+                failures += 1
+                continue
+            return result
+
+        logger.info(f"All attempts to {task} failed, returning None")
         return None
 
+    def _run(self, policy: RetryPolicy[T]) -> Optional[T]:
+        """
+        Make the calls of a `_retry` policy with the blocking LLM methods.
+        """
+        try:
+            step = next(policy)
+            while True:
+                if not isinstance(step, LLMAttempt):
+                    time.sleep(step)
+                    step = policy.send(None)
+                    continue
+
+                try:
+                    with llm_call_context(
+                        stage=step.stage, retries=step.attempt, sink=self.metrics
+                    ):
+                        reply = self._generate(
+                            prompt=step.prompt,
+                            model_names=step.model_names,
+                            is_valid=step.is_valid,
+                            options=step.options,
+                            stream=step.stream,
+                        )
+                except (LLMRateLimitError, LLMServiceUnavailableError) as e:
+                    step = policy.throw(e)
+                else:
+                    step = policy.send(reply)
+
+        except StopIteration as stop:
+            return stop.value
+
+    async def _arun(self, policy: RetryPolicy[T]) -> Optional[T]:
+        """
+        Coroutine counterpart of `_run`.
+        """
+        try:
+            step = next(policy)
+            while True:
+                if not isinstance(step, LLMAttempt):
+                    await asyncio.sleep(step)
+                    step = policy.send(None)
+                    continue
+
+                try:
+                    with llm_call_context(
+                        stage=step.stage, retries=step.attempt, sink=self.metrics
+                    ):
+                        reply = await self._agenerate(
+                            prompt=step.prompt,
+                            model_names=step.model_names,
+                            is_valid=step.is_valid,
+                            options=step.options,
+                            stream=step.stream,
+                        )
+                except (LLMRateLimitError, LLMServiceUnavailableError) as e:
+                    step = policy.throw(e)
+                else:
+                    step = policy.send(reply)
+
+        except StopIteration as stop:
+            return stop.value
+
+    def _filter_policy(
+        self, post: Post, model_names: list[str], num_retries: int
+    ) -> RetryPolicy[bool]:
+        return self._retry(
+            stage="filter",
+            task="filter post",
+            format_prompt=lambda: self._format_filter_prompt(post=post),
+            parse=extract_relevance,
+            model_names=model_names,
+            num_retries=num_retries,
+            options=FILTER_OPTIONS,
+            stream=self.stream_filter,
+        )
+
+    def _batch_filter_policy(
+        self, posts: list[Post], model_names: list[str], num_retries: int
+    ) -> RetryPolicy[dict[int, bool]]:
+        prompt = self._format_batch_filter_prompt(posts=posts)
+        return self._retry(
+            stage="filter",
+            task="filter batch",
+            format_prompt=lambda: prompt,
+            parse=lambda output: extract_batch_relevance(output, len(posts)) or None,
+            model_names=model_names,
+            num_retries=num_retries,
+            stream=self.stream_filter,
+            # Keep reading until every post is answered
+            is_valid=lambda output: len(extract_batch_relevance(output, len(posts)))
+            == len(posts),
+        )
+
+    def _summary_policy(
+        self, post: Post, model_names: list[str], num_retries: int
+    ) -> RetryPolicy[News]:
+        def parse(output: str) -> Optional[News]:
+            result = extract_summary(output)
+            if result is None:
+                return None
+            return News(title=result[0], description=result[1], sources=post.sources)
+
+        return self._retry(
+            stage="summary",
+            task="summarize post",
+            format_prompt=lambda: self._format_summary_prompt(post=post),
+            parse=parse,
+            model_names=model_names,
+            num_retries=num_retries,
+        )
+
+    def _get_rate_limit_delay(
+        self, error: LLMRateLimitError, rate_limited: int
+    ) -> float:
+        """
+        Wait for the retry-after of the provider, or back off exponentially.
+        """
+        if error.retry_after is not None:
+            return min(error.retry_after, settings.rate_limit.max_retry_backoff)
+        return min(
+            settings.rate_limit.retry_backoff * 2**rate_limited,
+            settings.rate_limit.max_retry_backoff,
+        )
+
+    def _get_fallback_delay(self, model_names: list[str]) -> float:
+        # No need to wait when the health registry knows a fallback is healthy
+        if self.health is not None and any(
+            self.health.is_available(model_name) for model_name in model_names
+        ):
+            return 0
+        return 3
+
+    def filter_post(
+        self, post: Post, model_names: list[str], num_retries: int = 1
+    ) -> Optional[bool]:
+        return self._run(
+            self._filter_policy(
+                post=post, model_names=model_names, num_retries=num_retries
+            )
+        )
+
+    def filter_batch(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> dict[int, bool]:
+        """
+        Filter the posts with a single prompt. Returns the relevance of the posts
+        whose answer could be parsed, by index.
+        """
+        relevances = self._run(
+            self._batch_filter_policy(
+                posts=posts, model_names=model_names, num_retries=num_retries
+            )
+        )
+        return relevances or {}
+
+    def _prefilter(self, posts: list[Post]) -> list[Optional[bool]]:
+        if self.prefilter is None:
+            return [None] * len(posts)
+        return [self.prefilter.decide(post) for post in posts]
+
+    def _merge_decisions(
+        self, decisions: list[Optional[bool]], relevances: list[Optional[bool]]
+    ) -> list[Optional[bool]]:
+        """
+        Fill the posts the pre-filter left undecided with the LLM relevances.
+        """
+        relevances_iterator = iter(relevances)
+        return [
+            next(relevances_iterator) if decision is None else decision
+            for decision in decisions
+        ]
+
+    def filter_posts(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> list[Optional[bool]]:
+        """
+        Filter the posts the local pre-filter is unsure about with the LLM.
+        """
+        results, _ = self._filter_posts(
+            posts=posts, model_names=model_names, num_retries=num_retries
+        )
+        return results
+
+    def _filter_posts(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> tuple[list[Optional[bool]], list[Optional[bool]]]:
+        """
+        Same as `filter_posts`, also returning the pre-filter decisions, so that
+        the caller can tell the LLM decisions (left undecided there) apart.
+        """
+        decisions = self._prefilter(posts)
+        relevances = self._filter_posts_with_llm(
+            posts=[
+                post for post, decision in zip(posts, decisions) if decision is None
+            ],
+            model_names=model_names,
+            num_retries=num_retries,
+        )
+        return self._merge_decisions(decisions, relevances), decisions
+
+    def _filter_posts_with_llm(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> list[Optional[bool]]:
+        """
+        Filter the posts in one batched prompt, then filter the posts left without
+        a usable answer one by one.
+        """
+        if not posts:
+            return []
+
+        if len(posts) == 1:
+            return [
+                self.filter_post(
+                    post=posts[0], model_names=model_names, num_retries=num_retries
+                )
+            ]
+
+        relevances = self.filter_batch(
+            posts=posts, model_names=model_names, num_retries=num_retries
+        )
+        if len(relevances) < len(posts):
+            logger.info(
+                f"{len(posts) - len(relevances)} of {len(posts)} posts not answered "
+                "in batch, filtering them one by one"
+            )
+        return [
+            (
+                relevances[idx]
+                if idx in relevances
+                else self.filter_post(
+                    post=post, model_names=model_names, num_retries=num_retries
+                )
+            )
+            for idx, post in enumerate(posts)
+        ]
+
     def summarize_post(
         self, post: Post, model_name: list[str], num_retries: int = 1
     ) -> Optional[News]:
-        model_index_to_use = 0
-        for _ in range(num_retries + 1):
-            prompt = self._format_summary_prompt(post=post)
-            try:
-                output = self.llm.generate(
-                    prompt=prompt, model_name=model_name[model_index_to_use]
+        return self._run(
+            self._summary_policy(
+                post=post, model_names=model_name, num_retries=num_retries
+            )
+        )
+
+    def _reuse_results(
+        self, posts: list[Post], filter_model: list[str], summary_model: list[str]
+    ) -> tuple[list[Post], list[tuple[Post, News]]]:
+        """
+        Split the posts into those left to the LLM and the relevant ones unchanged
+        since an earlier run, with their summary. Irrelevant unchanged posts are
+        dropped.
+        """
+        if self.results is None:
+            return posts, []
+
+        new_posts, reused = [], []
+        for post in posts:
+            result = self.results.get(
+                post, filter_model=filter_model, summary_model=summary_model
+            )
+            if result is None:
+                new_posts.append(post)
+            elif result.news is not None:
+                reused.append((post, result.news))
+        return new_posts, reused
+
+    def _store_result(
+        self,
+        post: Post,
+        news: Optional[News],
+        filter_model: list[str],
+        summary_model: list[str],
+    ):
+        if self.results is not None:
+            self.results.set(
+                post,
+                PostResult(relevant=news is not None, news=news),
+                filter_model=filter_model,
+                summary_model=summary_model,
+            )
+
+    def _summarize_and_store(
+        self, post: Post, filter_model: list[str], summary_model: list[str]
+    ) -> Optional[News]:
+        news = self.summarize_post(post=post, model_name=summary_model)
+        if news is not None:
+            self._store_result(
+                post, news=news, filter_model=filter_model, summary_model=summary_model
+            )
+        return news
+
+    def _build_newsletter(
+        self, news_list: list[News], newsletter_name: str, metrics_start: int = 0
+    ) -> Newsletter:
+        metrics = self.metrics.summary(since=metrics_start)
+        if self.prefilter is not None:
+            self.prefilter.report()
+        if self.results is not None:
+            self.results.report()
+        logger.info(f"Newsletter {newsletter_name}: {metrics.report()}")
+        return Newsletter(
+            news=news_list,
+            name=newsletter_name,
+            created_at=datetime.datetime.now(),
+            path=Path(settings.storage.newsletter_folder) / f"{newsletter_name}.json",
+            metrics=metrics,
+        )
+
+    def _filter_then_summarize(
+        self,
+        posts: list[Post],
+        filter_model: list[str],
+        summary_model: list[str],
+        summary_executor: ThreadPoolExecutor,
+    ) -> list[tuple[Post, Future]]:
+        """
+        Filter the posts and hand the relevant ones straight to the summary stage.
+        """
+        posts, reused = self._reuse_results(
+            posts, filter_model=filter_model, summary_model=summary_model
+        )
+        summary_futures = []
+        for post, news in reused:
+            future = Future()
+            future.set_result(news)
+            summary_futures.append((post, future))
+
+        results, decisions = (
+            self._filter_posts(posts=posts, model_names=filter_model)
+            if posts
+            else ([], [])
+        )
+        for post, result, decision in zip(posts, results, decisions):
+            if result is None:
+                logger.debug(f"{post=} failed to get filter result. Skipping")
+
+            elif result is False:
+                # Pre-filter rejections are cheap to redo, and the pre-filter
+                # learns from every run, so only the LLM decisions are stored.
+                if decision is None:
+                    self._store_result(
+                        post,
+                        news=None,
+                        filter_model=filter_model,
+                        summary_model=summary_model,
+                    )
+
+            elif result is True:
+                summary_futures.append(
+                    (
+                        post,
+                        summary_executor.submit(
+                            self._summarize_and_store,
+                            post=post,
+                            filter_model=filter_model,
+                            summary_model=summary_model,
+                        ),
+                    )
                 )
-                result = extract_summary(output)
-                if result is None:
-                    logger.info("Failed to summarize post. Retrying...")
+
+        return summary_futures
+
+    def summarize_posts(
+        self,
+        posts: Iterable[Post],
+        filter_model: list[str],
+        summary_model: list[str],
+        newsletter_name: Optional[str] = None,
+    ) -> Newsletter:
+        """
+        Filter and summarize posts as a pipeline: each post is filtered as soon as
+        it is produced by `posts` (or its batch is full, see `filter_batch_size`)
+        and summarized as soon as it passes the filter.
+        """
+        newsletter_name = newsletter_name or generate_default_newsletter_name()
+        metrics_start = len(self.metrics)
+        if self.deduplicate:
+            posts = deduplicate_posts(posts)
+
+        max_workers = (
+            self.max_workers or get_concurrency_limit(self.llm.platform).max_concurrency
+        )
+        news_list = []
+        with ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as filter_executor, ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as summary_executor:
+            filter_futures = {
+                filter_executor.submit(
+                    self._filter_then_summarize,
+                    posts=batch,
+                    filter_model=filter_model,
+                    summary_model=summary_model,
+                    summary_executor=summary_executor,
+                ): batch
+                for batch in batched(posts, self.filter_batch_size)
+            }
+
+            summary_futures = {}
+            for future in as_completed(filter_futures):
+                if future.exception() is not None:
+                    logger.error(
+                        f"{filter_futures[future]} failed to get filter result due to exception {future.exception()}. Skipping"
+                    )
                     continue
 
-            except LLMRateLimitError:
-                logger.info("Hitting rate limit error, waiting for 15 seconds.")
-                time.sleep(15)
-                continue
+                for post, summary_future in future.result():
+                    summary_futures[summary_future] = post
 
-            except LLMServiceUnavailableError as e:
-                logger.info(
-                    f"LLM model {model_name[model_index_to_use]} unavailable (exception: {e}), using other LLM"
-                )
-                time.sleep(3)
-                model_index_to_use = min(model_index_to_use + 1, len(model_name) - 1)
-                continue
+            for future in as_completed(summary_futures):
+                if future.exception() is not None:
+                    logger.error(
+                        f"{summary_futures[future]} failed to get summary result due to exception {future.exception()}. Skipping"
+                    )
 
-            return News(title=result[0], description=result[1], sources=[post.url])
+                elif future.result() is not None:
+                    news = future.result()
+                    # Duplicates may have been merged after the summary started
+                    news.sources = summary_futures[future].sources
+                    news_list.append(news)
 
-        logger.info("All summarization attempts failed, returning None")
-        return None
+                else:
+                    logger.debug(
+                        f"{summary_futures[future]} failed to get summary result. Skipping"
+                    )
+
+        return self._build_newsletter(
+            news_list=news_list,
+            newsletter_name=newsletter_name,
+            metrics_start=metrics_start,
+        )
 
     def summarize_post_list(
         self,
@@ -140,66 +832,218 @@ class Summarizer(BaseModel):
         summary_model: list[str],
         newsletter_name: Optional[str] = None,
     ) -> Newsletter:
-        if newsletter_name is None:
-            newsletter_name = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-
-        filtered_post = []
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            future_results = {
-                executor.submit(
-                    self.filter_post, post=post, model_names=filter_model
-                ): post
-                for post in post_list.posts
-            }
+        return self.summarize_posts(
+            posts=post_list.posts,
+            filter_model=filter_model,
+            summary_model=summary_model,
+            newsletter_name=newsletter_name,
+        )
 
-            for future_result in as_completed(future_results):
-                if future_result.exception() is not None:
-                    logger.error(
-                        f"{future_results[future_result]} failed to get filter result due to exception {future_result.exception()}. Skipping"
+    async def afilter_post(
+        self, post: Post, model_names: list[str], num_retries: int = 1
+    ) -> Optional[bool]:
+        return await self._arun(
+            self._filter_policy(
+                post=post, model_names=model_names, num_retries=num_retries
+            )
+        )
+
+    async def afilter_batch(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> dict[int, bool]:
+        relevances = await self._arun(
+            self._batch_filter_policy(
+                posts=posts, model_names=model_names, num_retries=num_retries
+            )
+        )
+        return relevances or {}
+
+    async def afilter_posts(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> list[Optional[bool]]:
+        results, _ = await self._afilter_posts(
+            posts=posts, model_names=model_names, num_retries=num_retries
+        )
+        return results
+
+    async def _afilter_posts(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> tuple[list[Optional[bool]], list[Optional[bool]]]:
+        decisions = self._prefilter(posts)
+        relevances = await self._afilter_posts_with_llm(
+            posts=[
+                post for post, decision in zip(posts, decisions) if decision is None
+            ],
+            model_names=model_names,
+            num_retries=num_retries,
+        )
+        return self._merge_decisions(decisions, relevances), decisions
+
+    async def _afilter_posts_with_llm(
+        self, posts: list[Post], model_names: list[str], num_retries: int = 1
+    ) -> list[Optional[bool]]:
+        if not posts:
+            return []
+
+        if len(posts) == 1:
+            return [
+                await self.afilter_post(
+                    post=posts[0], model_names=model_names, num_retries=num_retries
+                )
+            ]
+
+        relevances = await self.afilter_batch(
+            posts=posts, model_names=model_names, num_retries=num_retries
+        )
+        if len(relevances) < len(posts):
+            logger.info(
+                f"{len(posts) - len(relevances)} of {len(posts)} posts not answered "
+                "in batch, filtering them one by one"
+            )
+        unanswered = [idx for idx in range(len(posts)) if idx not in relevances]
+        fallbacks = await asyncio.gather(
+            *(
+                self.afilter_post(
+                    post=posts[idx], model_names=model_names, num_retries=num_retries
+                )
+                for idx in unanswered
+            )
+        )
+        relevances.update(zip(unanswered, fallbacks))
+        return [relevances[idx] for idx in range(len(posts))]
+
+    async def asummarize_post(
+        self, post: Post, model_name: list[str], num_retries: int = 1
+    ) -> Optional[News]:
+        return await self._arun(
+            self._summary_policy(
+                post=post, model_names=model_name, num_retries=num_retries
+            )
+        )
+
+    async def _asummarize_with_semaphore(
+        self, post: Post, summary_model: list[str], semaphore: asyncio.Semaphore
+    ) -> Optional[News]:
+        async with semaphore:
+            return await self.asummarize_post(post=post, model_name=summary_model)
+
+    async def _afilter_then_summarize(
+        self,
+        posts: list[Post],
+        filter_model: list[str],
+        summary_model: list[str],
+        semaphore: asyncio.Semaphore,
+    ) -> list[tuple[Post, Optional[News] | BaseException]]:
+        """
+        Filter the posts and summarize the relevant ones. A failed summary is
+        returned as its exception, so that it does not fail the whole batch.
+        """
+        posts, reused = self._reuse_results(
+            posts, filter_model=filter_model, summary_model=summary_model
+        )
+        if posts:
+            async with semaphore:
+                results, decisions = await self._afilter_posts(
+                    posts=posts, model_names=filter_model
+                )
+        else:
+            results, decisions = [], []
+
+        relevant_posts = []
+        for post, result, decision in zip(posts, results, decisions):
+            if result is None:
+                logger.debug(f"{post=} failed to get filter result. Skipping")
+
+            elif result is False:
+                if decision is None:
+                    self._store_result(
+                        post,
+                        news=None,
+                        filter_model=filter_model,
+                        summary_model=summary_model,
                     )
 
-                else:
-                    result = future_result.result()
+            elif result is True:
+                relevant_posts.append(post)
 
-                    if result is None:
-                        logger.debug(
-                            f"{future_results[future_result]=} failed to get filter result. Skipping"
-                        )
+        summaries = await asyncio.gather(
+            *(
+                self._asummarize_with_semaphore(
+                    post=post, summary_model=summary_model, semaphore=semaphore
+                )
+                for post in relevant_posts
+            ),
+            return_exceptions=True,
+        )
+        for post, news in zip(relevant_posts, summaries):
+            if isinstance(news, News):
+                self._store_result(
+                    post,
+                    news=news,
+                    filter_model=filter_model,
+                    summary_model=summary_model,
+                )
+        return reused + list(zip(relevant_posts, summaries))
+
+    async def asummarize_posts(
+        self,
+        posts: Iterable[Post],
+        filter_model: list[str],
+        summary_model: list[str],
+        newsletter_name: Optional[str] = None,
+    ) -> Newsletter:
+        """
+        Asyncio counterpart of `summarize_posts`. LLM calls run as coroutines on
+        the event loop, so concurrency is not bound by the number of threads.
+        """
+        newsletter_name = newsletter_name or generate_default_newsletter_name()
+        metrics_start = len(self.metrics)
+        if self.deduplicate:
+            posts = deduplicate_posts(posts)
 
-                    elif result is True:
-                        filtered_post.append(future_results[future_result])
+        semaphore = asyncio.Semaphore(self.max_async_concurrency)
+        tasks: dict[asyncio.Task, list[Post]] = {}
+        batch_iterator = batched(posts, self.filter_batch_size)
+        while True:
+            # Producing a post may block on scraping, keep it off the event loop
+            batch = await asyncio.to_thread(next, batch_iterator, None)
+            if batch is None:
+                break
 
-                    elif result is not False:
-                        logger.debug(f"Unknown filter result {result=}, skipping")
+            task = asyncio.create_task(
+                self._afilter_then_summarize(
+                    posts=batch,
+                    filter_model=filter_model,
+                    summary_model=summary_model,
+                    semaphore=semaphore,
+                )
+            )
+            tasks[task] = batch
 
         news_list = []
+        for task, batch in tasks.items():
+            try:
+                results = await task
 
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            future_results = {
-                executor.submit(
-                    self.summarize_post, post=post, model_name=summary_model
-                ): post
-                for post in filtered_post
-            }
+            except Exception as e:
+                logger.error(
+                    f"{batch} failed to get filter result due to exception {e}. Skipping"
+                )
+                continue
 
-            for future in as_completed(future_results):
-                result = future.result()
-                if future.exception() is not None:
+            for post, news in results:
+                if isinstance(news, BaseException):
                     logger.error(
-                        f"{future.post} failed to get summary result due to exception {future.exception()}. Skipping"
+                        f"{post} failed to get summary result due to exception {news}. Skipping"
                     )
 
-                elif result is not None:
-                    news_list.append(result)
-
-                else:
-                    logger.debug(
-                        f"{future_results[future]} failed to get summary result. Skipping"
-                    )
+                elif news is not None:
+                    # Duplicates may have been merged after the summary started
+                    news.sources = post.sources
+                    news_list.append(news)
 
-        return Newsletter(
-            news=news_list,
-            name=newsletter_name,
-            created_at=datetime.datetime.now(),
-            path=Path(settings.storage.newsletter_folder) / f"{newsletter_name}.json",
+        return self._build_newsletter(
+            news_list=news_list,
+            newsletter_name=newsletter_name,
+            metrics_start=metrics_start,
         )
@@ -0,0 +1,146 @@
+"""
+Merge posts that cover the same story, so that each story goes through the LLM
+stages only once.
+
+Two posts are duplicates when they link to the same canonical URL, when one is a
+crosspost of the other (or both are crossposts of the same post), or when their
+text is nearly identical according to SimHash.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from typing import Annotated, Iterable, Iterator, Optional
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Doc
+
+from newsletter.logger import logger
+from newsletter.scraper.post import Post
+
+TRACKING_PARAMS = {"fbclid", "gclid", "igshid", "mc_cid", "mc_eid", "ref", "ref_src"}
+TRACKING_PREFIXES = ("utm_", "_guc")
+word_pattern = re.compile(r"\w+")
+
+
+def canonicalize_url(url: str) -> str:
+    parsed = urlparse(url.strip())
+    netloc = parsed.netloc.lower().removeprefix("www.")
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS
+        and not key.lower().startswith(TRACKING_PREFIXES)
+    )
+    path = parsed.path.rstrip("/") or "/"
+    # Scheme and fragment do not change the linked resource
+    return urlunparse(("", netloc, path, "", urlencode(query), ""))
+
+
+def get_post_text(post: Post) -> str:
+    texts = [post.title or ""]
+    if post.content is not None:
+        for content in post.content.contents:
+            # Text has `text`, Webpage has `content`
+            for attribute in ("text", "content"):
+                value = getattr(content, attribute, None)
+                if isinstance(value, str):
+                    texts.append(value)
+    return "\n".join(texts)
+
+
+def simhash(words: list[str], shingle_size: int = 3) -> int:
+    """
+    64-bit SimHash over word shingles.
+    """
+    weights = [0] * 64
+    for idx in range(max(len(words) - shingle_size + 1, 1)):
+        shingle = " ".join(words[idx : idx + shingle_size])
+        value = int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class PostDeduplicator(BaseModel):
+    max_distance: Annotated[
+        int, Doc("Maximum SimHash Hamming distance for near-duplicate text.")
+    ] = 3
+    min_words: Annotated[
+        int, Doc("Posts with fewer words are never compared by text.")
+    ] = 30
+    merged: int = 0
+    _keys: dict[str, Post] = PrivateAttr(default_factory=dict)
+    _fingerprints: list[tuple[int, Post]] = PrivateAttr(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _get_keys(self, post: Post) -> list[str]:
+        keys = []
+        if post.id is not None:
+            keys.append(f"id:{post.id}")
+        if post.crosspost_parent is not None:
+            keys.append(f"id:{post.crosspost_parent}")
+        if post.linked_url is not None:
+            keys.append(f"url:{canonicalize_url(post.linked_url)}")
+        return keys
+
+    def _find_near_duplicate(self, fingerprint: int) -> Optional[Post]:
+        for other_fingerprint, other in self._fingerprints:
+            if (fingerprint ^ other_fingerprint).bit_count() <= self.max_distance:
+                return other
+        return None
+
+    def add(self, post: Post) -> bool:
+        """
+        Register the post. Returns False if it was merged into an earlier post.
+        """
+        keys = self._get_keys(post)
+        words = word_pattern.findall(get_post_text(post).lower())
+        fingerprint = simhash(words) if len(words) >= self.min_words else None
+
+        with self._lock:
+            canonical = next(
+                (self._keys[key] for key in keys if key in self._keys), None
+            )
+            if canonical is None and fingerprint is not None:
+                canonical = self._find_near_duplicate(fingerprint)
+
+            if canonical is not None:
+                canonical.duplicate_urls = [
+                    *(canonical.duplicate_urls or []),
+                    *post.sources,
+                ]
+                for key in keys:
+                    self._keys.setdefault(key, canonical)
+                self.merged += 1
+                logger.debug(f"Merged duplicate post {post.url} into {canonical.url}")
+                return False
+
+            for key in keys:
+                self._keys[key] = post
+            if fingerprint is not None:
+                self._fingerprints.append((fingerprint, post))
+            return True
+
+
+def deduplicate_posts(
+    posts: Iterable[Post], deduplicator: Optional[PostDeduplicator] = None
+) -> Iterator[Post]:
+    """
+    Yield only the first post of every story. Later duplicates are merged into it.
+    """
+    if deduplicator is None:
+        deduplicator = PostDeduplicator()
+
+    for post in posts:
+        if deduplicator.add(post):
+            yield post
+
+    if deduplicator.merged > 0:
+        logger.info(f"Merged {deduplicator.merged} duplicate posts")
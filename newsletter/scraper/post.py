@@ -1,51 +1,126 @@
 """
 Common object for online posts.
 Support Reddit, X, and others.
+
+`prompt_view` gives the token-lean form of an object put into LLM prompts: text
+only, with short keys and without nulls, media, urls or timestamps.
 """
 
 from __future__ import annotations
 
 import abc
+import json
 from datetime import datetime
-from typing import Optional
+from typing import Annotated, Any, Literal, Optional, TypeAlias, Union
+from urllib.parse import urlparse
+
+from pydantic import BaseModel, Discriminator, Field, PrivateAttr, Tag
 
-from pydantic import BaseModel, Field, SerializeAsAny
+
+def compact(view: dict[str, Any]) -> dict[str, Any]:
+    """
+    Drop the null and empty fields of a prompt view.
+    """
+    return {key: value for key, value in view.items() if value not in (None, "", [])}
 
 
 class Content(BaseModel, abc.ABC):
-    pass
+    def prompt_view(self) -> Any:
+        """
+        Prompt form of the content, None when it holds no text.
+        """
+        return None
 
 
 class Video(Content):
+    type: Literal["video"] = "video"
     url: str
-    _type: str = "video"
 
 
 class Image(Content):
+    type: Literal["image"] = "image"
     url: str
-    _type: str = "image"
 
 
 class Text(Content):
+    type: Literal["text"] = "text"
     text: str
-    _type: str = "text"
+
+    def prompt_view(self) -> Any:
+        return self.text or None
 
 
 class Poll(Content):
-    _type: str = "poll"
+    type: Literal["poll"] = "poll"
     start_time: Optional[datetime] = None
     end_time: Optional[datetime] = None
     description: Optional[str] = None
     total_votes: int
     result: dict[str, int]  # A mapping from choice to votes.
 
+    def prompt_view(self) -> Any:
+        return compact({"poll": self.description, "votes": self.result})
+
+
+class Webpage(Content):
+    type: Literal["webpage"] = "webpage"
+    title: Optional[str] = None
+    content: Optional[str] = None  # TODO: Might need to support multimodal
+    created_time: Optional[datetime] = None
+    url: Optional[str] = None
+    authors: Optional[list[str]] = None
+
+    def prompt_view(self) -> Any:
+        return compact({"page": self.title, "text": self.content})
+
+
+def get_content_type(content: Any) -> Optional[str]:
+    """
+    Discriminator of `AnyContent`. Contents stored before they were tagged with
+    their `type` are told apart by their fields.
+    """
+    if not isinstance(content, dict):
+        return getattr(content, "type", None)
+    if "type" in content:
+        return content["type"]
+    if "text" in content:
+        return "text"
+    if "result" in content:
+        return "poll"
+    if set(content) == {"url"}:
+        url = urlparse(content["url"])
+        # Reddit videos are served from v.redd.it, images from i.redd.it
+        if url.netloc == "v.redd.it" or url.path.endswith(".mp4"):
+            return "video"
+        return "image"
+    return "webpage"
+
+
+# Tagged by `type`, so that stored posts are read back into the right class
+AnyContent: TypeAlias = Annotated[
+    Union[
+        Annotated[Text, Tag("text")],
+        Annotated[Image, Tag("image")],
+        Annotated[Video, Tag("video")],
+        Annotated[Poll, Tag("poll")],
+        Annotated[Webpage, Tag("webpage")],
+    ],
+    Discriminator(get_content_type),
+]
+
 
 class ForumContent(BaseModel):
-    contents: SerializeAsAny[list[Content]] = Field(default_factory=list)
+    contents: list[AnyContent] = Field(default_factory=list)
 
     def add(self, content: Content):
         self.contents.append(content)
 
+    def prompt_view(self) -> Any:
+        views = [view for view in (c.prompt_view() for c in self.contents) if view]
+        if all(isinstance(view, str) for view in views):
+            return "\n\n".join(views) or None
+        return views[0] if len(views) == 1 else views
+
 
 class Comment(BaseModel):
     author: Optional[str] = None
@@ -56,8 +131,22 @@ class Comment(BaseModel):
     url: Optional[str] = None
     comments: Optional[list[ForumContent]] = None
 
+    def prompt_view(self) -> Any:
+        return compact(
+            {
+                "text": self.content.prompt_view() if self.content else None,
+                "votes": self.upvotes,
+                "replies": [
+                    view
+                    for view in (reply.prompt_view() for reply in self.comments or [])
+                    if view
+                ],
+            }
+        )
+
 
 class Post(BaseModel):
+    id: Optional[str] = None
     title: Optional[str] = None
     content: Optional[ForumContent] = None
     upvotes: Optional[int] = None
@@ -65,12 +154,53 @@ class Post(BaseModel):
     author: Optional[str] = None
     created_utc: Optional[int] = None
     url: Optional[str] = None
+    linked_url: Optional[str] = None  # External link of the post, if any
+    crosspost_parent: Optional[str] = None  # Id of the original post, if crossposted
+    duplicate_urls: Optional[list[str]] = None  # Urls of merged duplicate posts
     comments: Optional[list[Comment]] = None
+    _prompt: Optional[str] = PrivateAttr(default=None)
+    # Prompts trimmed to a token budget, see `PromptBudget.fit`
+    _fitted: dict[tuple, str] = PrivateAttr(default_factory=dict)
+
+    def prompt_view(self) -> Any:
+        return compact(
+            {
+                "title": self.title,
+                "text": self.content.prompt_view() if self.content else None,
+                "votes": self.upvotes,
+                "comments": [
+                    view
+                    for view in (
+                        comment.prompt_view() for comment in self.comments or []
+                    )
+                    if view
+                ],
+            }
+        )
+
+    def to_prompt(self) -> str:
+        """
+        Compact JSON of the prompt view, computed once and reused by every stage
+        and retry. Call `clear_prompt` after changing the post.
+        """
+        if self._prompt is None:
+            self._prompt = json.dumps(
+                self.prompt_view(), ensure_ascii=False, separators=(",", ":")
+            )
+        return self._prompt
+
+    def clear_prompt(self):
+        self._prompt = None
+        self._fitted = {}
 
     @property
     def upvote_ratio(self) -> float:
         return self.upvotes / (self.upvotes + self.downvotes)
 
+    @property
+    def sources(self) -> list[str]:
+        return [self.url, *(self.duplicate_urls or [])]
+
 
 class PostList(BaseModel):
     source: str
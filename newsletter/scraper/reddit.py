@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, TypeAlias
+from queue import Queue
+from typing import Annotated, Iterator, Literal, Optional, TypeAlias
 from urllib.parse import urlparse
 
 import praw
-from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, TypeAdapter
+from typing_extensions import Doc
 
 from newsletter.logger import logger
 from newsletter.scraper.post import (
@@ -21,11 +25,16 @@ from newsletter.scraper.post import (
     Text,
     Video,
 )
+from newsletter.scraper.state import SourceState
+from newsletter.scraper.store import RawDataStore, raw_data_store
 from newsletter.scraper.webpage import scrape_webpage
 from newsletter.settings import settings
 
 Submission: TypeAlias = praw.models.reddit.submission.Submission
 RedditComment: TypeAlias = praw.models.reddit.comment.Comment
+CommentSort: TypeAlias = Literal[
+    "confidence", "controversial", "new", "old", "q&a", "top"
+]
 
 
 class Preference(BaseModel):
@@ -62,40 +71,100 @@ class PostFilter(BaseModel):
     recency: Optional[int] = None
 
     def to_accept(self, submission: Post) -> bool:
-        if self.upvotes is not None and submission.upvotes < self.upvotes:
+        return self._accepts(
+            upvotes=submission.upvotes,
+            upvote_ratio=submission.upvote_ratio,
+            created_utc=submission.created_utc,
+        )
+
+    def to_accept_submission(self, submission: Submission) -> bool:
+        """
+        Same checks as `to_accept`, but on the raw listing metadata so that
+        rejected submissions never have their comments or linked webpage fetched.
+        """
+        return self._accepts(
+            upvotes=submission.ups,
+            upvote_ratio=submission.upvote_ratio,
+            created_utc=submission.created_utc,
+        )
+
+    def _accepts(self, upvotes: int, upvote_ratio: float, created_utc: float) -> bool:
+        if self.upvotes is not None and upvotes < self.upvotes:
             return False
 
         if self.recency is not None:
-            age = (datetime.now() - datetime.fromtimestamp(submission.created_utc)).days
+            age = (datetime.now() - datetime.fromtimestamp(created_utc)).days
             if age > self.recency:
                 return False
 
-        if (
-            self.upvote_ratio is not None
-            and submission.upvote_ratio < self.upvote_ratio
-        ):
+        if self.upvote_ratio is not None and upvote_ratio < self.upvote_ratio:
             return False
 
         return True
 
 
+class ScrapeStats(BaseModel):
+    fetched: Annotated[int, Doc("Submissions returned by the listing.")] = 0
+    dropped_by_prefilter: Annotated[
+        int, Doc("Submissions rejected on listing metadata, before parsing.")
+    ] = 0
+    skipped_unchanged: Annotated[
+        int, Doc("Submissions already scraped and not materially changed.")
+    ] = 0
+    accepted: int = 0
+
+
 class RedditPostList(PostList):
     subreddit_name: str
-
-    def save(self, path: Path):
-        path.parent.mkdir(parents=True, exist_ok=True)
-        path.write_text(self.model_dump_json(indent=2), encoding="utf-8")
+    stats: Optional[ScrapeStats] = Field(default=None, exclude=True)
 
     @classmethod
     def from_path(cls, path: Path) -> RedditPostList:
+        """
+        Read a post list exported as JSON, e.g. a test fixture. Scraped posts are
+        persisted in the raw data store, see `from_store`.
+        """
         raw_text = path.read_text(encoding="utf-8")
         params = json.loads(raw_text)
         params["subreddit_name"] = path.parent.stem
         return RedditPostList(**params)
 
+    @classmethod
+    def from_store(
+        cls, run_id: str, subreddit_name: str, store: RawDataStore = raw_data_store
+    ) -> RedditPostList:
+        return RedditPostList(
+            source="reddit",
+            subreddit_name=subreddit_name,
+            posts=list(store.iter_posts(run_id=run_id, name=subreddit_name)),
+        )
+
+
+def get_submission_hash(submission: Submission) -> str:
+    raw = "\n".join([submission.title, submission.selftext, submission.url])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
 
 class RedditScraper(BaseModel):
     client: praw.Reddit = Field(default_factory=init_reddit_client)
+    max_concurrent_subreddits: int = Field(
+        default=settings.scraper.max_concurrent_subreddits
+    )
+    incremental: bool = Field(default=settings.scraper.incremental)
+    rescrape_score_change: Annotated[
+        float, Doc("Relative score change for a seen submission to be re-parsed.")
+    ] = 0.5
+    state_retention: Annotated[
+        float, Doc("Seconds a submission stays in the state after last being seen.")
+    ] = (7 * 24 * 60 * 60)
+    comment_limit: Annotated[int, Doc("Number of comments kept per post.")] = 10
+    comment_depth: Annotated[
+        int, Doc("Depth of the comment tree to fetch, 1 means top-level only.")
+    ] = 1
+    comment_sort: CommentSort = "top"
+    # States of the subreddits scraped since the last commit
+    _states: dict[str, SourceState] = PrivateAttr(default_factory=dict)
+    _states_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
 
     model_config = ConfigDict(
         arbitrary_types_allowed=True,
@@ -107,37 +176,159 @@ class RedditScraper(BaseModel):
         if isinstance(preferences, Preference):
             preferences = [preferences]
 
-        return {
-            preference.subreddit_name: self.scrape(
-                subreddit=preference.subreddit_name,
-                post_filter=preference.post_filter,
-                **kwargs,
-            )
-            for preference in preferences
-        }
+        if len(preferences) == 0:
+            return {}
+
+        max_workers = min(self.max_concurrent_subreddits, len(preferences))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                preference.subreddit_name: executor.submit(
+                    self.scrape,
+                    subreddit=preference.subreddit_name,
+                    post_filter=preference.post_filter,
+                    **kwargs,
+                )
+                for preference in preferences
+            }
+
+            # Keep the order of the preferences in the result
+            return {
+                subreddit_name: future.result()
+                for subreddit_name, future in futures.items()
+            }
+
+    def iter_scrape_with_preferences(
+        self, preferences: list[Preference] | Preference, **kwargs
+    ) -> Iterator[tuple[str, Post]]:
+        """
+        Like `scrape_with_preferences`, but yield `(subreddit_name, post)` as soon
+        as each post is parsed so that later stages can start right away.
+        """
+        if isinstance(preferences, Preference):
+            preferences = [preferences]
+
+        if len(preferences) == 0:
+            return
+
+        post_queue: Queue = Queue()
+
+        def scrape_to_queue(preference: Preference):
+            try:
+                for post in self.iter_scrape(
+                    subreddit=preference.subreddit_name,
+                    post_filter=preference.post_filter,
+                    **kwargs,
+                ):
+                    post_queue.put((preference.subreddit_name, post))
+            finally:
+                post_queue.put(None)
+
+        max_workers = min(self.max_concurrent_subreddits, len(preferences))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(scrape_to_queue, preference)
+                for preference in preferences
+            ]
+            remaining = len(futures)
+            while remaining > 0:
+                item = post_queue.get()
+                if item is None:
+                    remaining -= 1
+                    continue
+                yield item
+
+            # Surface scraping errors once every other subreddit is done
+            for future in futures:
+                future.result()
 
     def scrape(
         self, subreddit: str, post_filter: PostFilter = PostFilter(), **kwargs
     ) -> RedditPostList:
+        stats = ScrapeStats()
+        posts = list(
+            self.iter_scrape(
+                subreddit=subreddit, post_filter=post_filter, stats=stats, **kwargs
+            )
+        )
+        return RedditPostList(
+            source="reddit",
+            subreddit_name=subreddit,
+            posts=posts,
+            stats=stats,
+        )
+
+    def iter_scrape(
+        self,
+        subreddit: str,
+        post_filter: PostFilter = PostFilter(),
+        stats: Optional[ScrapeStats] = None,
+        **kwargs,
+    ) -> Iterator[Post]:
+        if stats is None:
+            stats = ScrapeStats()
+
         submission_list = self.client.subreddit(subreddit).hot(**kwargs)
         if submission_list is None:
             logger.warning(f"Failed to scrape subreddit {subreddit}")
-            return RedditPostList(source="reddit", subreddit_name=subreddit, posts=[])
+            return
+
+        state_folder = settings.storage.state_folder / "reddit"
+        state = SourceState.load(state_folder, subreddit) if self.incremental else None
 
         with ThreadPoolExecutor() as executor:
-            futures_to_submission = (
-                executor.submit(self._parse_submission_to_post, submission)
-                for submission in submission_list
-            )
-            submission_list = []
+            futures_to_submission = {}
+            for submission in submission_list:
+                stats.fetched += 1
+                # Cheap pre-filter on the listing metadata, parsing is the expensive part.
+                if not post_filter.to_accept_submission(submission):
+                    stats.dropped_by_prefilter += 1
+                    continue
+
+                if state is not None:
+                    state.touch(submission.id)
+                    if not state.is_changed(
+                        submission_id=submission.id,
+                        score=submission.score,
+                        content_hash=get_submission_hash(submission),
+                        score_change=self.rescrape_score_change,
+                    ):
+                        stats.skipped_unchanged += 1
+                        continue
+
+                future = executor.submit(self._parse_submission_to_post, submission)
+                futures_to_submission[future] = submission
+
             for future in as_completed(futures_to_submission):
-                submission_list.append(future.result())
-        filtered = filter(post_filter.to_accept, submission_list)
-        return RedditPostList(
-            source="reddit",
-            subreddit_name=subreddit,
-            posts=list(filtered),
-        )
+                post = future.result()
+                stats.accepted += 1
+                if state is not None:
+                    submission = futures_to_submission[future]
+                    state.stage(
+                        submission_id=submission.id,
+                        score=submission.score,
+                        content_hash=get_submission_hash(submission),
+                    )
+                yield post
+
+        if state is not None:
+            with self._states_lock:
+                self._states[subreddit] = state
+
+        logger.info(f"Scraped subreddit {subreddit}: {stats}")
+
+    def commit_state(self):
+        """
+        Save the incremental state of the subreddits scraped since the last call.
+        Call it once the posts of the run are persisted downstream.
+        """
+        with self._states_lock:
+            states, self._states = self._states, {}
+
+        state_folder = settings.storage.state_folder / "reddit"
+        for state in states.values():
+            state.commit()
+            state.prune(max_age=self.state_retention)
+            state.save(state_folder)
 
     def _parse_comments(self, comments: list[RedditComment]) -> list[Comment]:
         return list(
@@ -227,7 +418,20 @@ class RedditScraper(BaseModel):
 
         return content
 
+    def _bound_comment_fetch(self, subreddit_obj: Submission):
+        """
+        Ask Reddit for only the comments we keep, instead of the whole comment forest.
+        """
+        if getattr(subreddit_obj, "_fetched", False):
+            # Comments already loaded, nothing to save anymore
+            return
+
+        subreddit_obj.comment_sort = self.comment_sort
+        subreddit_obj.comment_limit = self.comment_limit
+        subreddit_obj.add_fetch_param("depth", self.comment_depth)
+
     def _parse_submission_to_post(self, subreddit_obj: Submission) -> Post:
+        self._bound_comment_fetch(subreddit_obj)
         truncated_comments = filter(
             lambda x: not isinstance(x, praw.models.MoreComments)
             and x.author is not None,
@@ -235,8 +439,9 @@ class RedditScraper(BaseModel):
         )
         truncated_comments = sorted(
             truncated_comments, key=lambda c: c.score, reverse=True
-        )[:10]
+        )[: self.comment_limit]
         post = Post(
+            id=subreddit_obj.name,
             author=subreddit_obj.author.name if subreddit_obj.author else None,
             comments=self._parse_comments(truncated_comments),
             content=self._parse_submission_content(subreddit_obj),
@@ -245,6 +450,8 @@ class RedditScraper(BaseModel):
             downvotes=int(subreddit_obj.ups * (1 / subreddit_obj.upvote_ratio - 1)),
             title=subreddit_obj.title,
             url=subreddit_obj.permalink,
+            linked_url=None if subreddit_obj.is_self else subreddit_obj.url,
+            crosspost_parent=getattr(subreddit_obj, "crosspost_parent", None),
         )
         # Clean post
         post.author = post.author.replace("’", "'")
@@ -0,0 +1,86 @@
+"""
+Persistent record of the submissions already scraped, used for incremental scraping.
+
+A parsed submission is only staged. It is marked as seen once the caller commits
+the state, after the run that used it completed, so that a run failing in a later
+stage parses it again. Unchanged submissions are skipped without being parsed
+and are never yielded, so an incremental run only contains the threads that are
+new or changed since an earlier run: a story already covered by an earlier
+newsletter does not appear in the next one.
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Annotated
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing_extensions import Doc
+
+
+class SeenSubmission(BaseModel):
+    score: Annotated[int, Doc("Score when the submission was last parsed.")]
+    content_hash: str
+    last_seen: float
+
+
+class SourceState(BaseModel):
+    name: str
+    submissions: dict[str, SeenSubmission] = Field(default_factory=dict)
+    _staged: dict[str, SeenSubmission] = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def load(cls, folder: Path, name: str) -> SourceState:
+        path = folder / f"{name}.json"
+        if not path.exists():
+            return cls(name=name)
+        return cls.model_validate_json(path.read_text(encoding="utf-8"))
+
+    def save(self, folder: Path):
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"{self.name}.json").write_text(
+            self.model_dump_json(), encoding="utf-8"
+        )
+
+    def is_changed(
+        self, submission_id: str, score: int, content_hash: str, score_change: float
+    ) -> bool:
+        """
+        Whether the submission is new, was edited, or its score moved by more
+        than `score_change` (relative) since it was last parsed.
+        """
+        seen = self.submissions.get(submission_id)
+        if seen is None or seen.content_hash != content_hash:
+            return True
+
+        return abs(score - seen.score) > score_change * max(seen.score, 1)
+
+    def touch(self, submission_id: str):
+        if submission_id in self.submissions:
+            self.submissions[submission_id].last_seen = time.time()
+
+    def mark(self, submission_id: str, score: int, content_hash: str):
+        self.submissions[submission_id] = SeenSubmission(
+            score=score, content_hash=content_hash, last_seen=time.time()
+        )
+
+    def stage(self, submission_id: str, score: int, content_hash: str):
+        """
+        Mark the submission on `commit`, once the run that parsed it completed.
+        """
+        self._staged[submission_id] = SeenSubmission(
+            score=score, content_hash=content_hash, last_seen=time.time()
+        )
+
+    def commit(self):
+        self.submissions.update(self._staged)
+        self._staged = {}
+
+    def prune(self, max_age: float):
+        now = time.time()
+        self.submissions = {
+            submission_id: seen
+            for submission_id, seen in self.submissions.items()
+            if now - seen.last_seen <= max_age
+        }
@@ -0,0 +1,104 @@
+"""
+Append-only store for raw scraped posts.
+
+Posts are written as gzip-compressed JSON lines, one segment per run and source
+(e.g. `<raw_data_folder>/<run_id>/<subreddit>.jsonl.gz`). Segments are never
+rewritten, so the history of every run is kept on disk.
+"""
+
+from __future__ import annotations
+
+import gzip
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, Optional
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+from newsletter.logger import logger
+from newsletter.scraper.post import Post
+from newsletter.settings import settings
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+
+
+class RawDataWriter:
+    def __init__(self, store: RawDataStore, run_id: str):
+        self.store = store
+        self.run_id = run_id
+        self._files: dict[str, IO[bytes]] = {}
+
+    def write(self, name: str, post: Post):
+        if name not in self._files:
+            path = self.store.segment_path(run_id=self.run_id, name=name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Appending adds a new gzip member, which readers handle transparently
+            self._files[name] = gzip.open(path, "ab", compresslevel=6)
+
+        self._files[name].write(post.model_dump_json(exclude_none=True).encode())
+        self._files[name].write(b"\n")
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+
+
+class RawDataStore(BaseModel):
+    folder: Path = Field(default=settings.storage.raw_data_folder)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def segment_path(self, run_id: str, name: str) -> Path:
+        return self.folder / run_id / f"{name}{SEGMENT_SUFFIX}"
+
+    @contextmanager
+    def writer(self, run_id: str) -> Iterator[RawDataWriter]:
+        writer = RawDataWriter(store=self, run_id=run_id)
+        try:
+            yield writer
+        finally:
+            writer.close()
+
+    def append(self, run_id: str, name: str, posts: list[Post]):
+        with self._lock, self.writer(run_id=run_id) as writer:
+            for post in posts:
+                writer.write(name=name, post=post)
+
+    def get_runs(self) -> list[str]:
+        if not self.folder.exists():
+            return []
+        return sorted(path.name for path in self.folder.iterdir() if path.is_dir())
+
+    def get_names(self, run_id: str) -> list[str]:
+        return sorted(
+            path.name.removesuffix(SEGMENT_SUFFIX)
+            for path in (self.folder / run_id).glob(f"*{SEGMENT_SUFFIX}")
+        )
+
+    def iter_posts(
+        self, run_id: Optional[str] = None, name: Optional[str] = None
+    ) -> Iterator[Post]:
+        """
+        Stream posts back from disk, optionally restricted to a run and/or source.
+        """
+        run_ids = [run_id] if run_id is not None else self.get_runs()
+        for current_run_id in run_ids:
+            names = [name] if name is not None else self.get_names(current_run_id)
+            for current_name in names:
+                path = self.segment_path(run_id=current_run_id, name=current_name)
+                if not path.exists():
+                    continue
+
+                try:
+                    with gzip.open(path, "rt", encoding="utf-8") as file:
+                        for line in file:
+                            if line.strip():
+                                yield Post.model_validate_json(line)
+
+                except (EOFError, gzip.BadGzipFile) as e:
+                    # Segment cut short by an interrupted run, keep what was read
+                    logger.warning(f"Truncated raw data segment {path}: {e}")
+
+
+raw_data_store = RawDataStore()
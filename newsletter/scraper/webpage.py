@@ -1,31 +1,171 @@
-from datetime import datetime
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
-from newspaper import Article
-from newspaper.configuration import Configuration
-
-from newsletter.scraper.post import Content
-
-
-class Webpage(Content):
-    _type: str = "webpage"
-    title: Optional[str] = None
-    content: Optional[str] = None  # TODO: Might need to support multimodal
-    created_time: Optional[datetime] = None
-    url: Optional[str] = None
-    authors: Optional[list[str]] = None
-
-
-def scrape_webpage(url: str) -> Webpage:
-    custom_config = Configuration()
-    custom_config.browser_user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36 Edg/128.0.0.0"
-    article = Article(url=url, config=custom_config)
-    article.download()
-    article.parse()
-    return Webpage(
-        title=article.title,
-        content=article.text,
-        created_time=article.publish_date,
-        url=article.url,
-        authors=article.authors,
+import requests
+from newspaper import network
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
+
+from newsletter.cache import DiskCache
+from newsletter.extraction import extract_article_worker, get_config
+from newsletter.logger import logger
+from newsletter.scraper.post import Webpage
+from newsletter.settings import settings
+
+
+class CachedWebpage(BaseModel):
+    webpage: Webpage
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+webpage_cache = DiskCache(
+    folder=settings.storage.cache_folder / "webpage",
+    ttl=settings.cache.webpage_ttl,
+    max_entries=settings.cache.webpage_max_entries,
+    max_size_bytes=settings.cache.webpage_max_size_bytes,
+)
+
+
+class ExtractionResult(BaseModel):
+    webpage: Webpage
+    worker_pid: int
+    elapsed: float
+
+
+class WorkerStats(BaseModel):
+    pages: int = 0
+    busy_seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Pages extracted per busy second."""
+        return self.pages / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+
+class ExtractionStats(BaseModel):
+    workers: dict[int, WorkerStats] = Field(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def record(self, result: ExtractionResult):
+        with self._lock:
+            worker = self.workers.setdefault(result.worker_pid, WorkerStats())
+            worker.pages += 1
+            worker.busy_seconds += result.elapsed
+
+    def report(self):
+        with self._lock:
+            for pid, worker in self.workers.items():
+                logger.info(
+                    f"Extraction worker {pid}: {worker.pages} pages, "
+                    f"{worker.throughput:.2f} pages/s"
+                )
+
+    def reset(self):
+        with self._lock:
+            self.workers = {}
+
+
+extraction_stats = ExtractionStats()
+_extraction_pool: Optional[ProcessPoolExecutor] = None
+_extraction_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Process pool shared by all scraping threads, so that parsing is not bound by
+    the GIL. Returns None when extraction runs in the calling thread.
+    """
+    global _extraction_pool
+    if settings.scraper.extraction_workers == 0:
+        return None
+
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(
+                max_workers=settings.scraper.extraction_workers,
+                # Forking a process that runs many threads is not safe
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _extraction_pool
+
+
+def extract_webpage_in_pool(url: str, html: str) -> Webpage:
+    pool = get_extraction_pool()
+    if pool is None:
+        fields, worker_pid, elapsed = extract_article_worker(url=url, html=html)
+    else:
+        # The worker returns plain fields, so that it never imports this package
+        fields, worker_pid, elapsed = pool.submit(
+            extract_article_worker, url, html
+        ).result()
+
+    result = ExtractionResult(
+        webpage=Webpage(**fields), worker_pid=worker_pid, elapsed=elapsed
     )
+    extraction_stats.record(result)
+    return result.webpage
+
+
+def scrape_webpage(url: str, cache: Optional[DiskCache] = webpage_cache) -> Webpage:
+    config = get_config()
+    cached = None
+    if cache is not None:
+        entry = cache.get(url, allow_stale=True)
+        if entry is not None:
+            try:
+                cached = CachedWebpage.model_validate_json(entry.value)
+            except ValidationError as e:
+                logger.warning(f"Dropping unreadable cached webpage {url}: {e}")
+                cache.delete(url)
+        if cached is not None and cache.is_fresh(entry):
+            logger.debug(f"Webpage cache hit for {url}")
+            return cached.webpage
+
+    headers = {"User-Agent": config.browser_user_agent}
+    if cached is not None:
+        # Stale entry, ask the server whether it changed
+        if cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    try:
+        response = requests.get(
+            url=url,
+            headers=headers,
+            timeout=config.request_timeout,
+            proxies=config.proxies,
+            allow_redirects=True,
+        )
+        if response.status_code != 304:
+            response.raise_for_status()
+
+    except requests.RequestException as e:
+        if cached is None:
+            raise
+        # A stale copy beats no page at all
+        logger.warning(f"Failed to revalidate {url} ({e}), using cached version")
+        return cached.webpage
+
+    if response.status_code == 304 and cached is not None:
+        logger.debug(f"Webpage {url} not modified, reusing cached version")
+        cache.set(url, cached.model_dump_json())
+        return cached.webpage
+
+    response.raise_for_status()
+    html = network.get_html_2XX_only(url, config, response)
+    webpage = extract_webpage_in_pool(url=url, html=html)
+
+    if cache is not None:
+        cache.set(
+            url,
+            CachedWebpage(
+                webpage=webpage,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            ).model_dump_json(),
+        )
+
+    return webpage
@@ -1,7 +1,7 @@
 from pathlib import Path
 from typing import Annotated, Literal, Optional, TypeAlias, get_args
 
-from pydantic import BaseModel, SecretStr
+from pydantic import BaseModel, PrivateAttr, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing_extensions import Doc
 
@@ -40,20 +40,211 @@ class StorageSettings(BaseModel):
     preferences_folder: Annotated[Path, Doc("Folder where preferences are stored.")] = (
         Path("./data/preferences/")
     )
+    cache_folder: Annotated[Path, Doc("Folder where caches are stored.")] = Path(
+        "./data/cache/"
+    )
+    state_folder: Annotated[
+        Path, Doc("Folder where incremental scraping state is stored.")
+    ] = Path("./data/state/")
+    metrics_folder: Annotated[
+        Path, Doc("Folder where per-run LLM call metrics are exported.")
+    ] = Path("./data/metrics/")
+    # Interest prompt with the modification time and size it was read at
+    _interest_cache: Optional[tuple[int, int, str]] = PrivateAttr(default=None)
 
     @property
     def interest_file(self) -> Path:
         return self.preferences_folder / "interest.txt"
 
     def get_user_interest_prompt(self) -> Optional[str]:
-        if self.interest_file.exists():
-            return self.interest_file.read_text()
-
-        else:
+        """
+        Read once and kept in memory until the file changes on disk.
+        """
+        try:
+            stat = self.interest_file.stat()
+        except FileNotFoundError:
             return None
 
+        cache = self._interest_cache
+        if cache is None or cache[:2] != (stat.st_mtime_ns, stat.st_size):
+            cache = (stat.st_mtime_ns, stat.st_size, self.interest_file.read_text())
+            self._interest_cache = cache
+        return cache[2]
+
     def save_user_interest_prompt(self, new_text: str) -> None:
         self.interest_file.write_text(new_text)
+        self._interest_cache = None
+
+
+class ScraperSettings(BaseModel):
+    max_concurrent_subreddits: Annotated[
+        int, Doc("Maximum number of subreddits scraped at the same time.")
+    ] = 4
+    incremental: Annotated[
+        bool,
+        Doc(
+            "Only parse submissions that are new or materially changed since an "
+            "earlier run. The newsletter then only contains those threads, "
+            "stories covered by an earlier newsletter are left out."
+        ),
+    ] = False
+    extraction_workers: Annotated[
+        Optional[int],
+        Doc(
+            "Processes used to parse webpages. None uses every core, 0 parses in the scraping thread."
+        ),
+    ] = None
+
+
+class CacheSettings(BaseModel):
+    webpage_ttl: Annotated[
+        Optional[float],
+        Doc("Seconds a cached webpage is used before being revalidated."),
+    ] = (
+        6 * 60 * 60
+    )
+    webpage_max_entries: Annotated[
+        Optional[int], Doc("Maximum number of cached webpages.")
+    ] = 5000
+    webpage_max_size_bytes: Annotated[
+        Optional[int], Doc("Maximum size of the webpage cache on disk.")
+    ] = (200 * 1024 * 1024)
+    llm_enabled: Annotated[bool, Doc("Reuse responses for identical prompts.")] = True
+    llm_ttl: Annotated[
+        Optional[float], Doc("Seconds a cached LLM response is reused.")
+    ] = (7 * 24 * 60 * 60)
+    llm_max_entries: Annotated[
+        Optional[int], Doc("Maximum number of cached LLM responses.")
+    ] = 20000
+    llm_max_size_bytes: Annotated[
+        Optional[int], Doc("Maximum size of the LLM response cache on disk.")
+    ] = (100 * 1024 * 1024)
+    results_enabled: Annotated[
+        bool, Doc("Reuse the filter decisions and summaries of unchanged posts.")
+    ] = True
+    results_ttl: Annotated[
+        Optional[float], Doc("Seconds the result of a post is reused.")
+    ] = (3 * 24 * 60 * 60)
+    results_max_entries: Annotated[
+        Optional[int], Doc("Maximum number of stored post results.")
+    ] = 20000
+    results_top_comments: Annotated[
+        int, Doc("Top comments whose change makes a post go through the LLM again.")
+    ] = 3
+
+
+class RateLimit(BaseModel):
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+class RateLimitSettings(BaseModel):
+    enabled: Annotated[bool, Doc("Pace LLM calls to stay under rate limits.")] = True
+    default: Annotated[
+        RateLimit, Doc("Starting limit, refined from provider response headers.")
+    ] = RateLimit(requests_per_minute=600)
+    overrides: Annotated[
+        dict[str, RateLimit],
+        Doc('Limits keyed by "<platform>" or "<platform>/<model>".'),
+    ] = {}
+    max_retries: Annotated[
+        int,
+        Doc("Retries of a rate limited request, not counted as failed attempts."),
+    ] = 5
+    retry_backoff: Annotated[
+        float,
+        Doc("Wait before the first of them without a retry-after, then doubled."),
+    ] = 2.0
+    max_retry_backoff: Annotated[
+        float, Doc("Longest wait before retrying a rate limited request.")
+    ] = 60.0
+
+
+class PromptBudgetSettings(BaseModel):
+    filter_max_tokens: Annotated[
+        int, Doc("Token budget of a filter prompt, posts are trimmed to fit.")
+    ] = 4000
+    summary_max_tokens: Annotated[
+        int, Doc("Token budget of a summary prompt, posts are trimmed to fit.")
+    ] = 8000
+    min_comments: Annotated[
+        int, Doc("Comments kept while webpage contents are still being trimmed.")
+    ] = 3
+    batch_filter_post_max_tokens: Annotated[
+        int, Doc("Token budget of each post in a batched filter prompt.")
+    ] = 1000
+
+
+class PrefilterSettings(BaseModel):
+    enabled: Annotated[
+        bool, Doc("Score posts locally against the user interests before the LLM.")
+    ] = False
+    reject_below: Annotated[
+        float, Doc("Similarity under which a post is rejected without the LLM.")
+    ] = 0.01
+    accept_above: Annotated[
+        Optional[float],
+        Doc("Similarity over which a post is accepted without the LLM."),
+    ] = 0.4
+    seed_posts: Annotated[
+        int,
+        Doc("Posts of earlier runs the document frequencies are counted over."),
+    ] = 2000
+
+
+class LLMClientSettings(BaseModel):
+    pool_size: Annotated[
+        int,
+        Doc("Connections kept per LLM platform, also the async LLM concurrency."),
+    ] = 64
+    max_retries: Annotated[
+        Optional[int],
+        Doc("Retries done inside the provider SDKs. None keeps the SDK default."),
+    ] = None
+    base_urls: Annotated[
+        dict[str, str],
+        Doc("API endpoint overrides keyed by platform, e.g. for the mock server."),
+    ] = {}
+
+
+class ConcurrencyLimit(BaseModel):
+    min_concurrency: Annotated[int, Doc("Floor of the LLM calls in flight.")] = 1
+    max_concurrency: Annotated[int, Doc("Ceiling of the LLM calls in flight.")] = 32
+    initial_concurrency: Annotated[int, Doc("LLM calls in flight at start.")] = 4
+
+
+class ConcurrencySettings(BaseModel):
+    enabled: Annotated[
+        bool, Doc("Adapt the LLM calls in flight to the latency and errors.")
+    ] = True
+    default: ConcurrencyLimit = ConcurrencyLimit()
+    overrides: Annotated[
+        dict[str, ConcurrencyLimit], Doc("Limits keyed by platform.")
+    ] = {}
+    backoff: Annotated[
+        float, Doc("Factor applied to the limit on rate limits or rising latency.")
+    ] = 0.5
+    latency_tolerance: Annotated[
+        float, Doc("Recent over usual latency ratio that lowers the limit.")
+    ] = 2.0
+
+
+class ModelPricing(BaseModel):
+    input_per_million: Annotated[float, Doc("USD per million prompt tokens.")]
+    output_per_million: Annotated[float, Doc("USD per million completion tokens.")]
+    cached_input_per_million: Annotated[
+        Optional[float],
+        Doc(
+            "USD per million prompt tokens from the prefix cache, None if no discount."
+        ),
+    ] = None
+
+
+class MetricsSettings(BaseModel):
+    pricing: Annotated[
+        dict[str, ModelPricing],
+        Doc('Prices keyed by "<platform>/<model>" or "<model>", over the defaults.'),
+    ] = {}
 
 
 class AppSettings(BaseSettings):
@@ -62,6 +253,14 @@ class AppSettings(BaseSettings):
     fireworks_api_key: Optional[SecretStr] = None
     reddit: Optional[RedditCredentials] = None
     storage: StorageSettings = StorageSettings()
+    scraper: ScraperSettings = ScraperSettings()
+    cache: CacheSettings = CacheSettings()
+    rate_limit: RateLimitSettings = RateLimitSettings()
+    prompt_budget: PromptBudgetSettings = PromptBudgetSettings()
+    prefilter: PrefilterSettings = PrefilterSettings()
+    llm_client: LLMClientSettings = LLMClientSettings()
+    concurrency: ConcurrencySettings = ConcurrencySettings()
+    metrics: MetricsSettings = MetricsSettings()
 
     model_config = SettingsConfigDict(
         env_nested_delimiter="__", case_sensitive=False, env_file=".env"
@@ -71,6 +270,9 @@ class AppSettings(BaseSettings):
         self.storage.raw_data_folder.mkdir(parents=True, exist_ok=True)
         self.storage.newsletter_folder.mkdir(parents=True, exist_ok=True)
         self.storage.preferences_folder.mkdir(parents=True, exist_ok=True)
+        self.storage.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.storage.state_folder.mkdir(parents=True, exist_ok=True)
+        self.storage.metrics_folder.mkdir(parents=True, exist_ok=True)
 
         # Initialize the preference files
         self.storage.interest_file.touch(exist_ok=True)
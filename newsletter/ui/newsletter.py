@@ -3,12 +3,18 @@ import datetime
 import streamlit as st
 from loguru import logger
 
+from newsletter.llm.cache import wrap_with_cache
+from newsletter.llm.clients import run_async
+from newsletter.llm.concurrency import adapt_concurrency
 from newsletter.llm.fireworks_ai import FireworksAI
+from newsletter.llm.health import track_health
+from newsletter.llm.metrics import track_metrics
 from newsletter.llm.openai import OpenAILLM
 from newsletter.llm.together_llm import Model, TogetherLLM
+from newsletter.news.generate import stream_reddit_posts
 from newsletter.news.news import News, Newsletter, get_newsletters
+from newsletter.news.results import get_default_result_store
 from newsletter.news.summarize import Summarizer
-from newsletter.scraper.post import PostList
 from newsletter.scraper.reddit import load_reddit_preferences, reddit_scraper
 from newsletter.settings import LLMPlatform, settings
 from newsletter.ui.utils import (
@@ -48,40 +54,40 @@ def render_generate_newsletter():
             summary_models = task["summary_model"]
 
             preferences = load_reddit_preferences()
-            st.write("Scraping data...")
-            res = reddit_scraper.scrape_with_preferences(preferences=preferences)
-
-            all_post_list = []
-            for subreddit_name, post_list in res.items():
-                filepath = settings.storage.raw_data_folder / f"{subreddit_name}.json"
-                post_list.save(filepath)
-                all_post_list.append(post_list)
-
-            st.write("Scraping completed.")
-            st.write("Summarizing data...")
             match platform:
                 case "Fireworks AI":
-                    summarizer = Summarizer(llm=FireworksAI())
+                    llm = FireworksAI()
 
                 case "Together AI":
-                    summarizer = Summarizer(llm=TogetherLLM())
+                    llm = TogetherLLM()
 
                 case "OpenAI":
-                    summarizer = Summarizer(llm=OpenAILLM())
+                    llm = OpenAILLM()
 
-            aggregated_post_list = PostList.from_post_lists(
-                source="aggregated",
-                post_lists=all_post_list,
+            summarizer = Summarizer(
+                llm=track_metrics(
+                    wrap_with_cache(adapt_concurrency(track_health(llm)))
+                ),
+                results=get_default_result_store(),
             )
-            summary = summarizer.summarize_post_list(
-                post_list=aggregated_post_list,
-                summary_model=summary_models,
-                filter_model=filter_models,
-                newsletter_name=name,
+
+            st.write("Scraping and summarizing data...")
+            # Posts are filtered and summarized while the remaining ones are scraped
+            summary = run_async(
+                summarizer.asummarize_posts(
+                    posts=stream_reddit_posts(preferences=preferences, run_id=name),
+                    summary_model=summary_models,
+                    filter_model=filter_models,
+                    newsletter_name=name,
+                )
             )
             summary.save()
+            reddit_scraper.commit_state()
+            summarizer.metrics.export_jsonl(
+                settings.storage.metrics_folder / f"{name}.jsonl"
+            )
 
-            st.write("Summarizing completed.")
+            st.write("Scraping and summarizing completed.")
 
         except Exception as e:
             logger.exception(e)
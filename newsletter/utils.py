@@ -1,6 +1,9 @@
+import itertools
 import time
 from contextlib import contextmanager
-from typing import Optional
+from typing import Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
 
 
 @contextmanager
@@ -12,3 +15,12 @@ def timer(message: Optional[str] = None):
     end_time = time.perf_counter()
     elapsed_time = end_time - start_time
     print(f"{elapsed_time:.3f} seconds")
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    """
+    Split `iterable` in lists of `size` items, the last one may be shorter.
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
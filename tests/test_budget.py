@@ -0,0 +1,75 @@
+from newsletter.llm.tokens import estimate_tokens, truncate_to_tokens
+from newsletter.news.budget import PromptBudget
+from newsletter.scraper.post import Comment, ForumContent, Post, Text
+from newsletter.scraper.webpage import Webpage
+
+
+def serialize(post: Post) -> str:
+    return post.model_dump_json(indent=2)
+
+
+def make_post() -> Post:
+    comments = [
+        Comment(
+            content=ForumContent(contents=[Text(text=f"comment {idx} " * 20)]),
+            comments=[ForumContent(contents=[Text(text="reply " * 20)])],
+        )
+        for idx in range(10)
+    ]
+    return Post(
+        title="A long article",
+        url="https://reddit.com/r/test/1",
+        content=ForumContent(
+            contents=[
+                Text(text="Post body"),
+                Webpage(content="The article goes on and on. " * 2000),
+            ]
+        ),
+        comments=comments,
+    )
+
+
+def test_truncate_to_tokens():
+    text = "The quick brown fox jumps over the lazy dog. " * 10
+    truncated = truncate_to_tokens(text, 20)
+    assert estimate_tokens(truncated) <= 20
+    assert text.startswith(truncated)
+    assert truncate_to_tokens(text, 10_000) == text
+
+
+def test_prompt_budget():
+    post = make_post()
+    budget = PromptBudget(stage="test", max_tokens=1000, min_comments=3)
+
+    text = budget.fit(post, serialize=serialize, reserved_tokens=200)
+    assert estimate_tokens(text) <= 800
+    assert budget.hits == 1
+    # Comments are kept ahead of the article, the post itself is left untouched
+    assert text.count("comment 0") > 0
+    assert "Post body" in text
+    assert len(post.comments) == 10
+
+    assert budget.fit(post, serialize=serialize, reserved_tokens=-100_000) == (
+        serialize(post)
+    )
+    assert budget.hits == 1
+
+
+def test_prompt_budget_memoized_view():
+    post = make_post()
+    budget = PromptBudget(stage="test", max_tokens=1000, min_comments=3)
+
+    full = post.to_prompt()
+    assert "https://" not in full and "null" not in full
+    assert post.to_prompt() is full
+    # Trimming works on a copy, whose view is serialized again
+    text = budget.fit(post, serialize=Post.to_prompt)
+    assert estimate_tokens(text) <= 1000
+    assert post.to_prompt() is full
+
+    # Retries reuse the trimmed text until the post changes
+    assert budget.fit(post, serialize=Post.to_prompt) is text
+    assert budget.hits == 1
+    post.clear_prompt()
+    assert budget.fit(post, serialize=Post.to_prompt) == text
+    assert budget.hits == 2
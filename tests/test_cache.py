@@ -0,0 +1,47 @@
+import os
+import time
+
+import pytest
+
+from newsletter.cache import DiskCache
+
+
+@pytest.fixture
+def mock_cache(tmp_path) -> DiskCache:
+    return DiskCache(folder=tmp_path, ttl=60, max_entries=2)
+
+
+def test_cache_ttl(mock_cache):
+    mock_cache.set("key", "value")
+    assert mock_cache.get("key").value == "value"
+
+    mock_cache.ttl = 0
+    time.sleep(0.01)
+    assert mock_cache.get("key") is None
+    assert mock_cache.get("key", allow_stale=True).value == "value"
+
+
+def test_cache_lru_eviction(mock_cache):
+    mock_cache.set("a", "1")
+    mock_cache.set("b", "2")
+    # Make "a" the least recently used entry
+    os.utime(mock_cache._path("a"), (0, 0))
+    mock_cache.set("c", "3")
+
+    assert mock_cache.get("a") is None
+    assert mock_cache.get("b").value == "2"
+    assert mock_cache.get("c").value == "3"
+
+
+def test_cache_amortized_eviction(tmp_path, monkeypatch):
+    cache = DiskCache(folder=tmp_path, max_entries=10)
+    scans = []
+    evict = DiskCache.evict
+    monkeypatch.setattr(DiskCache, "evict", lambda self: scans.append(1) or evict(self))
+
+    for idx in range(30):
+        cache.set(str(idx), "value")
+    assert len(list(tmp_path.glob("*.json"))) <= 10
+    # The first scan, then one per overflow, each trimming to 9 entries
+    assert len(scans) < 15
+    assert cache.get("29").value == "value"
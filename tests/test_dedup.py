@@ -0,0 +1,39 @@
+from newsletter.scraper.dedup import (
+    PostDeduplicator,
+    canonicalize_url,
+    deduplicate_posts,
+)
+from newsletter.scraper.post import ForumContent, Post, Text
+
+
+def test_canonicalize_url():
+    assert canonicalize_url(
+        "https://www.example.com/news/story/?utm_source=reddit&id=3#comments"
+    ) == canonicalize_url("http://example.com/news/story?id=3")
+
+
+def test_deduplicate_posts():
+    article = " ".join(f"word{i}" for i in range(100))
+    posts = [
+        Post(id="t3_a", url="/r/a/1", linked_url="https://example.com/story"),
+        Post(id="t3_b", url="/r/b/2", linked_url="https://www.example.com/story/"),
+        Post(id="t3_c", url="/r/c/3", crosspost_parent="t3_a"),
+        Post(
+            id="t3_d",
+            url="/r/d/4",
+            content=ForumContent(contents=[Text(text=article)]),
+        ),
+        Post(
+            id="t3_e",
+            url="/r/e/5",
+            content=ForumContent(contents=[Text(text=article + " extra")]),
+        ),
+        Post(id="t3_f", url="/r/f/6", title="Unrelated"),
+    ]
+    deduplicator = PostDeduplicator()
+    result = list(deduplicate_posts(posts, deduplicator=deduplicator))
+
+    assert [post.id for post in result] == ["t3_a", "t3_d", "t3_f"]
+    assert result[0].sources == ["/r/a/1", "/r/b/2", "/r/c/3"]
+    assert result[1].sources == ["/r/d/4", "/r/e/5"]
+    assert deduplicator.merged == 3
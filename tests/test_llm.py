@@ -1,9 +1,35 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
 import pytest
+from pydantic import Field
+from together.constants import MAX_CONNECTION_RETRIES
 
+from newsletter.cache import DiskCache
 from newsletter.llm import TogetherLLM
-from newsletter.llm.base import LLMOptions
+from newsletter.llm.base import BaseLLM, LLMOptions
+from newsletter.llm.cache import CachedLLM
+from newsletter.llm.clients import run_async
+from newsletter.llm.concurrency import AdaptiveConcurrencyLLM, AIMDController
+from newsletter.llm.exception import LLMRateLimitError, LLMServiceUnavailableError
 from newsletter.llm.fireworks_ai import FireworksAI
+from newsletter.llm.health import HealthRegistry, HealthTrackedLLM
+from newsletter.llm.hedge import (
+    HedgeOptions,
+    LatencyTracker,
+    ahedged_generate,
+    hedged_generate,
+)
+from newsletter.llm.metrics import (
+    MetricsLLM,
+    MetricsSink,
+    llm_call_context,
+    report_usage,
+)
 from newsletter.llm.openai import OpenAILLM
+from newsletter.llm.rate_limit import RateLimiter, TokenBucket
+from newsletter.llm.together_llm import get_requests_session
 
 
 @pytest.fixture
@@ -42,3 +68,374 @@ def test_openai(simple_prompt):
     )
     assert str(answer) != 0
     print(answer)
+
+
+class CountingLLM(BaseLLM):
+    calls: int = 0
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        self.calls += 1
+        return f"{model_name}: {prompt}"
+
+
+def test_cached_llm(tmp_path, simple_prompt):
+    inner = CountingLLM()
+    llm = CachedLLM(llm=inner, cache=DiskCache(folder=tmp_path))
+
+    first = llm.generate(prompt=simple_prompt, model_name="model")
+    assert llm.generate(prompt=simple_prompt, model_name="model") == first
+    assert inner.calls == 1
+    assert llm.cache.hits == 1
+
+    # Different options or models are different requests
+    llm.generate(
+        prompt=simple_prompt, model_name="model", options=LLMOptions(max_tokens=10)
+    )
+    llm.generate(prompt=simple_prompt, model_name="other")
+    assert inner.calls == 3
+
+    llm.discard(prompt=simple_prompt, model_name="model")
+    llm.generate(prompt=simple_prompt, model_name="model")
+    assert inner.calls == 4
+
+
+def test_rate_limiter_learns_from_headers():
+    limiter = RateLimiter(requests=TokenBucket(per_minute=6000))
+    limiter.observe_headers(
+        {
+            "X-RateLimit-Limit-Requests": "60",
+            "X-RateLimit-Limit-Tokens": "60000",
+            "X-RateLimit-Remaining-Requests": "0",
+        }
+    )
+    assert limiter.requests.per_minute == 60
+    assert limiter.tokens.per_minute == 60000
+    # Nothing left in the request bucket, the next call waits for a refill
+    assert limiter.requests.reserve(1) > 0
+
+    limiter.observe_headers({"retry-after": "2"})
+    assert limiter.tokens.reserve(0) > 1.9
+
+
+def test_rate_limiter_pauses_on_rate_limit():
+    limiter = RateLimiter(
+        requests=TokenBucket(per_minute=6000), default_retry_after=1.0
+    )
+    limiter.observe_rate_limit(None)
+    assert limiter.requests.reserve(1) > 0.9
+
+    # The retry-after sent by the provider wins over the default
+    limiter = RateLimiter(requests=TokenBucket(per_minute=6000))
+    limiter.observe_rate_limit({"retry-after": "0"})
+    assert limiter.requests.reserve(1) == 0
+
+
+class SlowLLM(BaseLLM):
+    delays: dict[str, float]
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        time.sleep(self.delays[model_name])
+        return model_name
+
+    async def agenerate(self, prompt, model_name, options=None) -> str:
+        await asyncio.sleep(self.delays[model_name])
+        return model_name
+
+
+def test_hedged_generate():
+    llm = SlowLLM(delays={"slow": 2.0, "fast": 0.01})
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record("slow", 0.05)
+    hedge = HedgeOptions(tracker=tracker)
+
+    start = time.perf_counter()
+    result = hedged_generate(
+        llm=llm,
+        prompt="prompt",
+        model_names=["slow", "fast"],
+        is_valid=lambda output: True,
+        hedge=hedge,
+    )
+    assert result == ("fast", "fast")
+    assert time.perf_counter() - start < 1
+
+    result = asyncio.run(
+        ahedged_generate(
+            llm=llm,
+            prompt="prompt",
+            model_names=["slow", "fast"],
+            is_valid=lambda output: True,
+            hedge=hedge,
+        )
+    )
+    assert result == ("fast", "fast")
+
+    # An invalid answer from the first model falls through to the next one
+    result = hedged_generate(
+        llm=llm,
+        prompt="prompt",
+        model_names=["fast", "slow"],
+        is_valid=lambda output: output == "slow",
+        hedge=hedge,
+    )
+    assert result == ("slow", "slow")
+
+
+class ChunkedLLM(BaseLLM):
+    """
+    Streams one chunk per `delay` seconds, and records the closed streams.
+    """
+
+    delays: dict[str, float]
+    down: set[str] = Field(default_factory=set)
+    closed: list[str] = Field(default_factory=list)
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        return "".join(self.stream(prompt, model_name, options))
+
+    def stream(self, prompt, model_name, options=None):
+        if model_name in self.down:
+            raise LLMServiceUnavailableError(model_name)
+        try:
+            for _ in range(10):
+                time.sleep(self.delays[model_name])
+                yield model_name[0]
+        finally:
+            self.closed.append(model_name)
+
+
+def test_hedged_generate_closes_loser():
+    llm = ChunkedLLM(delays={"slow": 0.1, "fast": 0.001})
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record("slow", 0.01)
+
+    result = hedged_generate(
+        llm=llm,
+        prompt="prompt",
+        model_names=["slow", "fast"],
+        is_valid=lambda output: True,
+        hedge=HedgeOptions(tracker=tracker),
+    )
+    assert result == ("fast", "f" * 10)
+    # The losing stream is closed well before its 10 chunks
+    deadline = time.perf_counter() + 1
+    while "slow" not in llm.closed and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert llm.closed == ["fast", "slow"]
+
+
+def test_hedged_generate_reports_unavailable():
+    llm = ChunkedLLM(delays={}, down={"first", "second"})
+    with pytest.raises(LLMServiceUnavailableError) as error:
+        hedged_generate(
+            llm=llm,
+            prompt="prompt",
+            model_names=["first", "second"],
+            is_valid=lambda output: True,
+        )
+    assert error.value.model_names == ["first", "second"]
+
+
+class FlakyLLM(BaseLLM):
+    failing: bool = True
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        if self.failing:
+            raise LLMServiceUnavailableError(model_name)
+        return model_name
+
+
+def test_circuit_breaker():
+    inner = FlakyLLM()
+    registry = HealthRegistry(min_calls=2, cooldown=0.1)
+    llm = HealthTrackedLLM(llm=inner, registry=registry)
+
+    for _ in range(2):
+        with pytest.raises(LLMServiceUnavailableError):
+            llm.generate(prompt="prompt", model_name="flaky")
+    assert registry.get_state("flaky") == "open"
+    assert registry.order(["flaky", "other"]) == ["other", "flaky"]
+
+    time.sleep(0.1)
+    assert registry.get_state("flaky") == "half_open"
+    inner.failing = False
+    llm.generate(prompt="prompt", model_name="flaky")
+    assert registry.get_state("flaky") == "closed"
+    assert registry.order(["flaky", "other"]) == ["flaky", "other"]
+
+
+def test_circuit_breaker_single_probe():
+    registry = HealthRegistry(min_calls=1, cooldown=0.1)
+    registry.record("flaky", ok=False, latency=1.0)
+    time.sleep(0.1)
+
+    # Only the first caller probes the half-open model
+    assert registry.order(["flaky", "other"]) == ["flaky", "other"]
+    assert registry.order(["flaky", "other"]) == ["other", "flaky"]
+    assert not registry.try_acquire_probe("flaky")
+
+    # A probe whose outcome never comes back is given back after the cooldown
+    time.sleep(0.1)
+    assert registry.try_acquire_probe("flaky")
+
+
+def test_shared_clients():
+    assert OpenAILLM()._client is OpenAILLM()._client
+    assert TogetherLLM()._client is TogetherLLM()._client
+
+    async def get_async_clients():
+        return OpenAILLM()._async_client, OpenAILLM()._async_client
+
+    first, second = run_async(get_async_clients())
+    assert first is second
+    assert first.is_closed()
+    # Async clients are bound to their event loop
+    third, _ = run_async(get_async_clients())
+    assert third is not first
+
+
+def test_together_session():
+    session = get_requests_session()
+    for url in ["https://api.together.xyz", "http://localhost:8000"]:
+        adapter = session.get_adapter(url)
+        assert adapter.max_retries.total == MAX_CONNECTION_RETRIES
+
+
+class UsageLLM(BaseLLM):
+    def generate(self, prompt, model_name, options=None) -> str:
+        report_usage(prompt_tokens=100, completion_tokens=10)
+        return "answer"
+
+
+def test_metrics(tmp_path):
+    sink = MetricsSink()
+    llm = MetricsLLM(llm=CachedLLM(llm=UsageLLM(), cache=DiskCache(folder=tmp_path)))
+
+    with llm_call_context(stage="filter", sink=sink):
+        llm.generate(prompt="prompt", model_name="gpt-4o-mini")
+    with llm_call_context(stage="summary", retries=1, sink=sink):
+        llm.generate(prompt="prompt", model_name="gpt-4o-mini")
+        # Streams closed early are estimated from what was read
+        "".join(llm.stream(prompt="other prompt", model_name="unpriced"))
+
+    first, cached, streamed = sink.get_calls()
+    assert (first.stage, first.prompt_tokens, first.completion_tokens) == (
+        "filter",
+        100,
+        10,
+    )
+    assert first.cost == pytest.approx((100 * 0.15 + 10 * 0.6) / 1_000_000)
+    assert cached.cache_hit and cached.cost == 0 and cached.retries == 1
+    assert streamed.cost is None
+
+    metrics = sink.summary()
+    assert metrics.total.calls == 3
+    assert metrics.by_stage["summary"].retries == 2
+    assert metrics.by_model["gpt-4o-mini"].prompt_tokens == 100
+    sink.export_jsonl(tmp_path / "metrics.jsonl")
+    assert len((tmp_path / "metrics.jsonl").read_text().splitlines()) == 3
+
+
+class StreamingCompletions:
+    """
+    Fake `chat.completions` of an OpenAI client, only reporting the usage on
+    the final chunk when asked to, as the API does.
+    """
+
+    def __init__(self):
+        self.with_raw_response = self
+        self.kwargs = {}
+
+    def create(self, **kwargs):
+        self.kwargs = kwargs
+        chunks = [
+            SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=text))],
+                usage=None,
+            )
+            for text in ["Hello", " world"]
+        ]
+        if kwargs.get("stream_options", {}).get("include_usage"):
+            usage = SimpleNamespace(
+                prompt_tokens=100,
+                completion_tokens=2,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=64),
+            )
+            chunks.append(SimpleNamespace(choices=[], usage=usage))
+
+        class Stream(list):
+            def close(self):
+                pass
+
+        return SimpleNamespace(headers={}, parse=lambda: Stream(chunks))
+
+
+def test_stream_usage():
+    llm = OpenAILLM()
+    completions = StreamingCompletions()
+    llm._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    sink = MetricsSink()
+
+    with llm_call_context(stage="summary", sink=sink):
+        text = "".join(MetricsLLM(llm=llm).stream(prompt="prompt", model_name="gpt-4o"))
+
+    assert text == "Hello world"
+    assert completions.kwargs["stream_options"] == {"include_usage": True}
+    (call,) = sink.get_calls()
+    assert not call.estimated_usage
+    assert (call.prompt_tokens, call.completion_tokens) == (100, 2)
+    assert call.cached_prompt_tokens == 64
+
+
+class LimitedLLM(BaseLLM):
+    limited: bool = False
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        if self.limited:
+            raise LLMRateLimitError(model_name)
+        return model_name
+
+
+def test_aimd_controller():
+    inner = LimitedLLM()
+    controller = AIMDController(min_concurrency=2, max_concurrency=6, limit=4)
+    sink = MetricsSink()
+    llm = MetricsLLM(llm=AdaptiveConcurrencyLLM(llm=inner, controller=controller))
+
+    with llm_call_context(stage="filter", sink=sink):
+        for _ in range(40):
+            llm.generate(prompt="prompt", model_name="model")
+        assert controller.current == 6
+
+        inner.limited = True
+        for _ in range(3):
+            with pytest.raises(LLMRateLimitError):
+                llm.generate(prompt="prompt", model_name="model")
+    # Halved once per overload, never under the floor
+    assert controller.current == 2
+    assert controller.decreases == 2
+    assert controller.in_flight == 0
+
+    metrics = sink.summary()
+    assert (metrics.total.min_concurrency, metrics.total.max_concurrency) == (2, 6)
+    assert sink.get_calls()[0].concurrency_limit == 4
+
+
+def test_aimd_latency_by_stage():
+    controller = AIMDController(limit=4)
+    for _ in range(20):
+        controller.acquire()
+        controller.release(time.monotonic() - 0.01, latency_key="filter/model")
+    # Summaries are slower than filter answers, without any overload
+    for _ in range(5):
+        controller.acquire()
+        controller.release(time.monotonic() - 1.0, latency_key="summary/model")
+    assert controller.decreases == 0
+
+    # A stream closed early says nothing about the latency
+    llm = AdaptiveConcurrencyLLM(llm=LimitedLLM(), controller=controller)
+    stream = llm.stream(prompt="prompt", model_name="other")
+    next(stream)
+    stream.close()
+    assert set(controller._latencies) == {"filter/model", "summary/model"}
+    assert controller.in_flight == 0
@@ -0,0 +1,110 @@
+from pathlib import Path
+
+import pytest
+
+from newsletter.llm.base import LLMOptions
+from newsletter.llm.clients import run_async
+from newsletter.llm.exception import LLMRateLimitError, LLMServiceUnavailableError
+from newsletter.llm.metrics import track_metrics
+from newsletter.llm.mock_server import (
+    PREFIX_BLOCK_CHARS,
+    MockLLMServer,
+    MockModelConfig,
+    MockServerConfig,
+)
+from newsletter.llm.openai import OpenAILLM
+from newsletter.llm.together_llm import TogetherLLM
+from newsletter.news.prompts import FILTER_PROMPT
+from newsletter.news.summarize import Summarizer
+from newsletter.scraper.reddit import RedditPostList
+from newsletter.settings import settings
+
+
+@pytest.fixture(scope="module")
+def mock_server():
+    config = MockServerConfig(
+        default=MockModelConfig(reasoning_words=20, relevant_ratio=1.0),
+        models={
+            "down": MockModelConfig(error_rate=1.0),
+            "limited": MockModelConfig(rate_limit_rate=1.0, retry_after=0.0),
+        },
+        seed=0,
+    )
+    # Let the errors reach the Summarizer instead of the SDK retry loops
+    max_retries = settings.llm_client.max_retries
+    settings.llm_client.max_retries = 0
+    with MockLLMServer(config=config) as server:
+        yield server
+    settings.llm_client.max_retries = max_retries
+
+
+@pytest.mark.parametrize("llm_class", [OpenAILLM, TogetherLLM])
+def test_mock_server_protocol(mock_server, llm_class):
+    llm = llm_class(base_url=mock_server.base_url)
+    prompt = FILTER_PROMPT.format(post="{}", user_interests="Anything")
+
+    output = llm.generate(
+        prompt=prompt, model_name="mock", options=LLMOptions(stop=["</answer>"])
+    )
+    assert output.endswith("<answer>Relevant")
+    assert "".join(llm.stream(prompt=prompt, model_name="mock")).endswith(
+        "<answer>Relevant</answer>"
+    )
+
+    with pytest.raises(LLMRateLimitError):
+        llm.generate(prompt=prompt, model_name="limited")
+
+
+def test_mock_server_fallback(mock_server):
+    post_list = RedditPostList.from_path(Path("tests") / "test_data" / "chatgpt.json")
+    summarizer = Summarizer(llm=track_metrics(OpenAILLM(base_url=mock_server.base_url)))
+
+    with pytest.raises(LLMServiceUnavailableError):
+        summarizer.llm.generate(prompt="prompt", model_name="down")
+
+    res = run_async(
+        summarizer.asummarize_posts(
+            posts=post_list.posts[:5],
+            filter_model=["down", "mock"],
+            summary_model=["mock"],
+        )
+    )
+    assert len(res.news) == 5
+    assert res.news[0].title == "Mock summary"
+    down = res.metrics.by_model["down"]
+    assert down.errors == down.calls > 0
+    assert res.metrics.by_stage["filter"].calls == down.calls + 5
+    assert res.metrics.by_stage["summary"].prompt_tokens > 0
+    assert res.metrics.total.completion_tokens > 0
+    # Prompts share their instructions before the post. The filter streams are
+    # closed once answered, before the usage comes
+    assert res.metrics.by_stage["summary"].prefix_cache_hits > 0
+    assert mock_server.stats.cached_tokens > 0
+
+
+def test_mock_server_batch_filter(mock_server):
+    post_list = RedditPostList.from_path(Path("tests") / "test_data" / "chatgpt.json")
+    summarizer = Summarizer(
+        llm=track_metrics(OpenAILLM(base_url=mock_server.base_url)),
+        filter_batch_size=3,
+    )
+
+    relevances = run_async(
+        summarizer.afilter_posts(posts=post_list.posts[:3], model_names=["mock"])
+    )
+    assert relevances == [True, True, True]
+    assert len(summarizer.metrics) == 1
+
+
+def test_mock_server_prefix_cache_bounded():
+    server = MockLLMServer(config=MockServerConfig(prefix_cache_blocks=2))
+    try:
+        first, second = "a" * 2 * PREFIX_BLOCK_CHARS, "b" * 2 * PREFIX_BLOCK_CHARS
+        assert server.get_cached_tokens(first) == 0
+        assert server.get_cached_tokens(first) > 0
+        # The blocks of the second prompt evict the least recently used ones
+        assert server.get_cached_tokens(second) == 0
+        assert len(server._prefixes) == 2
+        assert server.get_cached_tokens(first) == 0
+    finally:
+        server.server_close()
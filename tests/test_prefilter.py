@@ -0,0 +1,101 @@
+from pydantic import Field
+
+from newsletter.llm.base import BaseLLM
+from newsletter.news import prefilter
+from newsletter.news.prefilter import RelevancePrefilter, get_default_prefilter
+from newsletter.news.summarize import Summarizer
+from newsletter.scraper.post import ForumContent, Post, Text
+from newsletter.settings import settings
+
+INTERESTS = "New GPT language models and OpenAI releases\nRocket launches"
+
+
+def make_post(url: str, title: str, text: str) -> Post:
+    return Post(url=url, title=title, content=ForumContent(contents=[Text(text=text)]))
+
+
+POSTS = [
+    make_post(
+        "/r/a/1",
+        "OpenAI releases a new GPT model",
+        "The new GPT language model from OpenAI beats the older models.",
+    ),
+    make_post(
+        "/r/b/2",
+        "My sourdough starter",
+        "Flour, water and patience, the loaf came out great.",
+    ),
+    make_post(
+        "/r/c/3",
+        "Thoughts on ChatGPT for homework",
+        "Teachers keep finding essays written with it.",
+    ),
+]
+
+
+def test_prefilter_scores():
+    prefilter = RelevancePrefilter(interests=INTERESTS, accept_above=0.3)
+    close, unrelated, partial = (prefilter.score(post) for post in POSTS)
+
+    assert unrelated < prefilter.reject_below
+    assert close > prefilter.accept_above
+    # Only a part of "chatgpt" matches, it is left to the LLM
+    assert prefilter.reject_below < partial < prefilter.accept_above
+
+
+class RecordingLLM(BaseLLM):
+    prompts: list[str] = Field(default_factory=list)
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        self.prompts.append(prompt)
+        return "<answer>Relevant</answer>"
+
+
+def test_prefilter_skips_llm():
+    llm = RecordingLLM()
+    summarizer = Summarizer(
+        llm=llm,
+        prefilter=RelevancePrefilter(interests=INTERESTS, accept_above=0.3),
+        stream_filter=False,
+    )
+
+    assert summarizer.filter_posts(posts=POSTS, model_names=["m"]) == [
+        True,
+        False,
+        True,
+    ]
+    assert len(llm.prompts) == 1
+    assert "ChatGPT" in llm.prompts[0]
+    assert (summarizer.prefilter.accepted, summarizer.prefilter.rejected) == (1, 1)
+
+
+def test_prefilter_seeded_scores_do_not_depend_on_order():
+    scores = []
+    for posts in (POSTS, POSTS[::-1]):
+        prefilter = RelevancePrefilter(interests=INTERESTS)
+        assert prefilter.seed(POSTS * 20) == 60
+        scores.append({post.url: prefilter.score(post) for post in posts})
+
+    for url, score in scores[0].items():
+        assert abs(score - scores[1][url]) < 1e-3
+
+
+def test_default_prefilter_seeded_once(monkeypatch):
+    reads = []
+
+    def iter_recent_posts():
+        reads.append(1)
+        return iter(POSTS)
+
+    monkeypatch.setattr(prefilter, "iter_recent_posts", iter_recent_posts)
+    monkeypatch.setattr(prefilter, "_seed", None)
+    monkeypatch.setattr(settings.prefilter, "enabled", True)
+
+    first, second = get_default_prefilter(), get_default_prefilter()
+    assert len(reads) == 1
+    assert first._documents == second._documents == len(POSTS)
+    # Each pre-filter counts the posts of its run on its own copy
+    first.interests = INTERESTS
+    first.score(POSTS[0])
+    assert first._documents == len(POSTS) + 1
+    assert second._documents == len(POSTS)
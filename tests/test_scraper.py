@@ -1,9 +1,33 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
+import requests
 
-from newsletter.scraper.reddit import PostFilter, RedditScraper
-from newsletter.scraper.webpage import scrape_webpage
+from newsletter.cache import DiskCache
+from newsletter.scraper import webpage
+from newsletter.scraper.post import (
+    Comment,
+    ForumContent,
+    Image,
+    Post,
+    Text,
+    Video,
+)
+from newsletter.scraper.reddit import (
+    PostFilter,
+    Preference,
+    RedditPostList,
+    RedditScraper,
+)
+from newsletter.scraper.state import SourceState
+from newsletter.scraper.store import RawDataStore
+from newsletter.scraper.webpage import CachedWebpage, Webpage, scrape_webpage
+from newsletter.settings import settings
 
 
 @pytest.fixture
@@ -11,14 +35,267 @@ def mock_reddit_filter():
     return PostFilter(upvotes=100, upvote_ratio=None, recency=2)
 
 
-def test_reddit_scraper(mock_reddit_filter):
+def test_reddit_scraper(mock_reddit_filter, tmp_path):
     scraper = RedditScraper()
     res = scraper.scrape(
         subreddit="chatgpt",
         post_filter=mock_reddit_filter,
         limit=10,
     )
-    res.save(Path("test.json"))
+    RawDataStore(folder=tmp_path).append(
+        run_id="run-1", name="chatgpt", posts=res.posts
+    )
+
+
+class FakeSubreddit:
+    def __init__(self, name: str, barrier: threading.Barrier):
+        self.name = name
+        self.barrier = barrier
+
+    def hot(self, **kwargs):
+        # Every subreddit waits for the others: they are scraped concurrently
+        self.barrier.wait(timeout=5)
+        if self.name == "broken":
+            raise RuntimeError("listing failed")
+        if self.name == "slow":
+            time.sleep(0.2)
+        return [
+            SimpleNamespace(
+                id=f"{self.name}-{idx}",
+                title=f"{self.name} {idx}",
+                ups=100,
+                upvote_ratio=0.9,
+                created_utc=time.time(),
+            )
+            for idx in range(3)
+        ]
+
+
+class FakeReddit:
+    def __init__(self, subreddits: int):
+        self.barrier = threading.Barrier(subreddits)
+
+    def subreddit(self, name: str) -> FakeSubreddit:
+        return FakeSubreddit(name, self.barrier)
+
+
+def get_fake_scraper(monkeypatch, subreddits: int) -> RedditScraper:
+    monkeypatch.setattr(
+        RedditScraper,
+        "_parse_submission_to_post",
+        lambda self, submission: Post(id=submission.id, title=submission.title),
+    )
+    return RedditScraper.model_construct(
+        client=FakeReddit(subreddits), max_concurrent_subreddits=4, incremental=False
+    )
+
+
+def get_preferences(*names: str) -> list[Preference]:
+    return [Preference(subreddit_name=name, post_filter=PostFilter()) for name in names]
+
+
+def test_scrape_subreddits_concurrently(monkeypatch):
+    scraper = get_fake_scraper(monkeypatch, subreddits=3)
+    result = scraper.scrape_with_preferences(get_preferences("slow", "a", "b"))
+
+    # In the order of the preferences, not the order they finished in
+    assert list(result) == ["slow", "a", "b"]
+    assert sorted(post.title for post in result["slow"].posts) == [
+        "slow 0",
+        "slow 1",
+        "slow 2",
+    ]
+
+
+def test_iter_scrape_subreddits_concurrently(monkeypatch):
+    scraper = get_fake_scraper(monkeypatch, subreddits=3)
+    items = list(
+        scraper.iter_scrape_with_preferences(get_preferences("slow", "a", "b"))
+    )
+    assert sorted(post.id for _, post in items) == sorted(
+        f"{name}-{idx}" for name in ["slow", "a", "b"] for idx in range(3)
+    )
+    assert all(post.id.startswith(name) for name, post in items)
+
+    # A failing subreddit still ends its stream, the others are all yielded
+    scraper = get_fake_scraper(monkeypatch, subreddits=2)
+    items = []
+    with pytest.raises(RuntimeError):
+        for item in scraper.iter_scrape_with_preferences(
+            get_preferences("broken", "a")
+        ):
+            items.append(item)
+    assert sorted(post.id for _, post in items) == ["a-0", "a-1", "a-2"]
+
+
+def test_bound_comment_fetch():
+    scraper = RedditScraper.model_construct(
+        comment_limit=5, comment_depth=2, comment_sort="new"
+    )
+    fetch_params = {}
+    submission = SimpleNamespace(
+        _fetched=False,
+        add_fetch_param=lambda key, value: fetch_params.update({key: value}),
+    )
+    scraper._bound_comment_fetch(submission)
+    assert (submission.comment_limit, submission.comment_sort) == (5, "new")
+    assert fetch_params == {"depth": 2}
+
+    # Comments already loaded are left alone
+    fetched = SimpleNamespace(_fetched=True)
+    scraper._bound_comment_fetch(fetched)
+    assert not hasattr(fetched, "comment_limit")
+
+
+def test_prefilter_submission(mock_reddit_filter):
+    now = datetime.now()
+    fresh_popular = SimpleNamespace(
+        ups=500, upvote_ratio=0.9, created_utc=now.timestamp()
+    )
+    unpopular = SimpleNamespace(ups=10, upvote_ratio=0.9, created_utc=now.timestamp())
+    stale = SimpleNamespace(
+        ups=500, upvote_ratio=0.9, created_utc=(now - timedelta(days=5)).timestamp()
+    )
+
+    assert mock_reddit_filter.to_accept_submission(fresh_popular)
+    assert not mock_reddit_filter.to_accept_submission(unpopular)
+    assert not mock_reddit_filter.to_accept_submission(stale)
+
+
+def test_incremental_state(tmp_path):
+    state = SourceState(name="chatgpt")
+    assert state.is_changed("abc", score=100, content_hash="h1", score_change=0.5)
+
+    state.stage("abc", score=100, content_hash="h1")
+    assert state.is_changed("abc", score=100, content_hash="h1", score_change=0.5)
+    state.commit()
+    state.save(tmp_path)
+    state = SourceState.load(tmp_path, "chatgpt")
+
+    assert not state.is_changed("abc", score=140, content_hash="h1", score_change=0.5)
+    assert state.is_changed("abc", score=200, content_hash="h1", score_change=0.5)
+    assert state.is_changed("abc", score=100, content_hash="h2", score_change=0.5)
+
+
+def test_raw_data_store(tmp_path):
+    store = RawDataStore(folder=tmp_path)
+    store.append(run_id="run-1", name="chatgpt", posts=[Post(title="a")])
+    store.append(run_id="run-1", name="chatgpt", posts=[Post(title="b")])
+    store.append(run_id="run-2", name="openai", posts=[Post(title="c")])
+
+    assert store.get_runs() == ["run-1", "run-2"]
+    assert [post.title for post in store.iter_posts(run_id="run-1")] == ["a", "b"]
+    assert [post.title for post in store.iter_posts(name="openai")] == ["c"]
+
+    post = Post(
+        title="d",
+        content=ForumContent(
+            contents=[
+                Text(text="Body"),
+                Webpage(title="Article", content="Page text"),
+                Image(url="https://i.redd.it/1.jpeg"),
+            ]
+        ),
+        comments=[Comment(content=ForumContent(contents=[Text(text="Reply")]))],
+    )
+    store.append(run_id="run-3", name="chatgpt", posts=[post])
+    (restored,) = store.iter_posts(run_id="run-3")
+    assert restored == post
+    assert isinstance(restored.content.contents[1], Webpage)
+    assert restored.content.contents[1].content == "Page text"
+    assert restored.comments[0].content.contents[0].text == "Reply"
+
+
+def test_untagged_contents():
+    # Posts saved before the contents were tagged with their type
+    post_list = RedditPostList.from_path(Path("tests") / "test_data" / "chatgpt.json")
+    contents = [
+        content
+        for post in post_list.posts
+        for content in [
+            *post.content.contents,
+            *(c for comment in post.comments for c in comment.content.contents),
+        ]
+    ]
+    assert any(isinstance(content, Image) for content in contents)
+    assert any(isinstance(content, Text) and content.text for content in contents)
+
+    content = ForumContent.model_validate(
+        {"contents": [{"url": "https://v.redd.it/1/DASH_720.mp4"}, {"title": "Page"}]}
+    )
+    assert [type(c) for c in content.contents] == [Video, Webpage]
+
+
+def test_post_prompt_view():
+    post = Post(
+        title="New model",
+        url="https://reddit.com/r/test/1",
+        created_utc=1726412414,
+        upvotes=10,
+        content=ForumContent(
+            contents=[Text(text="Out today"), Image(url="https://i.redd.it/a.png")]
+        ),
+        comments=[
+            Comment(
+                author="someone",
+                upvotes=3,
+                content=ForumContent(contents=[Text(text="Nice")]),
+                comments=[ForumContent(contents=[Text(text="Agreed")])],
+            ),
+            Comment(content=ForumContent(contents=[Image(url="https://i.redd.it/b")])),
+        ],
+    )
+    assert post.to_prompt() == (
+        '{"title":"New model","text":"Out today","votes":10,'
+        '"comments":[{"text":"Nice","votes":3,"replies":["Agreed"]}]}'
+    )
+
+
+def test_webpage_cache_fallback(tmp_path, monkeypatch):
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError("offline")
+
+    monkeypatch.setattr(requests, "get", offline)
+    cache = DiskCache(folder=tmp_path, ttl=0)
+    url = "https://example.com/article"
+
+    cache.set(url, "not a webpage")
+    with pytest.raises(requests.ConnectionError):
+        scrape_webpage(url, cache=cache)
+    assert cache.get(url, allow_stale=True) is None
+
+    # Stale, and the server cannot be reached
+    cached = CachedWebpage(webpage=Webpage(title="Article", content="Text"))
+    cache.set(url, cached.model_dump_json())
+    assert scrape_webpage(url, cache=cache).content == "Text"
+
+
+ARTICLE_HTML = """<html><head><title>Pooled article</title></head><body><article>
+<h1>Pooled article</h1>
+<p>Parsing webpages in a process pool keeps the scraping threads off the GIL,
+so that many pages can be extracted at the same time.</p>
+</article></body></html>"""
+
+
+def test_pooled_extraction(monkeypatch):
+    monkeypatch.setattr(settings.scraper, "extraction_workers", 1)
+    monkeypatch.setattr(webpage, "_extraction_pool", None)
+    stats = webpage.ExtractionStats()
+    monkeypatch.setattr(webpage, "extraction_stats", stats)
+
+    try:
+        for _ in range(2):
+            page = webpage.extract_webpage_in_pool(
+                url="https://example.com/article", html=ARTICLE_HTML
+            )
+            assert page.title == "Pooled article"
+            assert "process pool" in page.content
+    finally:
+        webpage._extraction_pool.shutdown()
+
+    ((worker_pid, worker),) = stats.workers.items()
+    assert worker_pid != os.getpid()
+    assert worker.pages == 2 and worker.throughput > 0
 
 
 def test_webpage_scraper():
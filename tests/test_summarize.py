@@ -1,11 +1,23 @@
+import asyncio
+import re
 import time
 from pathlib import Path
 
 import pytest
+from pydantic import Field
 
+from newsletter.cache import DiskCache
+from newsletter.llm.base import BaseLLM
+from newsletter.llm.cache import CachedLLM
+from newsletter.llm.exception import LLMRateLimitError, LLMServiceUnavailableError
+from newsletter.llm.health import HealthRegistry
+from newsletter.llm.metrics import track_metrics
 from newsletter.llm.together_llm import TogetherLLM
-from newsletter.news.summarize import Summarizer
+from newsletter.news.prefilter import RelevancePrefilter
+from newsletter.news.results import ResultStore
+from newsletter.news.summarize import FILTER_OPTIONS, LLMAttempt, Summarizer
 from newsletter.scraper.reddit import RedditPostList
+from newsletter.settings import StorageSettings, settings
 
 
 @pytest.fixture()
@@ -18,6 +30,29 @@ def mock_summarizer() -> Summarizer:
     return Summarizer(llm=TogetherLLM())
 
 
+class EchoLLM(BaseLLM):
+    """
+    Offline LLM marking every post whose title contains "GPT" as relevant.
+    """
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        if "Summary:" in prompt:
+            return "<title>Title</title><body>Body</body>"
+        batch = re.findall(r'<post id="(\d+)">\n\{"title":"(.*?)"', prompt)
+        if batch:
+            # The last post is left unanswered, to be filtered on its own
+            return "\n".join(
+                f'<answer id="{idx}">'
+                + ("Relevant" if "GPT" in title else "Not relevant")
+                + "</answer>"
+                for idx, title in batch[:-1]
+            )
+        title = re.search(r'"title":"(.*?)"', prompt).group(1)
+        if "GPT" in title:
+            return "<answer>Relevant</answer>"
+        return "<answer>Not relevant</answer>"
+
+
 def test_filter(mock_post_list, mock_summarizer):
     res = mock_summarizer.filter_post(
         post=mock_post_list.posts[0],
@@ -56,3 +91,206 @@ def test_summarize_post_list(mock_post_list, mock_summarizer):
     pprint(f"{res=}")
     end = time.perf_counter()
     print(f"Elapsed time: {end - start:.2f} seconds")
+
+
+def test_summarize_posts_pipeline(mock_post_list):
+    summarizer = Summarizer(llm=EchoLLM())
+    res = summarizer.summarize_posts(
+        posts=iter(mock_post_list.posts),
+        filter_model=["echo"],
+        summary_model=["echo"],
+        newsletter_name="test_newsletter",
+    )
+
+    relevant = [post for post in mock_post_list.posts if "GPT" in post.title]
+    assert len(res.news) == len(relevant)
+    assert {news.sources[0] for news in res.news} == {post.url for post in relevant}
+
+
+def test_asummarize_posts_pipeline(mock_post_list):
+    summarizer = Summarizer(llm=EchoLLM())
+    res = asyncio.run(
+        summarizer.asummarize_posts(
+            posts=iter(mock_post_list.posts),
+            filter_model=["echo"],
+            summary_model=["echo"],
+            newsletter_name="test_newsletter",
+        )
+    )
+
+    relevant = [post for post in mock_post_list.posts if "GPT" in post.title]
+    assert {news.sources[0] for news in res.news} == {post.url for post in relevant}
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_filter_batch(mock_post_list, use_async):
+    summarizer = Summarizer(llm=track_metrics(EchoLLM()), filter_batch_size=4)
+    kwargs = dict(
+        posts=iter(mock_post_list.posts),
+        filter_model=["echo"],
+        summary_model=["echo"],
+        newsletter_name="test_newsletter",
+    )
+    if use_async:
+        res = asyncio.run(summarizer.asummarize_posts(**kwargs))
+    else:
+        res = summarizer.summarize_posts(**kwargs)
+
+    relevant = [post for post in mock_post_list.posts if "GPT" in post.title]
+    assert {news.sources[0] for news in res.news} == {post.url for post in relevant}
+    # 6 posts: two batches, each with its last post filtered alone
+    assert res.metrics.by_stage["filter"].calls == 4
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_result_store(tmp_path, mock_post_list, use_async):
+    store = ResultStore(cache=DiskCache(folder=tmp_path))
+
+    def run():
+        summarizer = Summarizer(llm=track_metrics(EchoLLM()), results=store)
+        kwargs = dict(
+            posts=iter(mock_post_list.posts),
+            filter_model=["echo"],
+            summary_model=["echo"],
+            newsletter_name="test_newsletter",
+        )
+        if use_async:
+            return asyncio.run(summarizer.asummarize_posts(**kwargs))
+        return summarizer.summarize_posts(**kwargs)
+
+    first = run()
+    assert store.stored == len(mock_post_list.posts)
+    # Votes change between runs, the content does not
+    for post in mock_post_list.posts:
+        post.upvotes += 100
+    second = run()
+    assert second.metrics.total.calls == 0
+    assert sorted(news.sources[0] for news in second.news) == sorted(
+        news.sources[0] for news in first.news
+    )
+
+    mock_post_list.posts[0].title += " (edited)"
+    third = run()
+    assert third.metrics.total.calls > 0
+    assert store.stored == len(mock_post_list.posts) + 1
+
+
+class RejectAllPrefilter(RelevancePrefilter):
+    def decide(self, post):
+        return False
+
+
+def test_result_store_key(tmp_path, mock_post_list):
+    store = ResultStore(cache=DiskCache(folder=tmp_path))
+    kwargs = dict(
+        posts=mock_post_list.posts,
+        filter_model=["echo"],
+        summary_model=["echo"],
+        newsletter_name="test_newsletter",
+    )
+
+    # Pre-filter rejections are not stored as hard rejections
+    Summarizer(
+        llm=EchoLLM(), results=store, prefilter=RejectAllPrefilter()
+    ).summarize_posts(**kwargs)
+    assert store.stored == 0
+
+    Summarizer(llm=EchoLLM(), results=store, prefilter=None).summarize_posts(**kwargs)
+    assert store.stored == len(mock_post_list.posts)
+
+    # Another summary model does not reuse the stored results
+    summarizer = Summarizer(llm=track_metrics(EchoLLM()), results=store, prefilter=None)
+    newsletter = summarizer.summarize_posts(**{**kwargs, "summary_model": ["other"]})
+    assert newsletter.metrics.total.calls > 0
+    assert store.stored == 2 * len(mock_post_list.posts)
+
+
+class StreamingLLM(BaseLLM):
+    """
+    Answers first, then keeps rambling. Records how many chunks were read.
+    """
+
+    chunks_read: int = 0
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        return "".join(self.stream(prompt, model_name, options))
+
+    def stream(self, prompt, model_name, options=None):
+        for chunk in ["<answer>", "Relevant", "</answer>", *["reasoning"] * 100]:
+            self.chunks_read += 1
+            yield chunk
+
+
+def test_filter_stream_early_cutoff(tmp_path, mock_post_list):
+    inner = StreamingLLM()
+    summarizer = Summarizer(
+        llm=CachedLLM(llm=inner, cache=DiskCache(folder=tmp_path)), health=None
+    )
+
+    assert summarizer.filter_post(post=mock_post_list.posts[0], model_names=["m"])
+    assert inner.chunks_read <= 3
+    chunks_read = inner.chunks_read
+
+    # The partial output is cached and still decides the filter
+    assert summarizer.filter_post(post=mock_post_list.posts[0], model_names=["m"])
+    assert inner.chunks_read == chunks_read
+
+    # A full generation of the same prompt does not get the partial output
+    prompt = summarizer._format_filter_prompt(post=mock_post_list.posts[0])
+    output = summarizer.llm.generate(
+        prompt=prompt, model_name="m", options=FILTER_OPTIONS
+    )
+    assert output.endswith("reasoning")
+
+
+class DownLLM(EchoLLM):
+    down: set[str]
+    called: list[str] = Field(default_factory=list)
+
+    def generate(self, prompt, model_name, options=None) -> str:
+        self.called.append(model_name)
+        if model_name in self.down:
+            raise LLMServiceUnavailableError(model_name)
+        return super().generate(prompt, model_name, options)
+
+
+def test_filter_fallback_skips_failed_model(mock_post_list):
+    registry = HealthRegistry(min_calls=1, cooldown=60)
+    registry.record("primary", ok=False, latency=1.0)
+    inner = DownLLM(down={"fallback"})
+    summarizer = Summarizer(llm=inner, health=registry, stream_filter=False)
+
+    # The health registry tries the fallback first, which fails: the retry goes
+    # to the primary instead of the failed fallback again
+    summarizer.filter_post(
+        post=mock_post_list.posts[0], model_names=["primary", "fallback"]
+    )
+    assert inner.called == ["fallback", "primary"]
+
+
+def test_filter_rate_limit_backoff(mock_post_list):
+    summarizer = Summarizer(llm=EchoLLM(), health=None)
+    policy = summarizer._filter_policy(
+        post=mock_post_list.posts[0], model_names=["m"], num_retries=0
+    )
+
+    assert isinstance(next(policy), LLMAttempt)
+    # The retry-after of the provider is waited, else the backoff doubles
+    assert policy.throw(LLMRateLimitError(retry_after=7.0)) == 7.0
+    assert isinstance(policy.send(None), LLMAttempt)
+    assert policy.throw(LLMRateLimitError()) == settings.rate_limit.retry_backoff * 2
+    # Rate limits do not use up the retries after failures
+    assert isinstance(policy.send(None), LLMAttempt)
+
+
+def test_interest_prompt_cache(tmp_path):
+    storage = StorageSettings(preferences_folder=tmp_path)
+    assert storage.get_user_interest_prompt() is None
+
+    storage.save_user_interest_prompt("AI")
+    interests = storage.get_user_interest_prompt()
+    assert interests == "AI"
+    assert storage.get_user_interest_prompt() is interests
+    # Edited outside of the app
+    storage.interest_file.write_text("AI and robotics")
+    assert storage.get_user_interest_prompt() == "AI and robotics"